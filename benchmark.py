@@ -0,0 +1,420 @@
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+
+import m3u_processor as m3u
+from m3u_processor import Colors
+
+# Banco de pruebas sin conexión: genera listas M3U y guías XMLTV sintéticas, las sirve desde un servidor
+# HTTP local que simula latencia, fallos y descargas lentas, y mide cada etapa del procesamiento.
+# Uso: python benchmark.py --tamanos 1000 10000 --salida resultados.json [--comparar anterior.json]
+
+BENCHMARK_VERSION = 1
+DEFAULT_SIZES = (1000, 10000)
+QUALITY_TAGS = (' HD', ' FHD', ' SD', ' UHD', ' 1080', ' 720')
+NAME_PREFIXES = ('ES: ', 'ES | ', '[ES] ', 'VIP ')
+SYLLABLES = ('ra', 'to', 'me', 'di', 'sa', 'lu', 'no', 'ca', 've', 'pi', 'zo', 'mar', 'sol', 'del', 'tur', 'gen')
+CATEGORIES = ('Deportes', 'Cine', 'Noticias', 'Música', 'Infantil', 'Documentales', 'Series', 'Regional')
+
+# Perfiles de los streams sintéticos: peso relativo por defecto de cada comportamiento del servidor
+DEFAULT_STREAM_PROFILE = {
+    'ok': 0.80,
+    'http_error': 0.08,
+    'slow_body': 0.04,
+    'hang': 0.03,
+    'dead_host': 0.05
+}
+
+
+class _ServidorPruebasHandler(BaseHTTPRequestHandler):
+    # El comportamiento de cada URL va en la propia URL (?ms=latencia&st=estado&kb=tamaño&bps=velocidad),
+    # así las listas generadas con la misma semilla dan siempre los mismos resultados
+    protocol_version = "HTTP/1.1"
+
+    def _responder(self, con_cuerpo):
+        partes = urlsplit(self.path)
+        if partes.path in self.server.archivos:
+            self._servir_archivo(self.server.archivos[partes.path], con_cuerpo)
+            return
+
+        query = parse_qs(partes.query)
+        latencia_ms = int(query.get('ms', ['0'])[0])
+        estado = int(query.get('st', ['200'])[0])
+        tamano = int(query.get('kb', ['4'])[0]) * 1024
+        bytes_por_segundo = int(query.get('bps', ['0'])[0])
+        if latencia_ms:
+            time.sleep(latencia_ms / 1000)
+
+        if estado != 200:
+            self.send_response(estado)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        rango = self.headers.get('Range')
+        if rango and rango.startswith('bytes=0-'):
+            fin = rango[len('bytes=0-'):]
+            tamano = min(tamano, int(fin) + 1) if fin.isdigit() else tamano
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(tamano))
+        self.end_headers()
+        if not con_cuerpo:
+            return
+
+        bloque = b'\x47' * 16384
+        enviados = 0
+        try:
+            while enviados < tamano:
+                trozo = bloque[:min(len(bloque), tamano - enviados)]
+                self.wfile.write(trozo)
+                enviados += len(trozo)
+                if bytes_por_segundo:
+                    time.sleep(len(trozo) / bytes_por_segundo)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _servir_archivo(self, ruta, con_cuerpo):
+        tamano = os.path.getsize(ruta)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/gzip' if ruta.endswith('.gz') else 'application/xml')
+        self.send_header('Content-Length', str(tamano))
+        self.end_headers()
+        if con_cuerpo:
+            with open(ruta, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_GET(self):
+        self._responder(True)
+
+    def do_HEAD(self):
+        self._responder(False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ServidorPruebas(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _ServidorPruebasHandler)
+        self.archivos = {}
+        self.hilo = None
+
+    @property
+    def url_base(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handle_error(self, request, client_address):
+        # Los clientes cierran conexiones keep-alive y streams a medias: no es un error del servidor
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def publicar(self, ruta_url, ruta_archivo):
+        self.archivos[ruta_url] = ruta_archivo
+        return self.url_base + ruta_url
+
+    def iniciar(self):
+        self.hilo = threading.Thread(target=self.serve_forever, daemon=True)
+        self.hilo.start()
+        return self
+
+    def detener(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _nombre_base(aleatorio, indice):
+    # Nombres reales del perfil integrado y el resto inventados, para que el EPG tenga variedad
+    nombres_reales = list(m3u.COMMON_SPANISH_CHANNELS_ORDER)
+    if indice < len(nombres_reales):
+        return nombres_reales[indice].title()
+    palabra = ''.join(aleatorio.choice(SYLLABLES) for _ in range(aleatorio.randint(2, 3)))
+    return f"{palabra.capitalize()} {aleatorio.choice(CATEGORIES)} {indice}"
+
+
+def _anadir_ruido(aleatorio, nombre):
+    variante = aleatorio.randrange(6)
+    if variante == 0:
+        return nombre + aleatorio.choice(QUALITY_TAGS)
+    if variante == 1:
+        return aleatorio.choice(NAME_PREFIXES) + nombre
+    if variante == 2:
+        return nombre.upper()
+    if variante == 3 and len(nombre) > 3:
+        # Errata: dos letras contiguas intercambiadas
+        posicion = aleatorio.randrange(len(nombre) - 1)
+        return nombre[:posicion] + nombre[posicion + 1] + nombre[posicion] + nombre[posicion + 2:]
+    if variante == 4:
+        return nombre.replace(' ', '  ') + ' +'
+    return nombre + aleatorio.choice(QUALITY_TAGS) + ' (Backup)'
+
+
+def _url_sintetica(aleatorio, url_base, indice, perfil, timeout):
+    comportamiento = aleatorio.choices(list(perfil), weights=list(perfil.values()))[0]
+    if comportamiento == 'dead_host':
+        # Puerto cerrado: conexión rechazada, siempre en el mismo "servidor caído"
+        return f"http://127.0.0.1:9/live/{indice}.ts"
+    if comportamiento == 'http_error':
+        return f"{url_base}/live/{indice}.ts?st={aleatorio.choice((403, 404, 500, 503))}"
+    if comportamiento == 'hang':
+        return f"{url_base}/live/{indice}.ts?ms={int((timeout + 1) * 1000)}"
+    if comportamiento == 'slow_body':
+        return f"{url_base}/live/{indice}.ts?ms={aleatorio.randint(50, 300)}&kb=512&bps=65536"
+    return f"{url_base}/live/{indice}.ts?ms={aleatorio.randint(0, 40)}&kb={aleatorio.choice((4, 64, 512))}"
+
+
+def generar_m3u(ruta, entradas, url_base, ratio_duplicados=0.3, ruido=0.3, semilla=1, perfil=None, timeout=2):
+    # Devuelve la lista de nombres base usados, para generar después un EPG que los cubra
+    aleatorio = random.Random(semilla)
+    perfil = perfil or DEFAULT_STREAM_PROFILE
+    nombres_base = []
+    with open(ruta, 'w', encoding='utf-8') as f:
+        f.write("#EXTM3U\n")
+        for indice in range(entradas):
+            if nombres_base and aleatorio.random() < ratio_duplicados:
+                nombre = aleatorio.choice(nombres_base)
+            else:
+                nombre = _nombre_base(aleatorio, len(nombres_base))
+                nombres_base.append(nombre)
+            if aleatorio.random() < ruido:
+                nombre = _anadir_ruido(aleatorio, nombre)
+            grupo = aleatorio.choice(CATEGORIES)
+            logo = f"{url_base}/logos/{indice}.png"
+            f.write(f'#EXTINF:-1 tvg-id="" tvg-name="{nombre}" tvg-logo="{logo}" group-title="{grupo}",{nombre}\n')
+            f.write(_url_sintetica(aleatorio, url_base, indice, perfil, timeout) + "\n")
+    return nombres_base
+
+
+def generar_xmltv(ruta, nombres_base, cobertura=0.8, canales_extra=500, programas_por_canal=5, semilla=1):
+    aleatorio = random.Random(semilla)
+    canales = [nombre for nombre in nombres_base if aleatorio.random() < cobertura]
+    canales += [_nombre_base(aleatorio, len(nombres_base) + indice) for indice in range(canales_extra)]
+    abrir = gzip.open if ruta.endswith('.gz') else open
+    with abrir(ruta, 'wt', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="benchmark">\n')
+        ids = []
+        for nombre in canales:
+            channel_id = nombre.replace(' ', '') + '.es'
+            ids.append(channel_id)
+            f.write(f'  <channel id="{escape(channel_id)}">\n')
+            f.write(f'    <display-name>{escape(nombre)}</display-name>\n')
+            if aleatorio.random() < 0.5:
+                f.write(f'    <display-name>{escape(nombre)} HD</display-name>\n')
+            f.write('  </channel>\n')
+        for channel_id in ids:
+            for numero in range(programas_por_canal):
+                inicio = f"20240101{numero:02d}0000 +0100"
+                fin = f"20240101{numero + 1:02d}0000 +0100"
+                f.write(f'  <programme start="{inicio}" stop="{fin}" channel="{escape(channel_id)}">\n')
+                f.write(f'    <title>Programa {numero}</title>\n    <desc>{"Descripción sintética. " * 8}</desc>\n')
+                f.write('  </programme>\n')
+        f.write('</tv>\n')
+    return len(canales)
+
+
+def medir(funcion, repeticiones, elementos=None):
+    tiempos = []
+    resultado = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    mediana = statistics.median(tiempos)
+    etapa = {
+        'segundos': mediana,
+        'minimo': min(tiempos),
+        'maximo': max(tiempos),
+        'repeticiones': tiempos
+    }
+    if elementos is not None:
+        etapa['elementos'] = elementos
+        etapa['por_segundo'] = elementos / mediana if mediana > 0 else None
+    return etapa, resultado
+
+
+def ejecutar_tamano(entradas, servidor, directorio, args):
+    print(f"\n{Colors.BOLD}=== {entradas} entradas ==={Colors.RESET}")
+    ruta_m3u = os.path.join(directorio, f"lista_{entradas}.m3u")
+    ruta_epg = os.path.join(directorio, f"guia_{entradas}.xml.gz")
+    nombres_base = generar_m3u(ruta_m3u, entradas, servidor.url_base, args.duplicados, args.ruido, args.semilla,
+                               timeout=args.timeout)
+    canales_epg = generar_xmltv(ruta_epg, nombres_base, args.cobertura_epg, args.canales_epg_extra, args.programas,
+                                args.semilla)
+    url_epg = servidor.publicar(f"/guia_{entradas}.xml.gz", ruta_epg)
+    etapas = {}
+    silencio = io.StringIO()
+
+    def etapa(nombre, funcion, elementos=None, repeticiones=None):
+        with contextlib.redirect_stdout(silencio):
+            etapas[nombre], resultado = medir(funcion, repeticiones or args.repeticiones, elementos)
+        silencio.seek(0)
+        silencio.truncate()
+        por_segundo = etapas[nombre].get('por_segundo')
+        detalle = f" ({por_segundo:,.0f}/s)" if por_segundo else ""
+        print(f"  {nombre:<36} {Colors.YELLOW}{etapas[nombre]['segundos']:.4f} s{Colors.RESET}{detalle}")
+        return resultado
+
+    lineas = etapa('leer_m3u', lambda: m3u.leer_m3u(ruta_m3u), entradas)
+    canales = etapa('parsear_m3u', lambda: [datos for tipo, datos in m3u.parsear_m3u(lineas) if tipo == 'canal'], entradas)
+    lineas = None
+
+    epg_data = etapa('descargar_y_parsear_epg', lambda: m3u.descargar_y_parsear_epg(url_epg), canales_epg)
+    epg_index = etapa('indice_epg', lambda: m3u.EpgMatchIndex(epg_data), len(epg_data))
+
+    nombres = list(dict.fromkeys(canal.tvg_name for canal in canales))[:args.max_emparejamientos]
+    emparejados = etapa('encontrar_epg_id',
+                        lambda: sum(1 for nombre in nombres if m3u.encontrar_epg_id(nombre, epg_data, epg_index)),
+                        len(nombres))
+    # Los mismos nombres emparejados en bloque (con rapidfuzz si está instalado)
+    canales_nombres = list({canal.tvg_name: canal for canal in canales}.values())[:args.max_emparejamientos]
+    etapa('emparejar_canales_epg', lambda: m3u.emparejar_canales_epg(canales_nombres, epg_data, epg_index),
+          len(canales_nombres))
+
+    for metodo in ('first', 'quality'):
+        etapa(f'filter_duplicate_channels[{metodo}]', lambda: m3u.filter_duplicate_channels(canales, metodo), entradas)
+
+    a_sondear = canales[:args.max_sondeos]
+    resultados_sondeo = {'ok': 0, 'fallidos': 0}
+
+    def sondear():
+        resultados_sondeo['ok'] = resultados_sondeo['fallidos'] = 0
+        for canal, resultado in m3u.comprobar_canales_concurrente(a_sondear, args.timeout, args.workers, args.metodo):
+            resultados_sondeo['ok' if resultado['ok'] else 'fallidos'] += 1
+    etapa('comprobacion', sondear, len(a_sondear), repeticiones=1)
+
+    ruta_salida = os.path.join(directorio, f"salida_{entradas}.m3u")
+
+    def escribir():
+        for canal in canales:
+            canal.processed = False
+        numerados = [{'chno': chno, 'channel': canal} for chno, canal, _ in m3u.asignar_numeros_canal(canales)]
+        numerados.sort(key=lambda datos: datos['chno'])
+        m3u.escribir_m3u(ruta_salida, True, [], numerados)
+    etapa('asignar_y_escribir', escribir, entradas)
+
+    if args.completo:
+        lista_completa = m3u.leer_m3u(ruta_m3u)[:1 + 2 * args.max_sondeos]
+
+        def procesar():
+            m3u.procesar_m3u(ruta_m3u, lista_completa, False, args.timeout, epg_data, ruta_salida, 1, 'quality',
+                             {'max_workers': args.workers, 'probe_method': args.metodo, 'epg_index': epg_index,
+                              'interactive': False})
+        etapa('procesar_m3u', procesar, len(a_sondear), repeticiones=1)
+
+    return {
+        'entradas': entradas,
+        'canales_unicos': len(nombres_base),
+        'canales_epg': canales_epg,
+        'tvg_id_emparejados': emparejados,
+        'sondeo': dict(resultados_sondeo, total=len(a_sondear)),
+        'etapas': etapas
+    }
+
+
+def comparar(actual, ruta_anterior):
+    try:
+        with open(ruta_anterior, 'r', encoding='utf-8') as f:
+            anterior = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"{Colors.RED}No se pudo leer '{ruta_anterior}': {e}{Colors.RESET}")
+        return
+    previos = {resultado['entradas']: resultado['etapas'] for resultado in anterior.get('resultados', [])}
+    print(f"\n{Colors.BOLD}Comparación con {ruta_anterior}:{Colors.RESET}")
+    for resultado in actual['resultados']:
+        etapas_previas = previos.get(resultado['entradas'])
+        if not etapas_previas:
+            continue
+        print(f"  {Colors.BOLD}{resultado['entradas']} entradas{Colors.RESET}")
+        for nombre, etapa in resultado['etapas'].items():
+            if nombre not in etapas_previas or not etapas_previas[nombre]['segundos']:
+                continue
+            cambio = etapa['segundos'] / etapas_previas[nombre]['segundos'] - 1
+            color = Colors.GREEN if cambio <= -0.05 else Colors.RED if cambio >= 0.05 else Colors.RESET
+            print(f"    {nombre:<36} {etapas_previas[nombre]['segundos']:.4f} s -> {etapa['segundos']:.4f} s "
+                  f"{color}({cambio:+.1%}){Colors.RESET}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banco de pruebas sin conexión de m3u_processor con datos sintéticos.")
+    parser.add_argument('--tamanos', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help="Número de entradas de cada lista generada (ej. 1000 10000 200000)")
+    parser.add_argument('--duplicados', type=float, default=0.3,
+                        help="Proporción de entradas que son espejos de un canal ya generado")
+    parser.add_argument('--ruido', type=float, default=0.3,
+                        help="Proporción de nombres con ruido (calidad, prefijos, erratas...)")
+    parser.add_argument('--cobertura-epg', type=float, default=0.8,
+                        help="Proporción de canales de la lista presentes en la guía")
+    parser.add_argument('--canales-epg-extra', type=int, default=500, help="Canales de la guía que no aparecen en la lista")
+    parser.add_argument('--programas', type=int, default=5, help="Programas por canal en la guía")
+    parser.add_argument('--max-emparejamientos', type=int, default=2000, help="Nombres distintos que se emparejan con el EPG")
+    parser.add_argument('--max-sondeos', type=int, default=1000, help="Entradas que se comprueban contra el servidor local")
+    parser.add_argument('--timeout', type=float, default=2, help="Tiempo de espera de cada comprobación")
+    parser.add_argument('--workers', type=int, default=m3u.DEFAULT_MAX_WORKERS, help="Conexiones simultáneas")
+    parser.add_argument('--metodo', choices=m3u.PROBE_METHODS, default=m3u.DEFAULT_PROBE_METHOD, help="Método de comprobación")
+    parser.add_argument('--repeticiones', type=int, default=3,
+                        help="Repeticiones de las etapas sin red (se guarda la mediana)")
+    parser.add_argument('--completo', action='store_true', help="Medir también procesar_m3u de principio a fin")
+    parser.add_argument('--semilla', type=int, default=1, help="Semilla de los generadores")
+    parser.add_argument('--salida', default=None, help="Archivo JSON de resultados (por defecto benchmark_<fecha>.json)")
+    parser.add_argument('--comparar', help="Resultados JSON de una ejecución anterior con los que comparar")
+    parser.add_argument('--conservar', action='store_true', help="No borrar las listas y guías generadas")
+    args = parser.parse_args(argv)
+
+    fecha = datetime.now()
+    salida = args.salida or f"benchmark_{fecha.strftime('%Y%m%d_%H%M%S')}.json"
+    directorio = tempfile.mkdtemp(prefix='m3u_benchmark_')
+    servidor = ServidorPruebas().iniciar()
+    print(f"{Colors.BLUE}Servidor de pruebas en {servidor.url_base}, datos en {directorio}{Colors.RESET}")
+
+    resultados = []
+    try:
+        for entradas in args.tamanos:
+            resultados.append(ejecutar_tamano(entradas, servidor, directorio, args))
+    finally:
+        servidor.detener()
+        if args.conservar:
+            print(f"{Colors.YELLOW}Datos generados conservados en {directorio}{Colors.RESET}")
+        else:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+    informe = {
+        'version': BENCHMARK_VERSION,
+        'fecha': fecha.isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': {clave: valor for clave, valor in vars(args).items()
+                       if clave not in ('salida', 'comparar', 'conservar')},
+        'resultados': resultados
+    }
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(f"\n{Colors.GREEN}{Colors.BOLD}Resultados guardados en {salida}{Colors.RESET}")
+
+    if args.comparar:
+        comparar(informe, args.comparar)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
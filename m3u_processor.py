@@ -1,10 +1,43 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
 import sys
 import os
 import re
+import time
+import sqlite3
+import math
+import zlib
+import gzip
+from urllib.parse import urljoin, urlsplit, quote, unquote
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import queue
+import hashlib
+import json
+import csv
+import random
+import glob
+import argparse
+import fnmatch
+import contextlib
+import shutil
+import tempfile
+from collections import Counter, deque
+from itertools import chain
 from tqdm import tqdm
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
 from fuzzywuzzy import fuzz
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+# rapidfuzz (opcional) calcula en bloque y en varios núcleos las puntuaciones del emparejamiento EPG
+try:
+    import numpy as np
+    from rapidfuzz import fuzz as rf_fuzz, process as rf_process
+except ImportError:
+    rf_process = None
 
 # Referencia del desarrollador/usuario
 # GitHub: https://github.com/rodillo69
@@ -20,7 +53,192 @@ class Colors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+# Expresiones precompiladas para el parseo de #EXTINF y la normalización de nombres.
+# Los atributos admiten claves con guion (tvg-name, group-title) y comas dentro de las comillas.
+EXTINF_PATTERN = re.compile(r'(#EXTINF:-?\d+)((?:[^,"]|"[^"]*")*)(,.*)')
+EXTINF_LOOSE_PATTERN = re.compile(r'(#EXTINF:-?\d+)(.*?)(,.*)')
+EXTINF_ATTR_PATTERN = re.compile(r'([\w-]+)="([^"]*)"')
+NORMALIZE_TAGS_PATTERN = re.compile(r'\s*(hd|sd|fhd|uhd|720|1080|tv|plus\+)\s*')
+NORMALIZE_SYMBOLS_PATTERN = re.compile(r'[^a-z0-9\s]')
+NORMALIZE_SPACES_PATTERN = re.compile(r'\s+')
+# Versión de normalizar_nombre_canal: forma parte de la huella de la guía, así que al cambiar la normalización
+# se descartan los emparejamientos guardados con la anterior (caché EPG, manifiestos, memoria de emparejamientos)
+NORMALIZE_VERSION = 3
+
 EPG_GUIDE_URL = "https://raw.githubusercontent.com/davidmuma/EPG_dobleM/master/guiatv.xml"
+# Guías que se combinan, por orden de prioridad: si un canal aparece en varias, gana la primera.
+# Se pueden añadir guías regionales, de deportes, internacionales...
+EPG_GUIDE_URLS = [EPG_GUIDE_URL]
+# Tiempo máximo de espera por el conjunto de guías: la que no termine se toma de su copia local
+EPG_SOURCES_DEADLINE = 120
+EPG_FUZZY_THRESHOLD = 75
+# Emparejamiento en bloque con rapidfuzz: nombres de la lista por cada matriz de puntuaciones contra la guía
+# y núcleos que se usan (-1: todos)
+EPG_MATCH_BATCH_ROWS = 512
+EPG_MATCH_WORKERS = -1
+EPG_CHUNK_SIZE = 64 * 1024
+# Formatos de la guía EPG filtrada que se genera junto a la lista (solo los canales emparejados)
+EPG_FILTERED_FORMATS = ('xml', 'xml.gz')
+# Caché de la guía ya normalizada, en JSON. Se descarta si cambia su formato o la normalización de nombres
+EPG_CACHE_DIR = ".epg_cache"
+EPG_CACHE_VERSION = 3
+
+DEFAULT_MAX_WORKERS = 20
+HTTP_POOL_HOSTS = 50
+
+# Listas remotas (http/https): se descargan en un hilo aparte y sus líneas pasan al parseo según llegan,
+# así la comprobación empieza con las primeras entradas. Como mucho M3U_STREAM_BUFFER_LINES líneas
+# descargadas esperan en memoria a ser procesadas.
+M3U_DOWNLOAD_TIMEOUT = 30
+M3U_STREAM_BUFFER_LINES = 100000
+# Se lee en trozos pequeños: la lectura espera a completar cada trozo antes de entregar sus líneas
+M3U_STREAM_CHUNK_SIZE = 1024
+
+# Métodos de comprobación: 'head', 'range' (GET de los primeros bytes), 'get' (GET completo en streaming),
+# 'auto' (HEAD y, si el servidor no lo acepta, GET parcial) y 'throughput' (mide el tiempo hasta el primer
+# byte y la velocidad de descarga de una muestra del stream; en HLS, del primer segmento)
+PROBE_METHODS = ('auto', 'head', 'range', 'get', 'throughput')
+DEFAULT_PROBE_METHOD = 'auto'
+PROBE_RANGE_BYTES = 1024
+PROBE_THROUGHPUT_BYTES = 256 * 1024
+HLS_PLAYLIST_MAX_BYTES = 512 * 1024
+
+# Cortocircuito por servidor: tras HOST_BREAKER_THRESHOLD fallos de conexión seguidos (rechazo, DNS o timeout
+# al conectar; un timeout de lectura no cuenta), el resto de URLs del servidor se dan por fallidas sin esperar. Cada HOST_BREAKER_COOLDOWN segundos se deja pasar
+# una comprobación de prueba con HOST_BREAKER_TRIAL_TIMEOUT; si responde, el servidor vuelve a comprobarse.
+HOST_BREAKER_THRESHOLD = 5
+HOST_BREAKER_COOLDOWN = 30
+HOST_BREAKER_TRIAL_TIMEOUT = 2
+# Timeout adaptativo: con al menos ADAPTIVE_TIMEOUT_MIN_SAMPLES respuestas de un servidor, su timeout pasa a
+# ADAPTIVE_TIMEOUT_FACTOR veces el percentil 95 de su latencia (nunca menos de ADAPTIVE_TIMEOUT_MIN ni más
+# que el timeout configurado)
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 10
+ADAPTIVE_TIMEOUT_FACTOR = 3
+ADAPTIVE_TIMEOUT_MIN = 1.0
+ADAPTIVE_TIMEOUT_WINDOW = 100
+# Reparto de las comprobaciones entre servidores: las listas suelen traer seguidas cientos de URLs del mismo
+# panel, y tantas peticiones seguidas acaban en límites de peticiones o bloqueos temporales (falsos FALLOS).
+# Los servidores siempre se turnan; además cada uno puede tener un máximo de conexiones simultáneas y un
+# cubo de fichas (peticiones por segundo y ráfaga). Por defecto no hay límites (None): solo cuenta el número
+# de conexiones simultáneas configurado. HOST_RATE_LIMITS ajusta los límites por patrón de host (fnmatch, el
+# primero que coincide gana); None en un límite lo desactiva. Sin ráfaga, la ráfaga es un segundo de
+# peticiones. Se adelantan como mucho HOST_SCHEDULER_LOOKAHEAD canales de la lista para poder alternar servidores.
+HOST_MAX_CONCURRENT = None
+HOST_RATE = None
+HOST_BURST = None
+HOST_RATE_LIMITS = {
+    'localhost': {'max_concurrent': None, 'rate': None},
+    '127.0.0.1': {'max_concurrent': None, 'rate': None},
+    # 'panel.ejemplo.com': {'max_concurrent': 2, 'rate': 1},
+    # '*.cdn.ejemplo.net': {'max_concurrent': 10, 'rate': 50, 'burst': 100},
+}
+HOST_SCHEDULER_LOOKAHEAD = 5000
+
+# Caché persistente del estado de los streams (segundos de validez de cada resultado)
+HEALTH_CACHE_FILE = "m3u_health_cache.sqlite"
+HEALTH_CACHE_TTL_OK = 6 * 3600
+HEALTH_CACHE_TTL_FAIL = 3600
+HEALTH_CACHE_MAX_ENTRIES = 200000
+# Varios procesos (modo por lotes) comparten el archivo: los resultados se guardan en memoria y se escriben
+# de HEALTH_CACHE_FLUSH_ROWS en HEALTH_CACHE_FLUSH_ROWS en transacciones cortas, y quien encuentra la base
+# ocupada espera hasta HEALTH_CACHE_BUSY_TIMEOUT segundos
+HEALTH_CACHE_FLUSH_ROWS = 500
+HEALTH_CACHE_BUSY_TIMEOUT = 30
+
+# Memoria persistente de emparejamientos EPG aproximados: nombre normalizado -> tvg-id (o "sin coincidencia")
+# para una guía concreta. Con la misma guía, las ejecuciones siguientes no vuelven a puntuar esos nombres.
+EPG_MATCH_MEMO_FILE = "m3u_epg_matches.sqlite"
+EPG_MATCH_MEMO_MAX_ENTRIES = 100000
+EPG_MATCH_MEMO_VERSION = 1
+
+# Agrupación aproximada de duplicados: además de los nombres normalizados idénticos se unen variantes
+# ("Movistar LaLiga" / "M+ LaLiga 1080 (backup)"). Se descartan tokens de ruido, se aplican alias y los
+# candidatos salen de MinHash-LSH sobre trigramas; después se verifican con token_sort_ratio y solo se
+# unen si difieren en el orden o el espaciado de las palabras, no en una palabra distinta.
+DUPLICATE_FUZZY_THRESHOLD = 90
+DUPLICATE_NOISE_TOKENS = frozenset({
+    'backup', 'bk', 'alt', 'alternativo', 'respaldo', 'reserva', 'opcion', 'op', 'link', 'server',
+    'vip', 'es', 'esp', 'spain', 'multi', 'multiaudio', 'hevc', 'h265', 'h264', '4k', '50fps', '60fps', 'directo', 'live'
+})
+DUPLICATE_TOKEN_ALIASES = {'m': 'movistar', 'mplus': 'movistar', 'movistarplus': 'movistar'}
+MINHASH_BANDS = 16
+MINHASH_ROWS = 3
+MINHASH_PRIME = (1 << 61) - 1
+# Los cubos LSH más grandes no se comparan por parejas: solo cada nombre con sus vecinos en orden alfabético
+DUPLICATE_MAX_BUCKET = 50
+
+# Métricas de cada ejecución (JSON y archivo de texto para el textfile collector de Prometheus)
+METRICS_PREFIX = "m3u_processor"
+PROBE_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Servidores con histograma propio; el resto se agrupa en host="other" para no disparar la cardinalidad
+METRICS_MAX_HOSTS = 50
+
+# Modo incremental: manifiesto de la última ejecución junto al archivo de salida. Los resultados de las
+# entradas sin cambios se reutilizan durante INCREMENTAL_MAX_AGE segundos.
+MANIFEST_VERSION = 2
+INCREMENTAL_MAX_AGE = 24 * 3600
+
+# Diario de comprobaciones: cada resultado se añade según llega a <salida>.journal, de modo que una
+# ejecución interrumpida (Ctrl+C, caída, SSH cortado) se puede reanudar sin volver a sondear lo ya comprobado
+JOURNAL_VERSION = 1
+JOURNAL_MAX_AGE = 24 * 3600
+
+# Opciones por defecto del modo por lotes (línea de comandos / archivo de configuración JSON)
+BATCH_DEFAULT_OPTIONS = {
+    'inputs': [],
+    'output_dir': 'salida',
+    'processes': None,
+    'timeout': 5,
+    'start_channel_number': 1,
+    'duplicate_handling': 'all',
+    'max_workers': DEFAULT_MAX_WORKERS,
+    'probe_method': DEFAULT_PROBE_METHOD,
+    'use_health_cache': False,
+    'channel_order_file': None,
+    'lazy_probe': False,
+    'fuzzy_duplicates': False,
+    'incremental': False,
+    'resume': False,
+    'quiet': False,
+    'metrics': False,
+    'filtered_epg': None,
+    'serve': False,
+    'serve_host': '0.0.0.0',
+    'serve_port': 8080,
+    'refresh_interval': 3600,
+    'host_limits': None,
+    'host_breaker': True,
+    'epg_url': EPG_GUIDE_URLS
+}
+
+# Opciones de procesar_m3u además de las posicionales: objetos ya preparados por quien llama (caché de
+# comprobaciones, índice EPG, perfil de orden, métricas, guías completas, memoria de emparejamientos) y ajustes
+PROCESS_DEFAULT_OPTIONS = {
+    'max_workers': DEFAULT_MAX_WORKERS,
+    'probe_method': DEFAULT_PROBE_METHOD,
+    'health_cache': None,
+    'epg_index': None,
+    'channel_order': None,
+    'interactive': True,
+    'lazy_probe': False,
+    'incremental': False,
+    'quiet': False,
+    'run_metrics': None,
+    'fuzzy_duplicates': False,
+    'epg_guides': None,
+    'filtered_epg': None,
+    'resume': False,
+    'epg_memo': None,
+    'host_limits': None,
+    'host_breaker': True
+}
+
+# Modo servidor: tipos de contenido de lo que se sirve y nivel de compresión gzip de las respuestas
+SERVE_CONTENT_TYPES = {'.m3u': 'audio/x-mpegurl; charset=utf-8', '.m3u8': 'application/vnd.apple.mpegurl',
+                       '.xml': 'application/xml; charset=utf-8', '.gz': 'application/gzip',
+                       '.json': 'application/json; charset=utf-8'}
+SERVE_GZIP_LEVEL = 6
+SERVE_RETRY_AFTER = 30
 
 COMMON_SPANISH_CHANNELS_ORDER = {
     "la 1": 1,
@@ -114,12 +332,635 @@ COMMON_SPANISH_CHANNELS_ORDER = {
     "cyl8": 231,
 }
 
-def comprobar_conexion(url, timeout=5):
+def crear_sesion_http(max_workers=DEFAULT_MAX_WORKERS):
+    # Sesión compartida entre hilos: un pool de conexiones keep-alive por host
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=max(1, max_workers),
+        max_retries=0
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _sondear_url(cliente, metodo, url, timeout):
+    if metodo == 'head':
+        response = cliente.head(url, timeout=timeout, allow_redirects=True)
+        response.close()
+        return response.status_code
+
+    headers = {'Range': f'bytes=0-{PROBE_RANGE_BYTES - 1}'} if metodo == 'range' else None
+    with cliente.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        # Solo se consume el cuerpo si es el trozo pedido; así la conexión vuelve al pool.
+        # Si el servidor ignora el Range se cierra la conexión sin descargar el stream.
+        if response.status_code == 206:
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit() and int(content_length) <= PROBE_RANGE_BYTES:
+                response.content
+        return response.status_code
+
+def _descargar_muestra(cliente, url, timeout, limite_bytes):
+    inicio = time.monotonic()
+    ttfb = None
+    recibidos = 0
+    contenido = bytearray()
+    with cliente.get(url, stream=True, timeout=timeout) as response:
+        content_type = response.headers.get('Content-Type', '').lower()
+        es_hls = 'mpegurl' in content_type or response.url.lower().split('?', 1)[0].endswith('.m3u8')
+        if 200 <= response.status_code < 300:
+            for bloque in response.iter_content(chunk_size=16 * 1024):
+                if ttfb is None:
+                    ttfb = time.monotonic() - inicio
+                recibidos += len(bloque)
+                if es_hls:
+                    contenido.extend(bloque)
+                if recibidos >= limite_bytes or time.monotonic() - inicio > timeout:
+                    break
+        duracion = time.monotonic() - inicio
+        return {
+            'status': response.status_code,
+            'url': response.url,
+            'hls': es_hls,
+            'contenido': bytes(contenido),
+            'ttfb': ttfb,
+            'throughput': recibidos / duracion if recibidos and duracion > 0 else None
+        }
+
+def _primer_segmento_hls(cliente, url, contenido, timeout, profundidad=0):
+    lineas = [linea.strip() for linea in contenido.decode('utf-8', errors='ignore').splitlines() if linea.strip()]
+    uris = [linea for linea in lineas if not linea.startswith('#')]
+    if not uris:
+        return None
+    siguiente = urljoin(url, uris[0])
+    if any(linea.startswith('#EXT-X-STREAM-INF') for linea in lineas):
+        # Lista maestra: se baja la primera variante para llegar a sus segmentos
+        if profundidad >= 1:
+            return None
+        muestra = _descargar_muestra(cliente, siguiente, timeout, HLS_PLAYLIST_MAX_BYTES)
+        if not 200 <= muestra['status'] < 300:
+            return None
+        return _primer_segmento_hls(cliente, muestra['url'], muestra['contenido'], timeout, profundidad + 1)
+    return siguiente
+
+def _servidor_no_responde(error):
+    # Solo los fallos al conectar (rechazo, DNS, timeout de conexión) indican que el servidor no responde; un
+    # timeout de lectura, también el que requests envuelve en ConnectionError al leer el cuerpo, es un servidor lento
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.Timeout):
+        return False
+    causa = error.args[0] if error.args else None
+    return not isinstance(causa, ReadTimeoutError)
+
+def medir_stream(url, timeout=5, session=None, limite_bytes=PROBE_THROUGHPUT_BYTES):
+    # Además del estado, devuelve el tiempo hasta el primer byte (s) y la velocidad (bytes/s)
+    # descargando como mucho limite_bytes. En HLS la velocidad es la del primer segmento de vídeo.
+    cliente = session if session is not None else requests
+    resultado = {'ok': False, 'ttfb': None, 'throughput': None, 'error_red': False}
+    try:
+        muestra = _descargar_muestra(cliente, url, timeout, limite_bytes)
+        resultado['ok'] = 200 <= muestra['status'] < 300
+        resultado['ttfb'] = muestra['ttfb']
+        resultado['throughput'] = muestra['throughput']
+        if resultado['ok'] and muestra['hls']:
+            segmento = _primer_segmento_hls(cliente, muestra['url'], muestra['contenido'], timeout)
+            if segmento:
+                muestra_segmento = _descargar_muestra(cliente, segmento, timeout, limite_bytes)
+                resultado['ok'] = 200 <= muestra_segmento['status'] < 300
+                resultado['throughput'] = muestra_segmento['throughput']
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        resultado['ok'] = False
+        resultado['error_red'] = _servidor_no_responde(e)
+    except requests.exceptions.RequestException:
+        resultado['ok'] = False
+    return resultado
+
+def _comprobar_url(url, timeout, cliente, metodo):
+    # Devuelve (ok, error_red); error_red indica que el servidor no llegó a responder (conexión rechazada, DNS
+    # o tiempo agotado al conectar), a diferencia de un código HTTP de error o de una respuesta demasiado lenta
     try:
-        response = requests.get(url, stream=True, timeout=timeout)
-        return 200 <= response.status_code < 300
+        if metodo == 'auto':
+            if 200 <= _sondear_url(cliente, 'head', url, timeout) < 300:
+                return True, False
+            # Muchos paneles IPTV no admiten HEAD (405/403): se reintenta con un GET parcial
+            return 200 <= _sondear_url(cliente, 'range', url, timeout) < 300, False
+        return 200 <= _sondear_url(cliente, metodo, url, timeout) < 300, False
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        return False, _servidor_no_responde(e)
     except requests.exceptions.RequestException:
-        return False
+        return False, False
+
+def comprobar_conexion(url, timeout=5, session=None, metodo='get'):
+    cliente = session if session is not None else requests
+    if metodo == 'throughput':
+        return medir_stream(url, timeout, session)['ok']
+    return _comprobar_url(url, timeout, cliente, metodo)[0]
+
+def _comprobar_canal(url, timeout, session, metodo, breaker=None):
+    host = urlsplit(url).netloc.lower()
+    if breaker is not None:
+        timeout = breaker.timeout_for(host, timeout, metodo)
+        if timeout is None:
+            return {'ok': False, 'ttfb': None, 'throughput': None, 'latencia': 0.0, 'cortocircuito': True}
+    inicio = time.monotonic()
+    if metodo == 'throughput':
+        resultado = medir_stream(url, timeout, session)
+    else:
+        cliente = session if session is not None else requests
+        ok, error_red = _comprobar_url(url, timeout, cliente, metodo)
+        resultado = {'ok': ok, 'ttfb': None, 'throughput': None, 'error_red': error_red}
+    resultado['latencia'] = time.monotonic() - inicio
+    if breaker is not None:
+        breaker.record(host, resultado['ok'], resultado['error_red'], resultado['latencia'], metodo)
+    return resultado
+
+def _adelantar_canales(canales, scheduler, fin):
+    # Pasa canales del generador al HostScheduler hasta tener HOST_SCHEDULER_LOOKAHEAD en cola o hasta que
+    # el generador no tenga más (por ahora, si entrega None)
+    while scheduler.queued < HOST_SCHEDULER_LOOKAHEAD:
+        canal = next(canales, fin)
+        if canal is fin or canal is None:
+            return
+        scheduler.add(canal)
+
+def _siguientes_canales(scheduler, libres):
+    # Canales para los hilos libres, en el orden del HostScheduler
+    siguientes = []
+    while len(siguientes) < libres:
+        canal = scheduler.next()
+        if canal is None:
+            break
+        siguientes.append(canal)
+    return siguientes
+
+def _esperar_turno(scheduler):
+    # Sin comprobaciones en curso, todo lo que queda espera a que su servidor recupere fichas. No debería
+    # pasar (los límites se validan), pero si ningún servidor puede avanzar ni va a recuperar fichas, se
+    # devuelve el siguiente canal para comprobarlo igualmente en vez de perderlo.
+    espera = scheduler.wait_time()
+    if espera is None:
+        return scheduler.next(force=True)
+    time.sleep(espera)
+    return None
+
+def comprobar_canales_concurrente(canales, timeout=5, max_workers=DEFAULT_MAX_WORKERS, probe_method=DEFAULT_PROBE_METHOD,
+                                  session=None, breaker=None, scheduler=None):
+    # Devuelve (canal, resultado) a medida que terminan las comprobaciones. 'canales' puede ser un
+    # generador: se consume sobre la marcha, adelantando como mucho HOST_SCHEDULER_LOOKAHEAD canales.
+    # Si el generador entrega None es que de momento no tiene más canales: se espera a algún resultado
+    # y se le vuelve a pedir (solo debe hacerlo mientras haya comprobaciones en curso).
+    # Cada hilo libre recibe el siguiente canal del HostScheduler, que alterna servidores y respeta sus límites.
+    sesion_propia = session is None
+    if sesion_propia:
+        session = crear_sesion_http(max_workers)
+    scheduler = scheduler if scheduler is not None else HostScheduler()
+    max_workers = max(1, max_workers)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pendientes = {}
+    canales = iter(canales)
+    fin = object()
+
+    def enviar(canal):
+        pendientes[executor.submit(_comprobar_canal, canal.url, timeout, session, probe_method, breaker)] = canal
+
+    try:
+        while True:
+            # Un generador ya agotado devuelve 'fin' al momento, así que se le puede seguir pidiendo
+            _adelantar_canales(canales, scheduler, fin)
+            for canal in _siguientes_canales(scheduler, max_workers - len(pendientes)):
+                enviar(canal)
+            if not pendientes:
+                if not scheduler.queued:
+                    break
+                canal = _esperar_turno(scheduler)
+                if canal is not None:
+                    enviar(canal)
+                continue
+            # Con hilos libres, también se despierta cuando algún servidor recupera una ficha
+            espera = scheduler.wait_time() if len(pendientes) < max_workers else None
+            terminados, _ = wait(pendientes, timeout=espera, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                canal = pendientes.pop(futuro)
+                scheduler.done(canal)
+                yield canal, futuro.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if sesion_propia:
+            session.close()
+
+class HostScheduler:
+    # Cola de canales por servidor con turno rotatorio. Solo lo usa el hilo que reparte el trabajo en
+    # comprobar_canales_concurrente, así que no necesita bloqueos.
+    def __init__(self, limits=None):
+        # Los patrones indicados tienen prioridad sobre los de HOST_RATE_LIMITS
+        self.limits = dict(limits or {})
+        for patron, valores in HOST_RATE_LIMITS.items():
+            self.limits.setdefault(patron, valores)
+        self.queues = {}
+        self.turn = deque()
+        self.in_flight = Counter()
+        self.buckets = {}
+        self.queued = 0
+        self._host_limits = {}
+
+    @staticmethod
+    def _host(canal):
+        return urlsplit(canal.url).netloc.lower()
+
+    def limits_for(self, host):
+        limites = self._host_limits.get(host)
+        if limites is None:
+            nombre = urlsplit('//' + host).hostname or host
+            limites = {'max_concurrent': HOST_MAX_CONCURRENT, 'rate': HOST_RATE, 'burst': HOST_BURST}
+            for patron, valores in self.limits.items():
+                if fnmatch.fnmatchcase(nombre, patron.lower()):
+                    limites.update(valores)
+                    # Con un ritmo propio y sin ráfaga propia, la ráfaga es un segundo de peticiones
+                    if 'rate' in valores and 'burst' not in valores and valores['rate']:
+                        limites['burst'] = max(1, valores['rate'])
+                    break
+            # Los límites se pueden editar a mano en HOST_RATE_LIMITS: lo que no sea un número positivo
+            # equivale a no limitar, y la ráfaga nunca baja de una ficha
+            for clave in ('max_concurrent', 'rate', 'burst'):
+                valor = limites.get(clave)
+                if isinstance(valor, bool) or not isinstance(valor, (int, float)) or not math.isfinite(valor) or valor <= 0:
+                    limites[clave] = None
+            if limites['max_concurrent']:
+                limites['max_concurrent'] = max(1, int(limites['max_concurrent']))
+            if limites['rate']:
+                limites['burst'] = max(1, limites['burst'] or limites['rate'])
+            self._host_limits[host] = limites
+        return limites
+
+    def add(self, canal):
+        host = self._host(canal)
+        cola = self.queues.setdefault(host, deque())
+        if not cola:
+            self.turn.append(host)
+        cola.append(canal)
+        self.queued += 1
+
+    def _tokens(self, host, ahora):
+        limites = self.limits_for(host)
+        fichas, ultima = self.buckets.get(host, (limites['burst'], ahora))
+        fichas = min(limites['burst'], fichas + (ahora - ultima) * limites['rate'])
+        self.buckets[host] = (fichas, ahora)
+        return fichas
+
+    def next(self, force=False):
+        # Siguiente canal del primer servidor en su turno que no esté en su límite de conexiones ni de fichas.
+        # Con force se ignoran los límites.
+        ahora = time.monotonic()
+        for _ in range(len(self.turn)):
+            host = self.turn[0]
+            self.turn.rotate(-1)
+            limites = self.limits_for(host)
+            if not force and limites['max_concurrent'] and self.in_flight[host] >= limites['max_concurrent']:
+                continue
+            if limites['rate']:
+                fichas = self._tokens(host, ahora)
+                if fichas < 1 and not force:
+                    continue
+                self.buckets[host] = (max(0.0, fichas - 1), ahora)
+            cola = self.queues[host]
+            canal = cola.popleft()
+            if not cola:
+                # Tras rotar, el servidor ha quedado al final del turno
+                self.turn.pop()
+            self.queued -= 1
+            self.in_flight[host] += 1
+            return canal
+        return None
+
+    def done(self, canal):
+        self.in_flight[self._host(canal)] -= 1
+
+    def wait_time(self):
+        # Segundos hasta que algún servidor que solo está esperando fichas (tiene canales en cola y
+        # conexiones libres) recupere una; None si no hay ninguno
+        ahora = time.monotonic()
+        espera = None
+        for host in self.turn:
+            limites = self.limits_for(host)
+            if not limites['rate'] or (limites['max_concurrent'] and self.in_flight[host] >= limites['max_concurrent']):
+                continue
+            falta = max(0.0, (1 - self._tokens(host, ahora)) / limites['rate'])
+            espera = falta if espera is None else min(espera, falta)
+        return espera
+
+class HostCircuitBreaker:
+    # Estado por servidor compartido por los hilos de comprobación
+    def __init__(self, threshold=HOST_BREAKER_THRESHOLD, cooldown=HOST_BREAKER_COOLDOWN,
+                 trial_timeout=HOST_BREAKER_TRIAL_TIMEOUT):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.trial_timeout = trial_timeout
+        self.lock = threading.Lock()
+        self.consecutive_failures = Counter()
+        self.opened_at = {}
+        self.trial_in_flight = set()
+        self.latencies = {}
+        self.short_circuited = Counter()
+
+    def timeout_for(self, host, timeout, method=None):
+        # Timeout para la siguiente comprobación del servidor, o None si se da por fallida sin sondear. Las
+        # latencias se guardan por método: un HEAD rápido no debe acortar el timeout de una medición de velocidad
+        with self.lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is not None:
+                if host in self.trial_in_flight or time.monotonic() - opened_at < self.cooldown:
+                    self.short_circuited[host] += 1
+                    return None
+                self.trial_in_flight.add(host)
+                return min(timeout, self.trial_timeout)
+
+            muestras = self.latencies.get((host, method))
+            if muestras is None or len(muestras) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+                return timeout
+            ordenadas = sorted(muestras)
+            p95 = ordenadas[int(0.95 * (len(ordenadas) - 1))]
+            return min(timeout, max(ADAPTIVE_TIMEOUT_MIN, p95 * ADAPTIVE_TIMEOUT_FACTOR))
+
+    def record(self, host, ok, network_error, latency, method=None):
+        with self.lock:
+            self.trial_in_flight.discard(host)
+            if not network_error:
+                # El servidor ha respondido (aunque sea con un error HTTP): está vivo
+                self.consecutive_failures[host] = 0
+                self.opened_at.pop(host, None)
+                self.latencies.setdefault((host, method), deque(maxlen=ADAPTIVE_TIMEOUT_WINDOW)).append(latency)
+                return
+            self.consecutive_failures[host] += 1
+            if host in self.opened_at or (self.threshold and self.consecutive_failures[host] >= self.threshold):
+                self.opened_at[host] = time.monotonic()
+
+    def tripped_hosts(self):
+        with self.lock:
+            return dict(self.short_circuited)
+
+class StreamHealthCache:
+    def __init__(self, db_file=HEALTH_CACHE_FILE, ttl_ok=HEALTH_CACHE_TTL_OK, ttl_fail=HEALTH_CACHE_TTL_FAIL,
+                 max_entries=HEALTH_CACHE_MAX_ENTRIES):
+        self.ttl_ok = ttl_ok
+        self.ttl_fail = ttl_fail
+        self.max_entries = max_entries
+        self._pending_writes = {}
+        self.conn = sqlite3.connect(db_file, timeout=HEALTH_CACHE_BUSY_TIMEOUT)
+        # En modo WAL las lecturas de un proceso no esperan a las escrituras de otro
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS stream_health ("
+            "url TEXT PRIMARY KEY, ok INTEGER NOT NULL, latency REAL, checked_at REAL NOT NULL, ttfb REAL, throughput REAL)"
+        )
+        columnas = {fila[1] for fila in self.conn.execute("PRAGMA table_info(stream_health)")}
+        for columna in ('ttfb', 'throughput'):
+            if columna not in columnas:
+                self.conn.execute(f"ALTER TABLE stream_health ADD COLUMN {columna} REAL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_stream_health_checked_at ON stream_health (checked_at)")
+        self.conn.commit()
+
+    def get(self, url):
+        row = self._pending_writes.get(url)
+        if row is None:
+            row = self.conn.execute(
+                "SELECT ok, latency, checked_at, ttfb, throughput FROM stream_health WHERE url = ?", (url,)
+            ).fetchone()
+        if row is not None:
+            ok, latency, checked_at = bool(row[0]), row[1], row[2]
+            ttl = self.ttl_ok if ok else self.ttl_fail
+            if time.time() - checked_at < ttl:
+                return {'ok': ok, 'latencia': latency, 'ttfb': row[3], 'throughput': row[4], 'cache': True}
+        return None
+
+    def put(self, url, ok, latency, ttfb=None, throughput=None):
+        self._pending_writes[url] = (int(ok), latency, time.time(), ttfb, throughput)
+        if len(self._pending_writes) >= HEALTH_CACHE_FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        # La transacción dura lo que tarda en escribirse el lote: el resto de procesos no esperan a toda la comprobación
+        if not self._pending_writes:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO stream_health (url, ok, latency, checked_at, ttfb, throughput) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                ((url,) + fila for url, fila in self._pending_writes.items())
+            )
+        self._pending_writes = {}
+
+    def evict(self):
+        self.flush()
+        # Borra lo caducado y, si aún se supera el límite, las entradas comprobadas hace más tiempo
+        self.conn.execute("DELETE FROM stream_health WHERE checked_at < ?", (time.time() - max(self.ttl_ok, self.ttl_fail),))
+        total = self.conn.execute("SELECT COUNT(*) FROM stream_health").fetchone()[0]
+        if total > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM stream_health WHERE url IN (SELECT url FROM stream_health ORDER BY checked_at LIMIT ?)",
+                (total - self.max_entries,)
+            )
+        self.conn.commit()
+
+    def close(self):
+        try:
+            self.evict()
+        except sqlite3.Error as e:
+            print(f"{Colors.YELLOW}No se pudo guardar la caché de comprobaciones: {e}{Colors.RESET}")
+        finally:
+            self.conn.close()
+
+class EpgMatchMemo:
+    # La huella identifica la guía (nombres y tvg-id) y el umbral de emparejamiento: si la guía cambia,
+    # nada de lo guardado con la huella anterior se reutiliza. Las entradas de la huella en uso se cargan
+    # al abrir y se guardan de una vez al cerrar; el tamaño se limita borrando las usadas hace más tiempo.
+    def __init__(self, huella, db_file=EPG_MATCH_MEMO_FILE, max_entries=EPG_MATCH_MEMO_MAX_ENTRIES):
+        self.huella = huella
+        self.max_entries = max_entries
+        self.hits = 0
+        self._usadas = set()
+        self._nuevas = {}
+        self.conn = sqlite3.connect(db_file, timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS epg_match ("
+            "fingerprint TEXT NOT NULL, name TEXT NOT NULL, epg_id TEXT, used_at REAL NOT NULL, "
+            "PRIMARY KEY (fingerprint, name))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_epg_match_used_at ON epg_match (used_at)")
+        self.conn.commit()
+        self.entries = dict(self.conn.execute("SELECT name, epg_id FROM epg_match WHERE fingerprint = ?", (huella,)))
+
+    @staticmethod
+    def fingerprint(epg_data):
+        huella = huella_epg(epg_data)
+        return f"{EPG_MATCH_MEMO_VERSION}:{EPG_FUZZY_THRESHOLD}:{huella}" if huella else None
+
+    def __contains__(self, normalized_name):
+        return normalized_name in self.entries
+
+    def get(self, normalized_name):
+        self.hits += 1
+        self._usadas.add(normalized_name)
+        return self.entries[normalized_name]
+
+    def put(self, normalized_name, epg_id):
+        self.entries[normalized_name] = epg_id
+        self._nuevas[normalized_name] = epg_id
+
+    def close(self):
+        ahora = time.time()
+        try:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO epg_match (fingerprint, name, epg_id, used_at) VALUES (?, ?, ?, ?)",
+                ((self.huella, nombre, epg_id, ahora) for nombre, epg_id in self._nuevas.items())
+            )
+            self.conn.executemany(
+                "UPDATE epg_match SET used_at = ? WHERE fingerprint = ? AND name = ?",
+                ((ahora, self.huella, nombre) for nombre in self._usadas)
+            )
+            # Lo emparejado con otra versión de la guía ya no sirve
+            self.conn.execute("DELETE FROM epg_match WHERE fingerprint != ?", (self.huella,))
+            total = self.conn.execute("SELECT COUNT(*) FROM epg_match").fetchone()[0]
+            if total > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM epg_match WHERE rowid IN (SELECT rowid FROM epg_match ORDER BY used_at LIMIT ?)",
+                    (total - self.max_entries,)
+                )
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"{Colors.YELLOW}No se pudo guardar la memoria de emparejamientos EPG: {e}{Colors.RESET}")
+        finally:
+            self.conn.close()
+
+def abrir_memo_epg(epg_data, huella=None):
+    # La memoria es una optimización: si no se puede abrir, se empareja como siempre
+    huella = huella or EpgMatchMemo.fingerprint(epg_data)
+    if not huella:
+        return None
+    try:
+        return EpgMatchMemo(huella)
+    except sqlite3.Error as e:
+        print(f"{Colors.YELLOW}No se pudo abrir la memoria de emparejamientos EPG: {e}{Colors.RESET}")
+        return None
+
+def _etiquetas_prometheus(etiquetas):
+    partes = []
+    for clave, valor in etiquetas.items():
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{clave}="{valor}"')
+    return '{' + ','.join(partes) + '}' if partes else ''
+
+class RunMetrics:
+    # Tiempos por etapa, histograma de latencias por servidor, contadores de emparejamiento EPG y de cachés
+    def __init__(self, playlist=None):
+        self.playlist = playlist
+        self.started_at = time.time()
+        self.stages = {}
+        self.counters = Counter()
+        self.timers = Counter()
+        self.probe_histograms = {}
+        self.probe_results = Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - inicio)
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+
+    def observe_probe(self, host, latency, ok):
+        histograma = self.probe_histograms.get(host)
+        if histograma is None:
+            histograma = self.probe_histograms[host] = {'buckets': [0] * len(PROBE_LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+        for posicion, limite in enumerate(PROBE_LATENCY_BUCKETS):
+            if latency <= limite:
+                histograma['buckets'][posicion] += 1
+                break
+        histograma['sum'] += latency
+        histograma['count'] += 1
+        self.probe_results[(host, 'ok' if ok else 'fail')] += 1
+
+    def _hosts_agrupados(self):
+        # Histogramas acumulados (cada bucket incluye los anteriores) de los servidores con más comprobaciones
+        principales = sorted(self.probe_histograms, key=lambda host: -self.probe_histograms[host]['count'])[:METRICS_MAX_HOSTS]
+        agrupados = {}
+        for host, histograma in self.probe_histograms.items():
+            destino = host if host in principales else 'other'
+            actual = agrupados.setdefault(destino, {'buckets': [0] * len(PROBE_LATENCY_BUCKETS), 'sum': 0.0, 'count': 0,
+                                                    'ok': 0, 'fail': 0})
+            actual['buckets'] = [a + b for a, b in zip(actual['buckets'], histograma['buckets'])]
+            actual['sum'] += histograma['sum']
+            actual['count'] += histograma['count']
+            actual['ok'] += self.probe_results[(host, 'ok')]
+            actual['fail'] += self.probe_results[(host, 'fail')]
+        for actual in agrupados.values():
+            acumulado = 0
+            for posicion, cantidad in enumerate(actual['buckets']):
+                acumulado += cantidad
+                actual['buckets'][posicion] = acumulado
+        return agrupados
+
+    def to_dict(self):
+        return {
+            'playlist': self.playlist,
+            'started_at': self.started_at,
+            'stages_seconds': dict(self.stages),
+            'counters': dict(self.counters),
+            'timers_seconds': dict(self.timers),
+            'probe_latency_buckets': list(PROBE_LATENCY_BUCKETS),
+            'probe_latency_by_host': self._hosts_agrupados()
+        }
+
+    def write_json(self, ruta):
+        with escritura_atomica(ruta) as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def prometheus_text(self):
+        base = {'playlist': self.playlist} if self.playlist else {}
+        lineas = []
+
+        def metrica(nombre, tipo, ayuda, muestras):
+            lineas.append(f"# HELP {METRICS_PREFIX}_{nombre} {ayuda}")
+            lineas.append(f"# TYPE {METRICS_PREFIX}_{nombre} {tipo}")
+            for sufijo, etiquetas, valor in muestras:
+                lineas.append(f"{METRICS_PREFIX}_{nombre}{sufijo}{_etiquetas_prometheus({**base, **etiquetas})} {valor}")
+
+        metrica('stage_seconds', 'gauge', 'Wall time of each processing stage.',
+                [('', {'stage': nombre}, f"{segundos:.6f}") for nombre, segundos in sorted(self.stages.items())])
+        metrica('events_total', 'counter', 'Event counters (EPG matches, cache lookups, probes...).',
+                [('', {'event': nombre}, cantidad) for nombre, cantidad in sorted(self.counters.items())])
+        metrica('time_seconds_total', 'counter', 'Accumulated time spent in instrumented operations.',
+                [('', {'operation': nombre}, f"{segundos:.6f}") for nombre, segundos in sorted(self.timers.items())])
+
+        muestras_histograma = []
+        muestras_resultado = []
+        for host, datos in sorted(self._hosts_agrupados().items()):
+            for limite, acumulado in zip(PROBE_LATENCY_BUCKETS, datos['buckets']):
+                muestras_histograma.append(('_bucket', {'host': host, 'le': limite}, acumulado))
+            muestras_histograma.append(('_bucket', {'host': host, 'le': '+Inf'}, datos['count']))
+            muestras_histograma.append(('_sum', {'host': host}, f"{datos['sum']:.6f}"))
+            muestras_histograma.append(('_count', {'host': host}, datos['count']))
+            muestras_resultado.append(('', {'host': host, 'result': 'ok'}, datos['ok']))
+            muestras_resultado.append(('', {'host': host, 'result': 'fail'}, datos['fail']))
+        metrica('probe_latency_seconds', 'histogram', 'Latency of stream probes per host.', muestras_histograma)
+        metrica('probes_total', 'counter', 'Stream probes per host and result.', muestras_resultado)
+        metrica('last_run_timestamp_seconds', 'gauge', 'Unix time when the run started.', [('', {}, f"{self.started_at:.0f}")])
+        return "\n".join(lineas) + "\n"
+
+    def write_prometheus(self, ruta):
+        # El textfile collector puede leer el archivo en cualquier momento: se escribe aparte y se renombra
+        with escritura_atomica(ruta) as f:
+            f.write(self.prometheus_text())
 
 def leer_m3u(archivo_m3u):
     lineas = []
@@ -131,75 +972,688 @@ def leer_m3u(archivo_m3u):
         sys.exit(1)
     return lineas
 
+def iterar_m3u(archivo_m3u):
+    # Igual que leer_m3u pero sin cargar el archivo en memoria: devuelve un iterador de líneas.
+    # También admite la URL de una lista remota, que se va leyendo mientras se descarga.
+    if es_lista_remota(archivo_m3u):
+        return _iterar_m3u_remota(archivo_m3u)
+    try:
+        f = open(archivo_m3u, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        print(f"{Colors.RED}{Colors.BOLD}Error:{Colors.RESET} El archivo '{archivo_m3u}' no se encontró.")
+        sys.exit(1)
+
+    def _lineas():
+        with f:
+            yield from f
+    return _lineas()
+
+def es_lista_remota(origen):
+    return urlsplit(origen).scheme.lower() in ('http', 'https')
+
+def nombre_lista(origen):
+    # Nombre de archivo para una lista: el de la ruta local o, en una URL, el último tramo de su ruta
+    # (ej. 'http://proveedor/get.php?type=m3u' -> 'get.m3u')
+    if not es_lista_remota(origen):
+        return os.path.basename(origen)
+    nombre = re.sub(r'[^\w.-]', '_', os.path.basename(unquote(urlsplit(origen).path)))
+    base, extension = os.path.splitext(nombre)
+    if extension.lower() not in ('.m3u', '.m3u8'):
+        nombre = (base or urlsplit(origen).hostname or 'lista') + '.m3u'
+    return nombre
+
+def _lineas_de_trozos(trozos):
+    # Parte en líneas los bytes de la descarga igual que open() con saltos universales (\n, \r\n o \r).
+    # Un trozo puede acabar entre el \r y el \n de un salto: el resto se guarda para el siguiente trozo,
+    # si no aparecería una línea vacía de más
+    resto = b''
+    for trozo in trozos:
+        if not trozo:
+            continue
+        partes = (resto + trozo).splitlines(keepends=True)
+        resto = partes.pop() if not partes[-1].endswith(b'\n') else b''
+        for parte in partes:
+            yield parte.rstrip(b'\r\n').decode('utf-8', errors='replace') + "\n"
+    if resto:
+        yield resto.rstrip(b'\r\n').decode('utf-8', errors='replace') + "\n"
+
+def _iterar_m3u_remota(url, timeout=M3U_DOWNLOAD_TIMEOUT):
+    try:
+        respuesta = requests.get(url, timeout=timeout, stream=True)
+        respuesta.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"{Colors.RED}{Colors.BOLD}Error:{Colors.RESET} No se pudo descargar la lista '{url}': {e}")
+        sys.exit(1)
+
+    lineas = queue.Queue(maxsize=M3U_STREAM_BUFFER_LINES)
+    detener = threading.Event()
+    fin = object()
+
+    def entregar(elemento):
+        # Si quien lee deja de hacerlo (cancelación), el hilo no se queda bloqueado en la cola
+        while not detener.is_set():
+            try:
+                lineas.put(elemento, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def descargar():
+        try:
+            with respuesta:
+                for linea in _lineas_de_trozos(respuesta.iter_content(chunk_size=M3U_STREAM_CHUNK_SIZE)):
+                    if not entregar(linea):
+                        return
+            entregar(fin)
+        except Exception as e:
+            # Cualquier fallo llega a quien lee: si no, se quedaría esperando líneas que no van a llegar
+            entregar(e)
+
+    threading.Thread(target=descargar, daemon=True).start()
+
+    def _lineas():
+        try:
+            while True:
+                linea = lineas.get()
+                if linea is fin:
+                    return
+                if isinstance(linea, Exception):
+                    # Una lista cortada dejaría fuera canales sin avisar: se trata como un error de lectura
+                    print(f"{Colors.RED}{Colors.BOLD}Error:{Colors.RESET} La descarga de la lista '{url}' se "
+                          f"interrumpió: {linea}")
+                    sys.exit(1)
+                yield linea
+        finally:
+            detener.set()
+    return _lineas()
+
+def contar_canales_m3u(lineas):
+    total = 0
+    extinf_pendiente = False
+    for linea in lineas:
+        linea_actual = linea.strip()
+        if extinf_pendiente and linea_actual.startswith("http"):
+            total += 1
+            extinf_pendiente = False
+        else:
+            extinf_pendiente = linea_actual.startswith("#EXTINF:")
+    return total
+
+def parsear_m3u(lineas):
+    # Genera ('canal', Channel) por cada #EXTINF seguido de una URL, ('cabecera', linea) por #EXTM3U
+    # y ('linea', linea) para el resto de líneas, en el orden del archivo
+    linea_extinf = None
+    for linea in lineas:
+        linea_actual = linea.strip()
+
+        if linea_extinf is not None:
+            if linea_actual.startswith("http"):
+                yield 'canal', Channel(linea_extinf, linea_actual)
+                linea_extinf = None
+                continue
+            yield 'linea', linea_extinf
+            linea_extinf = None
+
+        if linea_actual.startswith("#EXTINF:"):
+            linea_extinf = linea
+        elif linea_actual.startswith("#EXTM3U"):
+            yield 'cabecera', linea
+        else:
+            yield 'linea', linea
+
+    if linea_extinf is not None:
+        yield 'linea', linea_extinf
+
+@contextlib.contextmanager
+def escritura_atomica(ruta, modo='w', encoding='utf-8'):
+    # Se escribe en un temporal junto al destino y se renombra al terminar: si el proceso se corta, el
+    # archivo anterior sigue intacto y nunca queda uno a medio escribir
+    ruta_temporal = ruta + '.tmp'
+    try:
+        with open(ruta_temporal, modo, encoding=None if 'b' in modo else encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(ruta):
+            shutil.copymode(ruta, ruta_temporal)
+        os.replace(ruta_temporal, ruta)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(ruta_temporal)
+        raise
+
+def escribir_m3u(archivo_salida, incluir_cabecera, non_channel_lines, canales_numerados):
+    with escritura_atomica(archivo_salida) as f:
+        if incluir_cabecera:
+            f.write("#EXTM3U\n")
+        f.writelines(non_channel_lines)
+        for channel_info in canales_numerados:
+            channel_data = channel_info['channel']
+            f.write(channel_data.extinf_line(nuevo_tvg_id=channel_data.epg_id, nuevo_tvg_chno=channel_info['chno']))
+            f.write(channel_data.url_line())
+
 def normalizar_nombre_canal(nombre):
     nombre = nombre.lower()
-    nombre = re.sub(r'\s*(hd|sd|fhd|uhd|720|1080|tv|plus\+)\s*', '', nombre)
-    nombre = re.sub(r'[^a-z0-9\s]', '', nombre)
-    nombre = re.sub(r'\s+', ' ', nombre).strip()
+    nombre = NORMALIZE_TAGS_PATTERN.sub('', nombre)
+    nombre = NORMALIZE_SYMBOLS_PATTERN.sub('', nombre)
+    nombre = NORMALIZE_SPACES_PATTERN.sub(' ', nombre).strip()
     return nombre
 
-def descargar_y_parsear_epg(url_epg, timeout=10):
+def _agregar_canal_epg(channel_elem, epg_data):
+    channel_id = channel_elem.get('id')
+    if channel_id:
+        normalized_channel_id = normalizar_nombre_canal(channel_id)
+        if normalized_channel_id not in epg_data:
+            epg_data[normalized_channel_id] = channel_id
+
+        for display_name_elem in channel_elem.findall('display-name'):
+            display_name = display_name_elem.text
+            if display_name:
+                normalized_display_name = normalizar_nombre_canal(display_name)
+                if normalized_display_name not in epg_data:
+                    epg_data[normalized_display_name] = channel_id
+
+def _elementos_epg(bloques, solo_canales=False):
+    # Recorre una guía XMLTV (.xml o .xml.gz) bloque a bloque y devuelve (raíz, elemento) por cada elemento
+    # de primer nivel ya completo. Se libera al continuar, así que la memoria no depende del tamaño de la
+    # guía. En XMLTV los <channel> van antes que los <programme>: con solo_canales se para en el primer programa.
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    descompresor = None
+    primer_bloque = True
+    root = None
+    profundidad = 0
+
+    # None marca el final de la entrada: se vacía el descompresor y se cierra el parser
+    for bloque in chain(bloques, (None,)):
+        if bloque is None:
+            if descompresor is not None:
+                parser.feed(descompresor.flush())
+            parser.close()
+        else:
+            if primer_bloque:
+                # Guías .xml.gz servidas sin Content-Encoding: se descomprimen al vuelo
+                if bloque[:2] == b'\x1f\x8b':
+                    descompresor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                primer_bloque = False
+            if descompresor is not None:
+                bloque = descompresor.decompress(bloque)
+            parser.feed(bloque)
+
+        for evento, elem in parser.read_events():
+            if evento == 'start':
+                profundidad += 1
+                if root is None:
+                    root = elem
+                elif solo_canales and profundidad == 2 and elem.tag == 'programme':
+                    return
+            else:
+                profundidad -= 1
+                if profundidad == 1:
+                    yield root, elem
+                    root.clear()
+
+def _parsear_epg_respuesta(response, solo_canales=True):
+    # Se parsea mientras se descarga: con solo_canales la descarga se corta en el primer programa
     epg_data = {}
+    for _, elem in _elementos_epg(response.iter_content(chunk_size=EPG_CHUNK_SIZE), solo_canales):
+        if elem.tag == 'channel':
+            _agregar_canal_epg(elem, epg_data)
+    return epg_data
+
+def descargar_y_parsear_epg(url_epg, timeout=10, solo_canales=True):
     print(f"\n{Colors.YELLOW}Descargando y parseando la guía EPG desde: {Colors.BOLD}{url_epg}{Colors.RESET}")
     try:
-        response = requests.get(url_epg, timeout=timeout)
-        response.raise_for_status()
-        root = ET.fromstring(response.content)
-
-        for channel_elem in root.findall('channel'):
-            channel_id = channel_elem.get('id')
-            if channel_id:
-                normalized_channel_id = normalizar_nombre_canal(channel_id)
-                if normalized_channel_id not in epg_data:
-                    epg_data[normalized_channel_id] = channel_id
-                
-                for display_name_elem in channel_elem.findall('display-name'):
-                    display_name = display_name_elem.text
-                    if display_name:
-                        normalized_display_name = normalizar_nombre_canal(display_name)
-                        if normalized_display_name not in epg_data:
-                            epg_data[normalized_display_name] = channel_id
-        
+        with requests.get(url_epg, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            epg_data = _parsear_epg_respuesta(response, solo_canales)
+
         print(f"{Colors.GREEN}EPG parseado con éxito. Canales EPG encontrados: {len(set(epg_data.values()))}{Colors.RESET}")
         return epg_data
 
     except requests.exceptions.RequestException as e:
         print(f"{Colors.RED}{Colors.BOLD}Error al descargar EPG:{Colors.RESET} {e}")
         return None
-    except ET.ParseError as e:
+    except (ET.ParseError, zlib.error) as e:
         print(f"{Colors.RED}{Colors.BOLD}Error al parsear EPG XML:{Colors.RESET} {e}")
         return None
 
-def encontrar_epg_id(tvg_name_m3u, epg_data):
-    normalized_tvg_name = normalizar_nombre_canal(tvg_name_m3u)
-    
-    if normalized_tvg_name in epg_data:
-        return epg_data[normalized_tvg_name]
+def _ruta_cache_epg(url_epg, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha1(url_epg.encode('utf-8')).hexdigest() + '.json')
+
+def _leer_cache_epg(ruta_cache):
+    try:
+        with open(ruta_cache, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if (isinstance(cache, dict) and cache.get('version') == EPG_CACHE_VERSION
+                and cache.get('normalizacion') == NORMALIZE_VERSION and isinstance(cache.get('epg_data'), dict)):
+            return cache
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"{Colors.YELLOW}No se pudo leer la caché de la guía EPG ({e}). Se descargará de nuevo.{Colors.RESET}")
+    return None
 
+def _guardar_cache_epg(ruta_cache, cache):
+    try:
+        os.makedirs(os.path.dirname(ruta_cache), exist_ok=True)
+        with escritura_atomica(ruta_cache) as f:
+            json.dump(dict(cache, version=EPG_CACHE_VERSION, normalizacion=NORMALIZE_VERSION), f, ensure_ascii=False,
+                      separators=(',', ':'))
+    except (OSError, TypeError, ValueError) as e:
+        print(f"{Colors.YELLOW}No se pudo guardar la caché de la guía EPG:{Colors.RESET} {e}")
+
+def _plazo_vencido(limite):
+    return limite is not None and time.monotonic() >= limite
+
+def cargar_datos_epg(url_epg, timeout=10, cache_dir=EPG_CACHE_DIR, limite=None):
+    # Descarga condicional (ETag / Last-Modified). Si la guía no ha cambiado, o no se puede descargar,
+    # se usa el epg_data ya normalizado de la última descarga correcta. 'limite' (time.monotonic()) es
+    # el plazo de cargar_epgs: pasado este, la guía ya se ha tomado de la copia local y no se sobrescribe.
+    ruta_cache = _ruta_cache_epg(url_epg, cache_dir)
+    cache = _leer_cache_epg(ruta_cache)
+
+    headers = {}
+    if cache:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+
+    print(f"\n{Colors.YELLOW}Descargando y parseando la guía EPG desde: {Colors.BOLD}{url_epg}{Colors.RESET}")
+    try:
+        with requests.get(url_epg, timeout=timeout, stream=True, headers=headers) as response:
+            if response.status_code == 304 and cache:
+                print(f"{Colors.GREEN}La guía EPG no ha cambiado. Usando la copia local. Canales EPG encontrados: "
+                      f"{len(set(cache['epg_data'].values()))}{Colors.RESET}")
+                return cache['epg_data']
+            response.raise_for_status()
+            epg_data = _parsear_epg_respuesta(response)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        print(f"{Colors.GREEN}EPG parseado con éxito. Canales EPG encontrados: {len(set(epg_data.values()))}{Colors.RESET}")
+        if _plazo_vencido(limite):
+            return epg_data
+        _guardar_cache_epg(ruta_cache, {
+            'url': url_epg,
+            'etag': etag,
+            'last_modified': last_modified,
+            'epg_data': epg_data
+        })
+        return epg_data
+
+    except requests.exceptions.RequestException as e:
+        print(f"{Colors.RED}{Colors.BOLD}Error al descargar EPG:{Colors.RESET} {e}")
+    except (ET.ParseError, zlib.error) as e:
+        print(f"{Colors.RED}{Colors.BOLD}Error al parsear EPG XML:{Colors.RESET} {e}")
+
+    if cache:
+        print(f"{Colors.YELLOW}Usando la última copia correcta de la guía EPG guardada en local.{Colors.RESET}")
+        return cache['epg_data']
+    return None
+
+def cargar_epg(url_epg, timeout=10, cache_dir=EPG_CACHE_DIR):
+    # La caché solo guarda datos: el índice se reconstruye en cada carga
+    epg_data = cargar_datos_epg(url_epg, timeout, cache_dir)
+    if not epg_data:
+        return None, None
+    return epg_data, EpgMatchIndex(epg_data)
+
+def _ruta_guia_epg(url_epg, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha1(url_epg.encode('utf-8')).hexdigest() + '.guide')
+
+def descargar_guia_epg(url_epg, timeout=10, cache_dir=EPG_CACHE_DIR, limite=None):
+    # Guía completa (con programas) tal como llega, en disco y no en memoria, para poder filtrarla después.
+    # También con descarga condicional: si no ha cambiado se reutiliza la copia local. Pasado 'limite' se
+    # deja de descargar y no se toca la copia local, que ya puede estar filtrándose.
+    ruta_guia = _ruta_guia_epg(url_epg, cache_dir)
+    ruta_meta = ruta_guia + '.json'
+    headers = {}
+    if os.path.exists(ruta_guia):
+        try:
+            with open(ruta_meta, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        except (OSError, ValueError):
+            pass
+
+    print(f"\n{Colors.YELLOW}Descargando la guía EPG completa desde: {Colors.BOLD}{url_epg}{Colors.RESET}")
+    try:
+        with requests.get(url_epg, timeout=timeout, stream=True, headers=headers) as response:
+            if response.status_code == 304 and os.path.exists(ruta_guia):
+                print(f"{Colors.GREEN}La guía EPG completa no ha cambiado. Usando la copia local.{Colors.RESET}")
+                return ruta_guia
+            response.raise_for_status()
+            os.makedirs(cache_dir, exist_ok=True)
+            with escritura_atomica(ruta_guia, 'wb') as f:
+                for bloque in response.iter_content(chunk_size=EPG_CHUNK_SIZE):
+                    if _plazo_vencido(limite):
+                        raise TimeoutError(f"la descarga no ha terminado en el plazo ({url_epg})")
+                    f.write(bloque)
+            with escritura_atomica(ruta_meta) as f:
+                json.dump({'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}, f)
+        return ruta_guia
+    except TimeoutError:
+        return None
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"{Colors.RED}{Colors.BOLD}Error al descargar la guía EPG completa:{Colors.RESET} {e}")
+    if os.path.exists(ruta_guia):
+        print(f"{Colors.YELLOW}Usando la última copia completa de la guía EPG guardada en local.{Colors.RESET}")
+        return ruta_guia
+    return None
+
+def escribir_epg_filtrado(rutas_guia, ids_canal, archivo_destino):
+    # Copia de las guías (por orden de prioridad) con solo los canales indicados y sus programas, escrita
+    # en una única pasada por guía (comprimida si el destino termina en .gz). Cada canal se toma de la
+    # primera guía que lo incluye. Devuelve (canales, programas) o None si falla.
+    pendientes = set(ids_canal)
+    canales = programas = 0
+    abrir = gzip.open if archivo_destino.endswith('.gz') else open
+    ruta_temporal = archivo_destino + '.tmp'
+    try:
+        # Los programas se apartan a un archivo temporal y se añaden al final: así todos los <channel>
+        # quedan delante de los <programme>, como pide XMLTV, aunque se combinen varias guías
+        with abrir(ruta_temporal, 'wt', encoding='utf-8') as destino, \
+                tempfile.TemporaryFile('w+t', encoding='utf-8') as programas_temporal:
+            destino.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            cabecera_escrita = False
+            for ruta_guia in rutas_guia:
+                # En XMLTV los <channel> van antes que sus <programme>: al ver el canal se decide de qué guía sale
+                propios = set()
+                with open(ruta_guia, 'rb') as origen:
+                    for root, elem in _elementos_epg(iter(lambda: origen.read(EPG_CHUNK_SIZE), b'')):
+                        if not cabecera_escrita:
+                            atributos = "".join(f" {clave}={quoteattr(valor)}" for clave, valor in root.attrib.items())
+                            destino.write(f"<tv{atributos}>\n")
+                            cabecera_escrita = True
+                        if elem.tag == 'channel' and elem.get('id') in pendientes:
+                            pendientes.discard(elem.get('id'))
+                            propios.add(elem.get('id'))
+                            canales += 1
+                            salida = destino
+                        elif elem.tag == 'programme' and elem.get('channel') in propios:
+                            programas += 1
+                            salida = programas_temporal
+                        else:
+                            continue
+                        elem.tail = None
+                        salida.write("  " + ET.tostring(elem, encoding='unicode') + "\n")
+            if not cabecera_escrita:
+                destino.write("<tv>\n")
+            programas_temporal.seek(0)
+            shutil.copyfileobj(programas_temporal, destino)
+            destino.write("</tv>\n")
+        os.replace(ruta_temporal, archivo_destino)
+    except (OSError, EOFError, ET.ParseError, zlib.error) as e:
+        print(f"{Colors.RED}{Colors.BOLD}Error al generar la guía EPG filtrada:{Colors.RESET} {e}")
+        with contextlib.suppress(OSError):
+            os.remove(ruta_temporal)
+        return None
+    return canales, programas
+
+def _en_paralelo(funcion, urls, plazo):
+    # Ejecuta funcion(url, limite) para cada URL en su propio hilo y espera como mucho 'plazo' segundos en
+    # total. Devuelve {url: (resultado, segundos)} solo de las que han terminado; las demás siguen en segundo
+    # plano (sus hilos no impiden salir del programa) y con 'limite' saben que ya no deben escribir nada.
+    resultados = {}
+    limite = time.monotonic() + plazo
+
+    def ejecutar(url):
+        inicio = time.perf_counter()
+        try:
+            resultado = funcion(url, limite)
+        except Exception as e:
+            print(f"{Colors.RED}{Colors.BOLD}Error inesperado con {url}:{Colors.RESET} {e}")
+            resultado = None
+        resultados[url] = (resultado, time.perf_counter() - inicio)
+
+    hilos = [threading.Thread(target=ejecutar, args=(url,), daemon=True) for url in urls]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(max(0, limite - time.monotonic()))
+    return dict(resultados)
+
+def cargar_epgs(urls_epg, timeout=10, plazo=EPG_SOURCES_DEADLINE, cache_dir=EPG_CACHE_DIR):
+    # Varias guías a la vez, cada una con su propia caché. El orden de la lista es la prioridad: si un
+    # nombre normalizado aparece en varias guías, se queda el id de la primera. Una guía lenta no retrasa
+    # al resto más allá del plazo: se usa su última copia local, si existe.
+    if isinstance(urls_epg, str):
+        urls_epg = [urls_epg]
+    if len(urls_epg) == 1:
+        return cargar_epg(urls_epg[0], timeout, cache_dir)
+
+    resultados = _en_paralelo(lambda url, limite: cargar_datos_epg(url, timeout, cache_dir, limite), urls_epg, plazo)
+
+    epg_data = {}
+    conflictos = 0
+    print(f"\n{Colors.BOLD}Guías EPG (por orden de prioridad):{Colors.RESET}")
+    for posicion, url in enumerate(urls_epg, 1):
+        if url in resultados:
+            # Si el hilo de la guía falló, _en_paralelo deja None: esa guía cuenta como sin datos
+            datos_guia, duracion = resultados[url]
+            if datos_guia:
+                print(f"  {posicion}. {url}: {Colors.GREEN}{len(set(datos_guia.values()))} canales{Colors.RESET} en "
+                      f"{duracion:.1f}s")
+            else:
+                print(f"  {posicion}. {url}: {Colors.RED}sin datos{Colors.RESET} ({duracion:.1f}s)")
+        else:
+            cache = _leer_cache_epg(_ruta_cache_epg(url, cache_dir))
+            datos_guia = cache['epg_data'] if cache else None
+            estado = f"usando la copia local ({len(set(datos_guia.values()))} canales)" if datos_guia else "sin copia local"
+            print(f"  {posicion}. {url}: {Colors.YELLOW}no ha terminado en {plazo}s, {estado}{Colors.RESET}")
+        for nombre, channel_id in (datos_guia or {}).items():
+            previo = epg_data.setdefault(nombre, channel_id)
+            if previo != channel_id:
+                conflictos += 1
+
+    if not epg_data:
+        return None, None
+    print(f"{Colors.BLUE}Guías combinadas: {len(epg_data)} nombres, {conflictos} coincidencias entre guías resueltas "
+          f"por prioridad.{Colors.RESET}")
+    return epg_data, EpgMatchIndex(epg_data)
+
+def descargar_guias_epg(urls_epg, timeout=10, plazo=EPG_SOURCES_DEADLINE, cache_dir=EPG_CACHE_DIR):
+    # Guías completas para la EPG filtrada, en paralelo y en orden de prioridad. Si alguna no termina
+    # a tiempo se usa su copia anterior en disco.
+    if isinstance(urls_epg, str):
+        urls_epg = [urls_epg]
+    resultados = _en_paralelo(lambda url, limite: descargar_guia_epg(url, timeout, cache_dir, limite), urls_epg,
+                              plazo)
+    rutas = []
+    for url in urls_epg:
+        if url in resultados:
+            ruta = resultados[url][0]
+        else:
+            ruta = _ruta_guia_epg(url, cache_dir)
+            if os.path.exists(ruta):
+                print(f"{Colors.YELLOW}La guía completa {url} no ha terminado en {plazo}s. Usando la copia "
+                      f"local.{Colors.RESET}")
+            else:
+                print(f"{Colors.YELLOW}La guía completa {url} no ha terminado en {plazo}s y no hay copia local.{Colors.RESET}")
+                ruta = None
+        if ruta:
+            rutas.append(ruta)
+    return rutas
+
+def _cadena_token_set(nombre):
+    # Cadena que compara token_set_ratio cuando los dos nombres no comparten ningún token
+    return " ".join(sorted(set(nombre.split())))
+
+def _elementos_caracteres(texto):
+    # Multiconjunto de caracteres como conjunto: ('a', 1), ('a', 2), ...
+    ocurrencias = {}
+    elementos = []
+    for caracter in texto:
+        ocurrencias[caracter] = ocurrencias.get(caracter, 0) + 1
+        elementos.append((caracter, ocurrencias[caracter]))
+    return elementos
+
+class EpgMatchIndex:
+    # Índice de candidatos para encontrar_epg_id. Devuelve un subconjunto de epg_data que contiene
+    # siempre todos los nombres que pueden superar el umbral, así que el resultado es idéntico al
+    # recorrido completo:
+    #  - los nombres que comparten algún token con el buscado se puntúan siempre;
+    #  - si no comparten tokens, token_set_ratio se reduce a ratio() entre las cadenas de tokens
+    #    ordenados, que está acotado por 2 * caracteres_comunes / (len_a + len_b). Para superar el
+    #    umbral hace falta compartir suficientes caracteres, y un filtro de prefijos (caracteres más
+    #    raros primero) localiza esos nombres sin recorrer la guía entera.
+    def __init__(self, epg_data, threshold=EPG_FUZZY_THRESHOLD):
+        self.min_ratio = threshold / 100
+        self.entries = []
+        self.token_index = {}
+        self.char_index = {}
+        self.char_frequencies = {}
+
+        elementos_por_nombre = []
+        for pos, (epg_normalized_name, epg_id) in enumerate(epg_data.items()):
+            cadena = _cadena_token_set(epg_normalized_name)
+            self.entries.append((epg_normalized_name, epg_id, len(cadena), Counter(cadena)))
+            for token in set(epg_normalized_name.split()):
+                self.token_index.setdefault(token, []).append(pos)
+            elementos = _elementos_caracteres(cadena)
+            elementos_por_nombre.append(elementos)
+            for elemento in elementos:
+                self.char_frequencies[elemento] = self.char_frequencies.get(elemento, 0) + 1
+
+        for pos, elementos in enumerate(elementos_por_nombre):
+            for elemento in self._prefijo(elementos):
+                self.char_index.setdefault(elemento, []).append(pos)
+
+    def _prefijo(self, elementos):
+        if not elementos:
+            return []
+        # Caracteres comunes mínimos para cualquier pareja con esta longitud: r * len / (2 - r)
+        minimo_comun = max(1, math.ceil(self.min_ratio * len(elementos) / (2 - self.min_ratio) - 1e-9))
+        ordenados = sorted(elementos, key=lambda e: (self.char_frequencies.get(e, 0), e))
+        return ordenados[:len(ordenados) - minimo_comun + 1]
+
+    def candidates(self, normalized_name):
+        cadena = _cadena_token_set(normalized_name)
+        if not cadena:
+            return []
+
+        posiciones = set()
+        for token in set(normalized_name.split()):
+            posiciones.update(self.token_index.get(token, ()))
+
+        contador = Counter(cadena)
+        descartadas = set()
+        for elemento in self._prefijo(_elementos_caracteres(cadena)):
+            for pos in self.char_index.get(elemento, ()):
+                if pos in posiciones or pos in descartadas:
+                    continue
+                _, _, longitud, contador_epg = self.entries[pos]
+                comunes = sum((contador & contador_epg).values())
+                if 2 * comunes >= self.min_ratio * (len(cadena) + longitud):
+                    posiciones.add(pos)
+                else:
+                    descartadas.add(pos)
+
+        return [self.entries[pos][:2] for pos in sorted(posiciones)]
+
+def _mejor_epg_id(normalized_tvg_name, candidatos):
+    # Primer candidato (en el orden de la guía) con la puntuación más alta por encima del umbral
     best_match_epg_id = None
     highest_score = 0
-    
-    for epg_normalized_name, epg_id in epg_data.items():
+    for epg_normalized_name, epg_id in candidatos:
         score = fuzz.token_set_ratio(normalized_tvg_name, epg_normalized_name)
-        
-        if score > 75 and score > highest_score:
+
+        if score > EPG_FUZZY_THRESHOLD and score > highest_score:
             highest_score = score
             best_match_epg_id = epg_id
-        
     return best_match_epg_id
 
-def actualizar_linea_extinf(linea_extinf, nuevo_tvg_id=None, nuevo_tvg_chno=None):
-    match = re.match(r'(#EXTINF:[-]?\d+)(.*?)(,.*)', linea_extinf)
-    if not match:
-        return linea_extinf
+def encontrar_epg_id(tvg_name_m3u, epg_data, epg_index=None, memo=None):
+    normalized_tvg_name = normalizar_nombre_canal(tvg_name_m3u)
+
+    if normalized_tvg_name in epg_data:
+        return epg_data[normalized_tvg_name]
+
+    if memo is not None and normalized_tvg_name in memo:
+        return memo.get(normalized_tvg_name)
+
+    if epg_index is not None:
+        candidatos = epg_index.candidates(normalized_tvg_name)
+    else:
+        candidatos = epg_data.items()
+    best_match_epg_id = _mejor_epg_id(normalized_tvg_name, candidatos)
+
+    if memo is not None:
+        memo.put(normalized_tvg_name, best_match_epg_id)
+    return best_match_epg_id
+
+def _emparejar_epg_cdist(nombres, epg_data, workers=EPG_MATCH_WORKERS):
+    # rapidfuzz puntúa cada bloque de nombres contra toda la guía en varios núcleos. Su token_set_ratio
+    # nunca es menor que el de fuzzywuzzy (distancia de edición exacta frente a la aproximación de
+    # SequenceMatcher), así que con el umbral como corte no se pierde ningún candidato; los que quedan se
+    # vuelven a puntuar con fuzzywuzzy y el resultado, desempates incluidos, es el de encontrar_epg_id.
+    nombres_epg = list(epg_data)
+    ids_epg = list(epg_data.values())
+    resultados = {}
+    for inicio in range(0, len(nombres), EPG_MATCH_BATCH_ROWS):
+        bloque = nombres[inicio:inicio + EPG_MATCH_BATCH_ROWS]
+        puntuaciones = rf_process.cdist(bloque, nombres_epg, scorer=rf_fuzz.token_set_ratio,
+                                        score_cutoff=EPG_FUZZY_THRESHOLD, dtype=np.uint8, workers=workers)
+        candidatos = {}
+        for fila, columna in zip(*np.nonzero(puntuaciones)):
+            candidatos.setdefault(int(fila), []).append(int(columna))
+        for fila, nombre in enumerate(bloque):
+            # np.nonzero recorre la matriz por filas: las columnas ya están en el orden de la guía
+            pares = ((nombres_epg[columna], ids_epg[columna]) for columna in candidatos.get(fila, ()))
+            resultados[nombre] = _mejor_epg_id(nombre, pares)
+    return resultados
+
+def emparejar_canales_epg(canales, epg_data, epg_index=None, memo=None, metricas=None):
+    # Empareja de una vez todos los canales antes de numerarlos y deja en cada uno (tvg-id, origen), con
+    # origen 'exact', 'memo' o 'fuzzy'. Cada nombre distinto se puntúa una sola vez: con rapidfuzz, en bloque;
+    # sin él, con el índice de candidatos y fuzzywuzzy como en encontrar_epg_id. Devuelve el índice, que
+    # solo se construye si hace falta.
+    if metricas is None:
+        metricas = RunMetrics()
+    pendientes = {}
+    for canal in canales:
+        nombre = canal.normalized_tvg_name
+        if nombre in epg_data:
+            canal.epg_match = (epg_data[nombre], 'exact')
+        elif memo is not None and nombre in memo:
+            canal.epg_match = (memo.get(nombre), 'memo')
+        else:
+            pendientes.setdefault(nombre, []).append(canal)
+    if not pendientes:
+        return epg_index
 
-    prefix = match.group(1)
-    current_attrs_str = match.group(2)
-    suffix = match.group(3)
+    if rf_process is not None:
+        resultados = _emparejar_epg_cdist(list(pendientes), epg_data)
+    else:
+        if epg_index is None:
+            with metricas.stage('epg_index_build'):
+                epg_index = EpgMatchIndex(epg_data)
+        resultados = {nombre: _mejor_epg_id(nombre, epg_index.candidates(nombre)) for nombre in pendientes}
+    for nombre, epg_id in resultados.items():
+        if memo is not None:
+            memo.put(nombre, epg_id)
+        for canal in pendientes[nombre]:
+            canal.epg_match = (epg_id, 'fuzzy')
+    return epg_index
+
+def parsear_extinf(linea_extinf):
+    # Devuelve (prefijo, atributos, sufijo) o None si la línea no tiene el formato #EXTINF:duración ...,título
+    match = EXTINF_PATTERN.match(linea_extinf) or EXTINF_LOOSE_PATTERN.match(linea_extinf)
+    if not match:
+        return None
+    attrs = tuple(
+        (sys.intern(attr_match.group(1)), attr_match.group(2))
+        for attr_match in EXTINF_ATTR_PATTERN.finditer(match.group(2))
+    )
+    return sys.intern(match.group(1)), attrs, match.group(3)
 
-    current_attrs = {}
-    for attr_match in re.finditer(r'(\w+?)="([^"]*)"', current_attrs_str):
-        current_attrs[attr_match.group(1)] = attr_match.group(2)
+def formatear_extinf(prefix, attrs, suffix, nuevo_tvg_id=None, nuevo_tvg_chno=None):
+    current_attrs = dict(attrs)
 
     if nuevo_tvg_id is not None:
         current_attrs['tvg-id'] = nuevo_tvg_id
@@ -212,16 +1666,23 @@ def actualizar_linea_extinf(linea_extinf, nuevo_tvg_id=None, nuevo_tvg_chno=None
         new_attrs_list.append(f'tvg-id="{current_attrs.pop("tvg-id")}"')
     if 'tvg-chno' in current_attrs:
         new_attrs_list.append(f'tvg-chno="{current_attrs.pop("tvg-chno")}"')
-    
+
     for key, value in sorted(current_attrs.items()):
         new_attrs_list.append(f'{key}="{value}"')
-    
+
     new_attrs_str = ' '.join(new_attrs_list)
     if new_attrs_str:
         new_attrs_str = ' ' + new_attrs_str
 
     return f"{prefix}{new_attrs_str}{suffix}\n"
 
+def actualizar_linea_extinf(linea_extinf, nuevo_tvg_id=None, nuevo_tvg_chno=None):
+    partes = parsear_extinf(linea_extinf)
+    if partes is None:
+        return linea_extinf
+    prefix, attrs, suffix = partes
+    return formatear_extinf(prefix, attrs, suffix, nuevo_tvg_id, nuevo_tvg_chno)
+
 def get_quality_score(channel_name):
     name_lower = channel_name.lower()
     if 'uhd' in name_lower:
@@ -234,13 +1695,194 @@ def get_quality_score(channel_name):
         return 1
     return 0
 
-def filter_duplicate_channels(valid_entries, duplicate_handling_method):
+class Channel:
+    # Registro compacto de un canal: la línea #EXTINF se parsea una sola vez y se vuelve a
+    # generar al escribir, sin guardar las líneas originales
+    __slots__ = ('prefix', 'attrs', 'suffix', 'raw_extinf', 'url', 'tvg_name', 'normalized_tvg_name',
+                 'quality_score', 'epg_id', 'epg_match', 'processed', 'probe_ok', 'latency', 'ttfb', 'throughput')
+
+    def __init__(self, linea_extinf, url):
+        partes = parsear_extinf(linea_extinf)
+        if partes is None:
+            self.prefix = self.attrs = self.suffix = None
+            self.raw_extinf = linea_extinf
+            tvg_name = linea_extinf.strip().split(',', 1)[-1].strip()
+        else:
+            self.prefix, self.attrs, self.suffix = partes
+            self.raw_extinf = None
+            tvg_name = next((value for key, value in self.attrs if key == 'tvg-name'), None)
+            tvg_name = tvg_name.strip() if tvg_name is not None else self.suffix[1:].strip()
+
+        self.url = url
+        self.tvg_name = tvg_name
+        self.normalized_tvg_name = normalizar_nombre_canal(tvg_name)
+        self.quality_score = get_quality_score(tvg_name)
+        self.epg_id = None
+        self.epg_match = None
+        self.processed = False
+        self.probe_ok = None
+        self.latency = None
+        self.ttfb = None
+        self.throughput = None
+
+    def set_probe_result(self, resultado):
+        self.probe_ok = resultado['ok']
+        self.latency = resultado.get('latencia')
+        self.ttfb = resultado.get('ttfb')
+        self.throughput = resultado.get('throughput')
+
+    def extinf_line(self, nuevo_tvg_id=None, nuevo_tvg_chno=None):
+        if self.raw_extinf is not None:
+            return self.raw_extinf
+        return formatear_extinf(self.prefix, self.attrs, self.suffix, nuevo_tvg_id, nuevo_tvg_chno)
+
+    def url_line(self):
+        return self.url + "\n"
+
+    def entry_hash(self):
+        # Huella de la entrada sin tvg-id ni tvg-chno, que son los atributos que escribe el propio script:
+        # así una lista ya procesada (modificada en el mismo archivo) coincide con la entrada original
+        if self.raw_extinf is not None:
+            contenido = self.raw_extinf
+        else:
+            attrs = "\t".join(f"{key}={value}" for key, value in self.attrs if key not in ('tvg-id', 'tvg-chno'))
+            contenido = f"{self.prefix}\t{attrs}\t{self.suffix}"
+        return hashlib.sha1(f"{contenido}\n{self.url}".encode('utf-8')).hexdigest()
+
+def get_performance_key(channel_data):
+    # Mayor velocidad medida, después menor tiempo hasta el primer byte y menor latencia de la
+    # comprobación; sin medidas se recurre a la calidad del nombre
+    throughput = channel_data.throughput if channel_data.throughput is not None else -1
+    ttfb = channel_data.ttfb if channel_data.ttfb is not None else float('inf')
+    latency = channel_data.latency if channel_data.latency is not None else float('inf')
+    return (throughput, -ttfb, -latency, channel_data.quality_score)
+
+def _clave_casi_duplicado(nombre):
+    # Como normalizar_nombre_canal, pero las etiquetas de calidad se cambian por un espacio en vez de pegar
+    # las palabras vecinas ('laliga 1080 (backup)' daría 'laligabackup' y el ruido no se podría quitar)
+    nombre = NORMALIZE_TAGS_PATTERN.sub(' ', nombre.lower())
+    nombre = NORMALIZE_SYMBOLS_PATTERN.sub('', nombre)
+    tokens = []
+    for token in nombre.split():
+        token = DUPLICATE_TOKEN_ALIASES.get(token, token)
+        if token not in DUPLICATE_NOISE_TOKENS:
+            tokens.append(token)
+    return " ".join(tokens)
+
+def _firma_minhash(texto, tabla, coeficientes):
+    # Sin espacios para que "tele cinco" y "telecinco" compartan trigramas
+    texto = texto.replace(" ", "")
+    columnas = []
+    for posicion in range(max(1, len(texto) - 2)):
+        trigrama = texto[posicion:posicion + 3]
+        fila = tabla.get(trigrama)
+        if fila is None:
+            valor = zlib.crc32(trigrama.encode('utf-8'))
+            fila = tabla[trigrama] = tuple((a * valor + b) % MINHASH_PRIME for a, b in coeficientes)
+        columnas.append(fila)
+    return tuple(map(min, zip(*columnas)))
+
+def _palabras_distintas(clave, comunes):
+    # Palabras de la clave que no están en la otra, pegadas y en orden ("tele cinco" -> "telecinco")
+    pendientes = Counter(comunes)
+    partes = []
+    for token in clave.split():
+        if pendientes[token]:
+            pendientes[token] -= 1
+        else:
+            partes.append(token)
+    return "".join(partes)
+
+def _casi_duplicados(clave_a, clave_b, threshold):
+    # Cota por longitud: ninguna de las dos razones puede alcanzar el umbral si las longitudes difieren mucho
+    if 200 * min(len(clave_a), len(clave_b)) < threshold * (len(clave_a) + len(clave_b)):
+        return False
+    # token_sort_ratio tolera el orden de las palabras; ratio sin espacios, las palabras partidas ("tele cinco")
+    if (fuzz.token_sort_ratio(clave_a, clave_b) < threshold
+            and fuzz.ratio(clave_a.replace(" ", ""), clave_b.replace(" ", "")) < threshold):
+        return False
+    # Una sola letra distingue canales distintos ("movistar cine" / "movistar cines", "sky sport" / "sky sports"):
+    # solo se aceptan cambios de orden o de espaciado, nunca una palabra distinta
+    comunes = Counter(clave_a.split()) & Counter(clave_b.split())
+    return _palabras_distintas(clave_a, comunes) == _palabras_distintas(clave_b, comunes)
+
+def agrupar_casi_duplicados(nombres, threshold=DUPLICATE_FUZZY_THRESHOLD):
+    # Recibe los nombres tal como vienen en la lista y devuelve {nombre normalizado: nombre normalizado
+    # representativo del grupo} para los que se unen a otro. El representante es el primero que aparece.
+    # Coste casi lineal: solo se comparan los nombres que coinciden en alguna banda de su firma MinHash.
+    primer_nombre_por_clave = {}
+    claves_por_nombre = {}
+    for nombre_original in nombres:
+        nombre = normalizar_nombre_canal(nombre_original)
+        if nombre in claves_por_nombre:
+            continue
+        clave = _clave_casi_duplicado(nombre_original) or nombre
+        claves_por_nombre[nombre] = clave
+        primer_nombre_por_clave.setdefault(clave, nombre)
+
+    claves = list(primer_nombre_por_clave)
+    padres = list(range(len(claves)))
+
+    def raiz(posicion):
+        while padres[posicion] != posicion:
+            padres[posicion] = padres[padres[posicion]]
+            posicion = padres[posicion]
+        return posicion
+
+    def unir(a, b):
+        raiz_a, raiz_b = raiz(a), raiz(b)
+        if raiz_a != raiz_b:
+            # Queda como raíz la clave que apareció antes
+            padres[max(raiz_a, raiz_b)] = min(raiz_a, raiz_b)
+
+    aleatorio = random.Random(0)
+    coeficientes = [(aleatorio.randrange(1, MINHASH_PRIME), aleatorio.randrange(MINHASH_PRIME))
+                    for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+    tabla = {}
+    cubos = {}
+    for posicion, clave in enumerate(claves):
+        firma = _firma_minhash(clave, tabla, coeficientes)
+        # Los números distinguen canales distintos ("la 1" / "la 2", "dazn 1" / "dazn 2"): forman parte
+        # del cubo, así que solo se comparan nombres con los mismos números
+        numeros = tuple(sorted({token for token in clave.split() if token.isdigit()}))
+        for banda in range(MINHASH_BANDS):
+            cubos.setdefault((banda, numeros, firma[banda * MINHASH_ROWS:(banda + 1) * MINHASH_ROWS]), []).append(posicion)
+
+    comparadas = set()
+    for miembros in cubos.values():
+        if len(miembros) < 2:
+            continue
+        if len(miembros) <= DUPLICATE_MAX_BUCKET:
+            parejas = ((a, b) for i, a in enumerate(miembros) for b in miembros[i + 1:])
+        else:
+            ordenados = sorted(miembros, key=lambda posicion: claves[posicion])
+            parejas = ((a, b) for i, a in enumerate(ordenados) for b in ordenados[i + 1:i + DUPLICATE_MAX_BUCKET])
+        for a, b in parejas:
+            pareja = (a, b) if a < b else (b, a)
+            if pareja in comparadas or raiz(a) == raiz(b):
+                continue
+            comparadas.add(pareja)
+            if _casi_duplicados(claves[a], claves[b], threshold):
+                unir(a, b)
+
+    posicion_por_clave = {clave: posicion for posicion, clave in enumerate(claves)}
+    representantes = {}
+    for nombre, clave in claves_por_nombre.items():
+        representante = primer_nombre_por_clave[claves[raiz(posicion_por_clave[clave])]]
+        if representante != nombre:
+            representantes[nombre] = representante
+    return representantes
+
+def filter_duplicate_channels(valid_entries, duplicate_handling_method, grupos_aproximados=None):
+    # grupos_aproximados: resultado de agrupar_casi_duplicados para unir también variantes del nombre
     if duplicate_handling_method == 'all':
         return valid_entries
 
     grouped_channels = {}
     for entry in valid_entries:
-        normalized_name = entry['normalized_tvg_name']
+        normalized_name = entry.normalized_tvg_name
+        if grupos_aproximados:
+            normalized_name = grupos_aproximados.get(normalized_name, normalized_name)
         if normalized_name not in grouped_channels:
             grouped_channels[normalized_name] = []
         grouped_channels[normalized_name].append(entry)
@@ -256,184 +1898,577 @@ def filter_duplicate_channels(valid_entries, duplicate_handling_method):
         elif duplicate_handling_method == 'quality':
             best_quality_channels = []
             max_quality_score = -1
-            
+
             for channel_data in channels_list:
-                score = get_quality_score(channel_data['tvg_name'])
+                score = channel_data.quality_score
                 if score > max_quality_score:
                     max_quality_score = score
                     best_quality_channels = [channel_data]
                 elif score == max_quality_score:
                     best_quality_channels.append(channel_data)
-            
+
             if best_quality_channels:
                 filtered_entries.append(best_quality_channels[0])
+        elif duplicate_handling_method == 'fastest':
+            filtered_entries.append(max(channels_list, key=get_performance_key))
         else:
             filtered_entries.extend(channels_list)
 
     return filtered_entries
 
 
-def procesar_m3u(archivo_m3u, lineas, borrar_automatico=False, timeout=5, epg_data=None, output_file_name=None, start_channel_number=1, duplicate_handling_method='all'):
+def cargar_perfil_orden(archivo_perfil):
+    # Perfil de numeración externo: JSON {"nombre normalizado": numero} o CSV "nombre normalizado,numero"
+    channel_order = {}
+    try:
+        if archivo_perfil.lower().endswith('.json'):
+            with open(archivo_perfil, 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+            if not isinstance(datos, dict):
+                raise ValueError("el JSON debe ser un objeto {\"nombre\": numero}")
+            for nombre, chno in datos.items():
+                channel_order[nombre.strip().lower()] = int(chno)
+        else:
+            with open(archivo_perfil, 'r', encoding='utf-8', newline='') as f:
+                for fila in csv.reader(f):
+                    if len(fila) < 2 or not fila[0].strip() or fila[0].lstrip().startswith('#'):
+                        continue
+                    try:
+                        chno = int(fila[1])
+                    except ValueError:
+                        # Cabecera del CSV
+                        continue
+                    channel_order[fila[0].strip().lower()] = chno
+    except FileNotFoundError:
+        print(f"{Colors.RED}{Colors.BOLD}Error:{Colors.RESET} El perfil de orden '{archivo_perfil}' no se encontró.")
+        sys.exit(1)
+    except (ValueError, TypeError) as e:
+        print(f"{Colors.RED}{Colors.BOLD}Error al leer el perfil de orden '{archivo_perfil}':{Colors.RESET} {e}")
+        sys.exit(1)
+    return channel_order
+
+def asignar_numeros_canal(entries, channel_order=None, start_channel_number=1, numeros_previos=None):
+    # Devuelve (tvg-chno, entrada, prioritario) en el orden de asignación: primero los canales del
+    # perfil de orden (la primera entrada con ese nombre normalizado), después los que conservan el
+    # número de la ejecución anterior (numeros_previos: {entrada: tvg-chno}) y por último el resto por nombre
+    if channel_order is None:
+        channel_order = COMMON_SPANISH_CHANNELS_ORDER
+
+    primera_por_nombre = {}
+    for channel_data in entries:
+        primera_por_nombre.setdefault(channel_data.normalized_tvg_name, channel_data)
+
+    asignaciones = []
+    assigned_channel_numbers = set()
+
+    for common_normalized_name, desired_chno in channel_order.items():
+        if desired_chno in assigned_channel_numbers:
+            continue
+        channel_data = primera_por_nombre.get(common_normalized_name)
+        if channel_data is not None and not channel_data.processed:
+            channel_data.processed = True
+            assigned_channel_numbers.add(desired_chno)
+            asignaciones.append((desired_chno, channel_data, True))
+
+    if numeros_previos:
+        for channel_data in entries:
+            previous_chno = numeros_previos.get(channel_data)
+            if previous_chno is not None and not channel_data.processed and previous_chno not in assigned_channel_numbers:
+                channel_data.processed = True
+                assigned_channel_numbers.add(previous_chno)
+                asignaciones.append((previous_chno, channel_data, False))
+
+    remaining_channels_to_process = [
+        channel_data for channel_data in entries
+        if not channel_data.processed
+    ]
+    remaining_channels_to_process.sort(key=lambda x: x.normalized_tvg_name)
+
+    current_sequential_number = start_channel_number
+    for channel_data in remaining_channels_to_process:
+        while current_sequential_number in assigned_channel_numbers:
+            current_sequential_number += 1
+        assigned_channel_numbers.add(current_sequential_number)
+        asignaciones.append((current_sequential_number, channel_data, False))
+        current_sequential_number += 1
+
+    return asignaciones
+
+def ruta_manifiesto(archivo_destino):
+    return os.path.splitext(archivo_destino)[0] + '.manifest.json'
+
+def cargar_manifiesto(ruta):
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            manifiesto = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"{Colors.YELLOW}No se pudo leer el manifiesto '{ruta}' ({e}). Se procesará la lista completa.{Colors.RESET}")
+        return None
+    if not isinstance(manifiesto, dict) or manifiesto.get('version') != MANIFEST_VERSION:
+        return None
+    return manifiesto
+
+def guardar_manifiesto(ruta, manifiesto):
+    try:
+        with escritura_atomica(ruta) as f:
+            json.dump(manifiesto, f, ensure_ascii=False, separators=(',', ':'))
+    except OSError as e:
+        print(f"{Colors.YELLOW}No se pudo guardar el manifiesto '{ruta}': {e}{Colors.RESET}")
+
+def ruta_diario(archivo_destino):
+    return os.path.splitext(archivo_destino)[0] + '.journal'
+
+class ProbeJournal:
+    # Diario de solo añadir: una línea JSON por comprobación, escrita y volcada al momento. Si el proceso
+    # muere a mitad de una línea, al reanudar se descarta esa línea y se conserva todo lo anterior.
+    def __init__(self, ruta, probe_method, reanudar=False):
+        self.ruta = ruta
+        self.entries = {}
+        previo = self._leer(ruta, probe_method) if reanudar else None
+        if previo is not None:
+            self.entries = previo
+        # Se reescribe con lo recuperado: así no se añade nada detrás de una línea a medias
+        with escritura_atomica(ruta) as f:
+            f.write(json.dumps({'version': JOURNAL_VERSION, 'probe_method': probe_method, 'creado': time.time()}) + "\n")
+            for hash_entrada, registro in self.entries.items():
+                f.write(json.dumps(dict(registro, hash=hash_entrada), separators=(',', ':')) + "\n")
+        self.file = open(ruta, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _leer(ruta, probe_method):
+        entradas = {}
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                try:
+                    cabecera = json.loads(f.readline())
+                except ValueError:
+                    return None
+                if (not isinstance(cabecera, dict) or cabecera.get('version') != JOURNAL_VERSION
+                        or cabecera.get('probe_method') != probe_method):
+                    return None
+                limite = time.time() - JOURNAL_MAX_AGE
+                for linea in f:
+                    try:
+                        registro = json.loads(linea)
+                    except ValueError:
+                        # Última línea a medias de una ejecución que se cortó
+                        break
+                    if registro.get('comprobado', 0) >= limite:
+                        entradas[registro.pop('hash')] = registro
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            print(f"{Colors.YELLOW}No se pudo leer el diario '{ruta}' ({e}). Se comprobará la lista completa.{Colors.RESET}")
+            return None
+        return entradas
+
+    def _escribir(self, registro):
+        # Cada línea se vuelca en cuanto se escribe: si el proceso muere, lo escrito ya está en el sistema
+        self.file.write(json.dumps(registro, separators=(',', ':')) + "\n")
+        self.file.flush()
+
+    def get(self, hash_entrada):
+        return self.entries.get(hash_entrada)
+
+    def record(self, hash_entrada, resultado):
+        registro = {
+            'hash': hash_entrada,
+            'ok': resultado['ok'],
+            'latencia': resultado.get('latencia'),
+            'ttfb': resultado.get('ttfb'),
+            'throughput': resultado.get('throughput'),
+            'comprobado': time.time()
+        }
+        self._escribir(registro)
+
+    def close(self, completado=False):
+        # Una ejecución terminada ya no necesita el diario
+        if not self.file.closed:
+            self.file.close()
+        if completado:
+            with contextlib.suppress(OSError):
+                os.remove(self.ruta)
+
+def huella_epg(epg_data):
+    # Identifica el contenido de la guía: si cambia, los tvg-id emparejados antes se recalculan
+    if not epg_data:
+        return None
+    huella = hashlib.sha1(f"normalizacion {NORMALIZE_VERSION}\n".encode('utf-8'))
+    for nombre, epg_id in sorted(epg_data.items()):
+        huella.update(f"{nombre}\t{epg_id}\n".encode('utf-8'))
+    return huella.hexdigest()
+
+def procesar_m3u(archivo_m3u, lineas, borrar_automatico=False, timeout=5, epg_data=None, output_file_name=None,
+                 start_channel_number=1, duplicate_handling_method='all', opciones=None):
+    # El resto de opciones llegan en un diccionario con las claves de PROCESS_DEFAULT_OPTIONS
+    desconocidas = set(opciones or {}) - set(PROCESS_DEFAULT_OPTIONS)
+    if desconocidas:
+        raise TypeError(f"opciones desconocidas para procesar_m3u: {', '.join(sorted(desconocidas))}")
+    opciones = dict(PROCESS_DEFAULT_OPTIONS, **(opciones or {}))
+    max_workers = opciones['max_workers']
+    probe_method = opciones['probe_method']
+    health_cache = opciones['health_cache']
+    epg_index = opciones['epg_index']
+    channel_order = opciones['channel_order']
+    interactivo = opciones['interactive']
+    sondeo_diferido = opciones['lazy_probe']
+    incremental = opciones['incremental']
+    silencioso = opciones['quiet']
+    metricas = opciones['run_metrics']
+    agrupar_parecidos = opciones['fuzzy_duplicates']
+    guias_epg = opciones['epg_guides']
+    formato_epg_filtrado = opciones['filtered_epg']
+    reanudar = opciones['resume']
+    epg_memo = opciones['epg_memo']
+    limites_host = opciones['host_limits']
+
     canales_fallidos = []
     valid_channel_entries = []
     non_channel_lines = []
-
-    print(f"\n{Colors.BOLD}Realizando la primera pasada: identificando canales y comprobando conexiones (Timeout: {timeout}s):{Colors.RESET}")
-    
-    total_channels_to_check = 0
-    for i in range(len(lineas)):
-        if lineas[i].strip().startswith("#EXTINF:") and i + 1 < len(lineas) and lineas[i+1].strip().startswith("http"):
-            total_channels_to_check += 1
-
+    if metricas is None:
+        metricas = RunMetrics(nombre_lista(archivo_m3u) if archivo_m3u else None)
+    inicio_proceso = time.perf_counter()
+
+    print(f"\n{Colors.BOLD}Realizando la primera pasada: identificando canales y comprobando conexiones (Timeout: "
+          f"{timeout}s, Conexiones simultáneas: {max_workers}, Método: {probe_method}):{Colors.RESET}")
+
+    canales_a_comprobar = []
+    tiene_cabecera = False
+    cache_aciertos = 0
+    cache_fallos = 0
+
+    if isinstance(lineas, list):
+        total_estimado = contar_canales_m3u(lineas)
+    elif archivo_m3u and os.path.isfile(archivo_m3u):
+        # Pasada rápida sobre el archivo para la barra de progreso, sin guardar nada en memoria
+        total_estimado = contar_canales_m3u(iterar_m3u(archivo_m3u))
+    else:
+        total_estimado = None
+
+    entradas = parsear_m3u(lineas)
+    # Con 'first' y 'quality' solo sobrevive un canal por grupo de duplicados: se agrupan antes de
+    # comprobar y cada grupo se sondea en el orden de la política hasta encontrar uno que funcione
+    sondeo_diferido = sondeo_diferido and duplicate_handling_method in ('first', 'quality')
+    grupos_pendientes = {}
+    grupos_listos = deque()
+    en_vuelo = 0
+    canales_omitidos = 0
+    breaker = HostCircuitBreaker() if opciones['host_breaker'] else None
+
+    # Diario de comprobaciones junto al destino, para poder reanudar si la ejecución se corta
+    diario = None
+    sondeo_completo = True
+    sondeos_reanudados = 0
+    fallo_escritura = False
+    destino_diario = output_file_name or archivo_m3u
+    if destino_diario:
+        try:
+            diario = ProbeJournal(ruta_diario(destino_diario), probe_method, reanudar)
+        except OSError as e:
+            print(f"{Colors.YELLOW}No se pudo crear el diario de comprobaciones: {e}{Colors.RESET}")
+    if reanudar and diario is not None and diario.entries:
+        print(f"{Colors.BLUE}Reanudando: {len(diario.entries)} comprobaciones recuperadas del diario "
+              f"{diario.ruta}{Colors.RESET}")
+    elif reanudar:
+        print(f"{Colors.YELLOW}No hay un diario válido de una ejecución anterior: se comprobará la lista "
+              f"completa.{Colors.RESET}")
+    # Agrupación aproximada: se calcula sobre todas las entradas de la lista (no solo las que funcionan)
+    # para que los grupos sean los mismos con y sin sondeo diferido
+    agrupar_parecidos = agrupar_parecidos and duplicate_handling_method != 'all'
+    grupos_aproximados = {}
+
+    def agrupar_variantes():
+        with metricas.stage('cluster_duplicates'):
+            grupos_aproximados.update(agrupar_casi_duplicados(canal.tvg_name for canal in canales_a_comprobar))
+        metricas.count('near_duplicate_names_merged', len(grupos_aproximados))
+
+    def clave_duplicado(canal):
+        return grupos_aproximados.get(canal.normalized_tvg_name, canal.normalized_tvg_name)
+
+    # Modo incremental: las entradas que no han cambiado desde la última ejecución reutilizan su
+    # comprobación, su tvg-id y su tvg-chno; solo se sondean y emparejan las nuevas o modificadas
+    manifiesto = None
+    if incremental:
+        archivo_manifiesto = ruta_manifiesto(output_file_name or archivo_m3u)
+        manifiesto = cargar_manifiesto(archivo_manifiesto)
+    entradas_previas = manifiesto['entradas'] if manifiesto else {}
+    reutilizar_sondeos = manifiesto is not None and manifiesto.get('probe_method') == probe_method
+    huella_epg_actual = huella_epg(epg_data) if incremental else None
+    reutilizar_epg = manifiesto is not None and huella_epg_actual is not None and manifiesto.get('epg') == huella_epg_actual
+    hashes_entradas = {}
+    comprobado_en = {}
+    sondeos_reutilizados = 0
+
+    def canales_de_la_lista():
+        nonlocal tiene_cabecera
+        for tipo, datos in entradas:
+            if tipo == 'cabecera':
+                tiene_cabecera = True
+                continue
+            if tipo == 'linea':
+                non_channel_lines.append(datos)
+                continue
+            canales_a_comprobar.append(datos)
+            if incremental or diario is not None:
+                hashes_entradas[datos] = datos.entry_hash()
+            yield datos
+
+    def escribir_resultado(pbar, canal, estado):
+        # En modo silencioso no se escribe una línea por canal: en listas enormes la consola es el cuello de botella
+        if not silencioso:
+            pbar.write(f"Comprobando: {Colors.BOLD}{canal.tvg_name}{Colors.RESET} ({canal.url}) ... {estado}")
+
+    def desactivar_cache(error):
+        # La caché solo es una optimización: si falla, se sigue comprobando sin ella
+        nonlocal health_cache
+        print(f"{Colors.YELLOW}La caché de comprobaciones ha fallado ({error}); se continúa sin ella.{Colors.RESET}")
+        health_cache = None
+
+    def resuelto_por_cache(canal, pbar):
+        nonlocal cache_aciertos, cache_fallos, sondeos_reutilizados, sondeos_reanudados
+        registro = diario.get(hashes_entradas[canal]) if diario is not None else None
+        if registro is not None:
+            sondeos_reanudados += 1
+            canal.set_probe_result(registro)
+            comprobado_en[canal] = registro['comprobado']
+            estado = f"{Colors.GREEN}OK{Colors.RESET}" if canal.probe_ok else f"{Colors.RED}FALLO{Colors.RESET}"
+            escribir_resultado(pbar, canal, f"{estado} (diario)")
+            pbar.update(1)
+            return True
+        previo = entradas_previas.get(hashes_entradas.get(canal)) if reutilizar_sondeos else None
+        if previo is not None and 'ok' in previo and time.time() - previo['comprobado'] < INCREMENTAL_MAX_AGE:
+            sondeos_reutilizados += 1
+            canal.set_probe_result(previo)
+            comprobado_en[canal] = previo['comprobado']
+            estado = f"{Colors.GREEN}OK{Colors.RESET}" if canal.probe_ok else f"{Colors.RED}FALLO{Colors.RESET}"
+            escribir_resultado(pbar, canal, f"{estado} (sin cambios)")
+            pbar.update(1)
+            return True
+        # Los canales comprobados recientemente se toman de la caché y no se vuelven a sondear
+        try:
+            resultado_cache = health_cache.get(canal.url) if health_cache is not None else None
+        except sqlite3.Error as e:
+            desactivar_cache(e)
+            resultado_cache = None
+        # Al medir velocidad no sirven los resultados guardados por otros métodos sin medida
+        if (resultado_cache is not None and probe_method == 'throughput' and resultado_cache['ok']
+                and resultado_cache['throughput'] is None):
+            resultado_cache = None
+        if resultado_cache is None:
+            if health_cache is not None:
+                cache_fallos += 1
+            return False
+        cache_aciertos += 1
+        canal.set_probe_result(resultado_cache)
+        estado = f"{Colors.GREEN}OK{Colors.RESET}" if canal.probe_ok else f"{Colors.RED}FALLO{Colors.RESET}"
+        escribir_resultado(pbar, canal, f"{estado} (caché)")
+        pbar.update(1)
+        return True
+
+    def cerrar_grupo(normalized_name, pbar):
+        # El grupo ya tiene un canal que funciona: el resto de candidatos no se comprueban
+        nonlocal canales_omitidos
+        restantes = grupos_pendientes.pop(normalized_name)
+        if restantes:
+            canales_omitidos += len(restantes)
+            pbar.update(len(restantes))
+
+    def canales_para_sondear(pbar):
+        for canal in canales_de_la_lista():
+            if not resuelto_por_cache(canal, pbar):
+                yield canal
+
+    def canales_para_sondear_diferido(pbar):
+        nonlocal en_vuelo
+        canales = list(canales_de_la_lista())
+        if agrupar_parecidos:
+            agrupar_variantes()
+        for canal in canales:
+            grupos_pendientes.setdefault(clave_duplicado(canal), []).append(canal)
+        for normalized_name, candidatos in grupos_pendientes.items():
+            if duplicate_handling_method == 'quality':
+                candidatos.sort(key=lambda candidato: -candidato.quality_score)
+            candidatos.reverse()
+            grupos_listos.append(normalized_name)
+
+        while grupos_listos or en_vuelo:
+            if not grupos_listos:
+                yield None
+                continue
+            normalized_name = grupos_listos.popleft()
+            canal = grupos_pendientes[normalized_name].pop()
+            if resuelto_por_cache(canal, pbar):
+                if canal.probe_ok:
+                    cerrar_grupo(normalized_name, pbar)
+                elif grupos_pendientes[normalized_name]:
+                    grupos_listos.appendleft(normalized_name)
+                continue
+            en_vuelo += 1
+            yield canal
+
+    inicio_etapa = time.perf_counter()
     try:
-        with tqdm(total=total_channels_to_check, desc="Progreso de conexión", unit="canal") as pbar:
-            i = 0
-            while i < len(lineas):
-                linea_actual = lineas[i].strip()
-                
-                if linea_actual.startswith("#EXTINF:") and i + 1 < len(lineas):
-                    linea_extinf_original = lineas[i]
-                    posible_url = lineas[i + 1].strip()
-
-                    if posible_url.startswith("http"):
-                        url = posible_url
-                        
-                        tvg_name_match = re.search(r'tvg-name="([^"]*)"', linea_actual)
-                        nombre_canal_m3u = tvg_name_match.group(1).strip() if tvg_name_match else linea_actual.split(',', 1)[-1].strip()
-                        
-                        pbar.set_description(f"Comprobando: {nombre_canal_m3u}")
-
-                        if comprobar_conexion(url, timeout=timeout):
-                            pbar.write(f"Comprobando: {Colors.BOLD}{nombre_canal_m3u}{Colors.RESET} ({url}) ... {Colors.GREEN}OK{Colors.RESET}")
-                            valid_channel_entries.append({
-                                'extinf_line': linea_extinf_original,
-                                'url_line': lineas[i + 1],
-                                'tvg_name': nombre_canal_m3u,
-                                'normalized_tvg_name': normalizar_nombre_canal(nombre_canal_m3u),
-                                'epg_id': None,
-                                'processed': False
-                            })
-                        else:
-                            pbar.write(f"Comprobando: {Colors.BOLD}{nombre_canal_m3u}{Colors.RESET} ({url}) ... {Colors.RED}FALLO{Colors.RESET}")
-                            canales_fallidos.append((nombre_canal_m3u, url))
-                        
-                        pbar.update(1)
-                        i += 2
-                        continue
-                
-                if not linea_actual.startswith("#EXTM3U"): 
-                    non_channel_lines.append(lineas[i])
-                i += 1
+        with tqdm(total=total_estimado, desc="Progreso de conexión", unit="canal", disable=not interactivo) as pbar:
+            generador = canales_para_sondear_diferido(pbar) if sondeo_diferido else canales_para_sondear(pbar)
+            comprobaciones = comprobar_canales_concurrente(generador, timeout, max_workers, probe_method, breaker=breaker,
+                                                           scheduler=HostScheduler(limites_host))
+            for canal, resultado in comprobaciones:
+                canal.set_probe_result(resultado)
+                if incremental and not resultado.get('cortocircuito'):
+                    comprobado_en[canal] = time.time()
+                if diario is not None and not resultado.get('cortocircuito'):
+                    diario.record(hashes_entradas[canal], resultado)
+                if sondeo_diferido:
+                    en_vuelo -= 1
+                    if resultado['ok']:
+                        cerrar_grupo(clave_duplicado(canal), pbar)
+                    elif grupos_pendientes[clave_duplicado(canal)]:
+                        grupos_listos.append(clave_duplicado(canal))
+                if resultado.get('cortocircuito'):
+                    metricas.count('probe_short_circuited')
+                else:
+                    metricas.observe_probe(urlsplit(canal.url).netloc.lower(), resultado['latencia'], resultado['ok'])
+                    if health_cache is not None:
+                        try:
+                            health_cache.put(canal.url, resultado['ok'], resultado['latencia'], resultado['ttfb'],
+                                             resultado['throughput'])
+                        except sqlite3.Error as e:
+                            desactivar_cache(e)
+                if not silencioso:
+                    pbar.set_description(f"Comprobando: {canal.tvg_name}")
+                if resultado.get('cortocircuito'):
+                    escribir_resultado(pbar, canal, f"{Colors.RED}FALLO{Colors.RESET} (servidor caído)")
+                elif resultado['ok']:
+                    escribir_resultado(pbar, canal, f"{Colors.GREEN}OK{Colors.RESET}")
+                else:
+                    escribir_resultado(pbar, canal, f"{Colors.RED}FALLO{Colors.RESET}")
+                pbar.update(1)
     except KeyboardInterrupt:
         pbar.close()
         print(f"\n{Colors.YELLOW}{Colors.BOLD}Proceso de comprobación de canales interrumpido por el usuario.{Colors.RESET}")
+        sondeo_completo = False
+        if not interactivo:
+            raise
         respuesta_continuar = input(f"{Colors.BOLD}¿Deseas continuar con la asignación de EPG/numeración y guardar los canales ya comprobados? (s/n): {Colors.RESET}").lower()
         if respuesta_continuar != 's':
             print(f"{Colors.YELLOW}Operación cancelada. No se guardarán cambios.{Colors.RESET}")
+            if diario is not None:
+                print(f"{Colors.YELLOW}Las comprobaciones hechas quedan en {diario.ruta}: la próxima ejecución puede "
+                      f"reanudarse desde ahí.{Colors.RESET}")
             sys.exit(0)
+        if diario is not None:
+            print(f"{Colors.YELLOW}Se guardará lo comprobado hasta ahora. El diario {diario.ruta} se conserva para "
+                  f"completar la lista con --resume (o reanudando desde el menú).{Colors.RESET}")
+    finally:
+        entradas.close()
+        # El diario se cierra (sin borrarlo) en cuanto acaban las comprobaciones
+        if diario is not None:
+            diario.close()
+        metricas.add_stage('parse_and_probe', time.perf_counter() - inicio_etapa)
+
+    # Los resultados llegan en orden de finalización; se recorren en el orden original de la lista
+    for canal in canales_a_comprobar:
+        if canal.probe_ok is None:
+            continue
+        if canal.probe_ok:
+            valid_channel_entries.append(canal)
+        else:
+            canales_fallidos.append((canal.tvg_name, canal.url))
+    if agrupar_parecidos and not sondeo_diferido:
+        agrupar_variantes()
+    canales_a_comprobar = None
 
     print(f"\n{Colors.BOLD}Aplicando el método de manejo de duplicados: '{duplicate_handling_method}'...{Colors.RESET}")
-    filtered_valid_channel_entries = filter_duplicate_channels(valid_channel_entries, duplicate_handling_method)
+    with metricas.stage('deduplicate'):
+        filtered_valid_channel_entries = filter_duplicate_channels(valid_channel_entries, duplicate_handling_method,
+                                                                   grupos_aproximados)
+    if agrupar_parecidos:
+        print(f"{Colors.BLUE}Nombres agrupados por parecido con otro canal: {len(grupos_aproximados)}{Colors.RESET}")
     print(f"{Colors.BLUE}Canales válidos después del filtrado de duplicados: {len(filtered_valid_channel_entries)}{Colors.RESET}")
 
     canales_ok = len(filtered_valid_channel_entries)
     total_canales = canales_ok + len(canales_fallidos)
 
     final_output_channels_data = []
-    assigned_channel_numbers = set()
     canales_con_epg_id = 0
     canales_con_tvg_chno = 0
-    
-    print(f"\n{Colors.BOLD}Asignando tvg-id y tvg-chno según el orden lógico...{Colors.RESET}")
-
-    for common_normalized_name, desired_chno in COMMON_SPANISH_CHANNELS_ORDER.items():
-        if desired_chno in assigned_channel_numbers:
-            continue 
-
-        found_channel_data = None
-        found_channel_index = -1
-        for idx, channel_data in enumerate(filtered_valid_channel_entries):
-            if not channel_data['processed'] and channel_data['normalized_tvg_name'] == common_normalized_name:
-                found_channel_data = channel_data
-                found_channel_index = idx
-                break
-        
-        if found_channel_data:
-            epg_id_encontrado = None
-            if epg_data:
-                epg_id_encontrado = encontrar_epg_id(found_channel_data['tvg_name'], epg_data)
-                if epg_id_encontrado:
-                    found_channel_data['epg_id'] = epg_id_encontrado
-                    canales_con_epg_id += 1
-
-            updated_extinf_line = actualizar_linea_extinf(
-                found_channel_data['extinf_line'], 
-                nuevo_tvg_id=found_channel_data['epg_id'], 
-                nuevo_tvg_chno=desired_chno
-            )
-            
-            final_output_channels_data.append({
-                'chno': desired_chno,
-                'extinf_line': updated_extinf_line,
-                'url_line': found_channel_data['url_line']
-            })
-            assigned_channel_numbers.add(desired_chno)
-            filtered_valid_channel_entries[found_channel_index]['processed'] = True
-            canales_con_tvg_chno += 1
-            print(f"  {Colors.BLUE}Asignado (Prioritario):{Colors.RESET} '{found_channel_data['tvg_name']}' -> tvg-chno={desired_chno}")
-
-    current_sequential_number = start_channel_number
-    
-    while current_sequential_number in assigned_channel_numbers:
-        current_sequential_number += 1
-
-    remaining_channels_to_process = [
-        channel_data for channel_data in filtered_valid_channel_entries 
-        if not channel_data['processed']
-    ]
+    emparejados_epg = {}
+    epg_reutilizados = 0
+
+    numeros_previos = {}
+    if manifiesto is not None:
+        # Primero conserva su número cada entrada sin cambios; los números de las entradas que han
+        # cambiado (p. ej. una URL nueva) pasan a la siguiente entrada con el mismo nombre
+        hashes_numerados = set()
+        for channel_data in filtered_valid_channel_entries:
+            previo = entradas_previas.get(hashes_entradas[channel_data])
+            if previo is not None and previo.get('chno') is not None:
+                numeros_previos[channel_data] = previo['chno']
+                hashes_numerados.add(hashes_entradas[channel_data])
+        numeros_por_nombre = {}
+        for hash_entrada, previo in entradas_previas.items():
+            if previo.get('chno') is not None and hash_entrada not in hashes_numerados:
+                numeros_por_nombre.setdefault(previo.get('nombre'), deque()).append(previo['chno'])
+        for channel_data in filtered_valid_channel_entries:
+            if channel_data not in numeros_previos and numeros_por_nombre.get(channel_data.normalized_tvg_name):
+                numeros_previos[channel_data] = numeros_por_nombre[channel_data.normalized_tvg_name].popleft()
+
+    def epg_previo(canal):
+        previo = entradas_previas.get(hashes_entradas[canal]) if reutilizar_epg else None
+        return previo if previo is not None and 'epg_id' in previo else None
+
+    # Emparejamiento EPG de todos los canales de una vez, antes de numerarlos: la numeración solo consulta el resultado
+    if epg_data:
+        inicio_emparejamiento = time.perf_counter()
+        epg_index = emparejar_canales_epg(
+            [canal for canal in filtered_valid_channel_entries if canal.epg_id is None and epg_previo(canal) is None],
+            epg_data, epg_index, epg_memo, metricas
+        )
+        metricas.add_time('epg_match', time.perf_counter() - inicio_emparejamiento)
 
-    remaining_channels_to_process.sort(key=lambda x: x['normalized_tvg_name'])
+    print(f"\n{Colors.BOLD}Asignando tvg-id y tvg-chno según el orden lógico...{Colors.RESET}")
 
-    for channel_data in remaining_channels_to_process:
-        while current_sequential_number in assigned_channel_numbers:
-            current_sequential_number += 1
-        
-        if channel_data['epg_id'] is None and epg_data:
-            epg_id_encontrado = encontrar_epg_id(channel_data['tvg_name'], epg_data)
+    inicio_etapa = time.perf_counter()
+    numeracion = asignar_numeros_canal(filtered_valid_channel_entries, channel_order, start_channel_number, numeros_previos)
+    for chno, channel_data, prioritario in numeracion:
+        if channel_data.epg_id is None and epg_data:
+            previo = epg_previo(channel_data)
+            if previo is not None:
+                epg_id_encontrado = previo['epg_id']
+                epg_reutilizados += 1
+                metricas.count('epg_match_reused')
+            else:
+                epg_id_encontrado, origen = channel_data.epg_match
+                if origen == 'exact':
+                    metricas.count('epg_match_exact')
+                elif origen == 'memo':
+                    metricas.count('epg_match_memo')
+                else:
+                    metricas.count('epg_match_fuzzy' if epg_id_encontrado else 'epg_match_none')
+            emparejados_epg[channel_data] = epg_id_encontrado
             if epg_id_encontrado:
-                channel_data['epg_id'] = epg_id_encontrado
+                channel_data.epg_id = epg_id_encontrado
                 canales_con_epg_id += 1
 
-        updated_extinf_line = actualizar_linea_extinf(
-            channel_data['extinf_line'], 
-            nuevo_tvg_id=channel_data['epg_id'], 
-            nuevo_tvg_chno=current_sequential_number
-        )
-        
         final_output_channels_data.append({
-            'chno': current_sequential_number,
-            'extinf_line': updated_extinf_line,
-            'url_line': channel_data['url_line']
+            'chno': chno,
+            'channel': channel_data
         })
-        assigned_channel_numbers.add(current_sequential_number)
         canales_con_tvg_chno += 1
-        print(f"  {Colors.BLUE}Asignado (Secuencial):{Colors.RESET} '{channel_data['tvg_name']}' -> tvg-chno={current_sequential_number}")
-        current_sequential_number += 1
-
-
-    nuevas_lineas = []
-    if output_file_name:
-        nuevas_lineas.append("#EXTM3U\n")
-    else:
-        if any(line.strip().startswith("#EXTM3U") for line in lineas):
-            nuevas_lineas.append("#EXTM3U\n")
-
-    for line in non_channel_lines:
-        nuevas_lineas.append(line)
+        if silencioso:
+            continue
+        if prioritario:
+            print(f"  {Colors.BLUE}Asignado (Prioritario):{Colors.RESET} '{channel_data.tvg_name}' -> tvg-chno={chno}")
+        elif numeros_previos.get(channel_data) == chno:
+            print(f"  {Colors.BLUE}Asignado (Conservado):{Colors.RESET} '{channel_data.tvg_name}' -> tvg-chno={chno}")
+        else:
+            print(f"  {Colors.BLUE}Asignado (Secuencial):{Colors.RESET} '{channel_data.tvg_name}' -> tvg-chno={chno}")
+    metricas.add_stage('numbering_and_epg', time.perf_counter() - inicio_etapa)
 
-    for channel_info in sorted(final_output_channels_data, key=lambda x: x['chno']):
-        nuevas_lineas.append(channel_info['extinf_line'])
-        nuevas_lineas.append(channel_info['url_line'])
+    incluir_cabecera = bool(output_file_name) or tiene_cabecera
+    final_output_channels_data.sort(key=lambda x: x['chno'])
 
 
     print(f"\n{Colors.BOLD}--- Análisis Completo ---{Colors.RESET}")
@@ -442,46 +2477,596 @@ def procesar_m3u(archivo_m3u, lineas, borrar_automatico=False, timeout=5, epg_da
     print(f"Canales fallidos: {Colors.RED}{len(canales_fallidos)}{Colors.RESET}")
     if epg_data:
         print(f"Canales con tvg-id EPG asignado: {Colors.BLUE}{canales_con_epg_id}{Colors.RESET}")
+        if epg_memo is not None and epg_memo.hits:
+            print("  Emparejamientos tomados de la memoria (sin volver a puntuar): "
+                  f"{Colors.BLUE}{epg_memo.hits}{Colors.RESET}")
     print(f"Canales con tvg-chno asignado: {Colors.BLUE}{canales_con_tvg_chno}{Colors.RESET}")
-
-
-    if canales_fallidos:
+    hosts_cortocircuitados = breaker.tripped_hosts() if breaker is not None else {}
+    if hosts_cortocircuitados:
+        print("Servidores caídos (sus URLs se dieron por fallidas sin esperar el timeout): "
+              f"{Colors.RED}{len(hosts_cortocircuitados)}{Colors.RESET}")
+        for host, cantidad in sorted(hosts_cortocircuitados.items(), key=lambda item: -item[1]):
+            print(f"  - {Colors.BOLD}{host}{Colors.RESET}: {Colors.YELLOW}{cantidad}{Colors.RESET} URLs")
+    if manifiesto is not None:
+        sin_cambios = sum(1 for hash_entrada in hashes_entradas.values() if hash_entrada in entradas_previas)
+        eliminadas = len(set(entradas_previas) - set(hashes_entradas.values()))
+        print(f"Modo incremental: {Colors.GREEN}{sin_cambios} entradas sin cambios{Colors.RESET}, "
+              f"{Colors.YELLOW}{len(hashes_entradas) - sin_cambios} nuevas o modificadas{Colors.RESET}, {eliminadas} "
+              "eliminadas")
+        print(f"  Comprobaciones reutilizadas: {Colors.BLUE}{sondeos_reutilizados}{Colors.RESET}, tvg-id reutilizados: "
+              f"{Colors.BLUE}{epg_reutilizados}{Colors.RESET}")
+    elif incremental:
+        print(f"{Colors.YELLOW}Modo incremental: no hay manifiesto previo válido, se ha procesado la lista "
+              f"completa.{Colors.RESET}")
+    if sondeo_diferido:
+        print("Duplicados sin comprobar (ya había una alternativa que funciona): "
+              f"{Colors.BLUE}{canales_omitidos}{Colors.RESET}")
+    if reanudar:
+        print(f"Comprobaciones recuperadas del diario: {Colors.BLUE}{sondeos_reanudados}{Colors.RESET}")
+    if health_cache is not None:
+        print(f"Caché de comprobaciones: {Colors.GREEN}{cache_aciertos} aciertos{Colors.RESET}, "
+              f"{Colors.YELLOW}{cache_fallos} fallos{Colors.RESET}")
+
+
+    if canales_fallidos and silencioso:
+        print(f"{Colors.YELLOW}Modo silencioso: no se muestra la lista de canales que no funcionan.{Colors.RESET}")
+    elif canales_fallidos:
         print(f"\n{Colors.BOLD}{Colors.UNDERLINE}Canales que no funcionan:{Colors.RESET}")
         for nombre, url in canales_fallidos:
             print(f"- {Colors.BOLD}{nombre}{Colors.RESET}: {Colors.YELLOW}{url}{Colors.RESET}")
 
+    archivo_guardado = None
     if output_file_name:
         try:
-            with open(output_file_name, 'w', encoding='utf-8') as f:
-                f.writelines(nuevas_lineas)
+            with metricas.stage('write_output'):
+                escribir_m3u(output_file_name, incluir_cabecera, non_channel_lines, final_output_channels_data)
+            archivo_guardado = output_file_name
             print(f"{Colors.GREEN}{Colors.BOLD}Nuevo archivo M3U creado con éxito: {output_file_name}{Colors.RESET}")
             if canales_fallidos:
                 print(f"{Colors.YELLOW}Los canales fallidos no se incluyeron en el nuevo archivo.{Colors.RESET}")
         except Exception as e:
+            fallo_escritura = True
             print(f"{Colors.RED}{Colors.BOLD}Error al crear el nuevo archivo:{Colors.RESET} {e}")
     else:
         if canales_fallidos or canales_con_epg_id > 0 or canales_con_tvg_chno > 0:
             if borrar_automatico:
                 try:
-                    with open(archivo_m3u, 'w', encoding='utf-8') as f:
-                        f.writelines(nuevas_lineas)
+                    with metricas.stage('write_output'):
+                        escribir_m3u(archivo_m3u, incluir_cabecera, non_channel_lines, final_output_channels_data)
+                    archivo_guardado = archivo_m3u
                     print(f"{Colors.GREEN}{Colors.BOLD}Los cambios (canales fallidos eliminados, tvg-id/chno asignados) han sido guardados automáticamente en el archivo original.{Colors.RESET}")
                 except Exception as e:
+                    fallo_escritura = True
                     print(f"{Colors.RED}{Colors.BOLD}Error al escribir en el archivo original:{Colors.RESET} {e}")
+            elif not interactivo:
+                print(f"{Colors.YELLOW}No se realizaron cambios en el archivo original (modo no interactivo).{Colors.RESET}")
             else:
                 respuesta = input(f"\n{Colors.BOLD}Se han realizado cambios (asignación de tvg-id/chno y/o eliminación de fallidos). ¿Deseas guardar estos cambios en el archivo .m3u original? (s/n): {Colors.RESET}").lower()
                 if respuesta == 's':
                     try:
-                        with open(archivo_m3u, 'w', encoding='utf-8') as f:
-                            f.writelines(nuevas_lineas)
+                        with metricas.stage('write_output'):
+                            escribir_m3u(archivo_m3u, incluir_cabecera, non_channel_lines, final_output_channels_data)
+                        archivo_guardado = archivo_m3u
                         print(f"{Colors.GREEN}{Colors.BOLD}Los cambios han sido guardados en el archivo original.{Colors.RESET}")
                     except Exception as e:
+                        fallo_escritura = True
                         print(f"{Colors.RED}{Colors.BOLD}Error al escribir en el archivo original:{Colors.RESET} {e}")
                 else:
                     print(f"{Colors.YELLOW}No se realizaron cambios en el archivo original.{Colors.RESET}")
         else:
             print(f"{Colors.GREEN}{Colors.BOLD}Todos los canales parecen funcionar y no se realizaron cambios de tvg-id/chno en el archivo original.{Colors.RESET}")
 
+    if incremental and archivo_guardado:
+        numeros_asignados = {datos['channel']: datos['chno'] for datos in final_output_channels_data}
+        entradas_manifiesto = {}
+        for canal, hash_entrada in hashes_entradas.items():
+            registro = {'nombre': canal.normalized_tvg_name}
+            if canal in comprobado_en:
+                registro.update({
+                    'ok': canal.probe_ok,
+                    'latencia': canal.latency,
+                    'ttfb': canal.ttfb,
+                    'throughput': canal.throughput,
+                    'comprobado': comprobado_en[canal]
+                })
+            if canal in emparejados_epg:
+                registro['epg_id'] = emparejados_epg[canal]
+            if canal in numeros_asignados:
+                registro['chno'] = numeros_asignados[canal]
+            entradas_manifiesto[hash_entrada] = registro
+        with metricas.stage('write_manifest'):
+            guardar_manifiesto(ruta_manifiesto(archivo_guardado), {
+                'version': MANIFEST_VERSION,
+                'probe_method': probe_method,
+                'epg': huella_epg_actual,
+                'generado': time.time(),
+                'entradas': entradas_manifiesto
+            })
+
+    # Guía EPG reducida a los canales de la lista resultante, junto a ella (lista.m3u -> lista.xml.gz)
+    epg_filtrada = None
+    if guias_epg and formato_epg_filtrado and archivo_guardado:
+        ids_canal = set()
+        for datos in final_output_channels_data:
+            canal = datos['channel']
+            tvg_id = canal.epg_id or (dict(canal.attrs).get('tvg-id') if canal.attrs else None)
+            if tvg_id:
+                ids_canal.add(tvg_id)
+        destino_epg = os.path.splitext(archivo_guardado)[0] + '.' + formato_epg_filtrado
+        with metricas.stage('write_filtered_epg'):
+            resultado_epg = escribir_epg_filtrado(guias_epg, ids_canal, destino_epg)
+        if resultado_epg is not None:
+            epg_filtrada = destino_epg
+            print(f"{Colors.GREEN}Guía EPG filtrada guardada en {destino_epg}: {resultado_epg[0]} canales y "
+                  f"{resultado_epg[1]} programas.{Colors.RESET}")
+
+    # El diario se borra solo si se comprobó toda la lista y el resultado se pudo escribir
+    if diario is not None:
+        diario.close(completado=sondeo_completo and not fallo_escritura)
+
+    metricas.count('channels_checked', total_canales)
+    metricas.count('channels_working', canales_ok)
+    metricas.count('channels_failed', len(canales_fallidos))
+    metricas.count('probe_skipped_duplicate', canales_omitidos)
+    metricas.count('health_cache_hit', cache_aciertos)
+    metricas.count('health_cache_miss', cache_fallos)
+    metricas.count('incremental_reused', sondeos_reutilizados)
+    metricas.count('journal_replayed', sondeos_reanudados)
+    metricas.add_stage('total', time.perf_counter() - inicio_proceso)
+
+    return {
+        'archivo': archivo_m3u,
+        'salida': archivo_guardado,
+        'epg_filtrada': epg_filtrada,
+        'comprobados': total_canales,
+        'funcionando': canales_ok,
+        'fallidos': len(canales_fallidos),
+        'con_epg_id': canales_con_epg_id,
+        'con_tvg_chno': canales_con_tvg_chno,
+        'cache_aciertos': cache_aciertos,
+        'cache_fallos': cache_fallos,
+        'sin_comprobar': canales_omitidos,
+        'hosts_cortocircuitados': hosts_cortocircuitados,
+        'sondeos_reutilizados': sondeos_reutilizados,
+        'sondeos_reanudados': sondeos_reanudados
+    }
+
+# Estado compartido por los procesos del modo por lotes: la guía EPG se descarga e indexa una sola
+# vez en el proceso principal y se entrega a cada proceso al arrancar (por fork o serializada)
+_DATOS_LOTE = {}
+
+def _inicializar_worker_lote(epg_data, epg_index, channel_order, guias_epg=None):
+    _DATOS_LOTE['epg_data'] = epg_data
+    # La huella de la guía se calcula una vez por proceso; cada lista abre su memoria de emparejamientos
+    _DATOS_LOTE['huella_memo_epg'] = EpgMatchMemo.fingerprint(epg_data) if epg_data else None
+    _DATOS_LOTE['guias_epg'] = guias_epg
+    _DATOS_LOTE['epg_index'] = epg_index
+    _DATOS_LOTE['channel_order'] = channel_order
+
+def exportar_metricas(metricas, archivo_destino):
+    base = os.path.splitext(archivo_destino)[0]
+    try:
+        metricas.write_json(base + '.metrics.json')
+        metricas.write_prometheus(base + '.prom')
+        print(f"{Colors.BLUE}Métricas guardadas en {base}.metrics.json y {base}.prom{Colors.RESET}")
+    except OSError as e:
+        print(f"{Colors.YELLOW}No se pudieron guardar las métricas: {e}{Colors.RESET}")
+
+def _procesar_lista_lote(archivo_m3u, output_file_name, opciones):
+    base_salida = os.path.splitext(output_file_name)[0]
+    ruta_log = base_salida + '.log'
+    metricas = RunMetrics(nombre_lista(archivo_m3u))
+    try:
+        with open(ruta_log, 'w', encoding='utf-8') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            health_cache = StreamHealthCache() if opciones['use_health_cache'] else None
+            epg_memo = None
+            if _DATOS_LOTE['epg_data']:
+                epg_memo = abrir_memo_epg(_DATOS_LOTE['epg_data'], _DATOS_LOTE['huella_memo_epg'])
+            try:
+                print(f"{Colors.YELLOW}Leyendo el archivo: {Colors.BOLD}{archivo_m3u}{Colors.RESET}")
+                opciones_proceso = {clave: opciones[clave] for clave in PROCESS_DEFAULT_OPTIONS if clave in opciones}
+                opciones_proceso.update({
+                    'health_cache': health_cache, 'epg_index': _DATOS_LOTE['epg_index'],
+                    'channel_order': _DATOS_LOTE['channel_order'], 'interactive': False, 'run_metrics': metricas,
+                    'epg_guides': _DATOS_LOTE['guias_epg'], 'epg_memo': epg_memo
+                })
+                resumen = procesar_m3u(
+                    archivo_m3u, iterar_m3u(archivo_m3u), False, opciones['timeout'], _DATOS_LOTE['epg_data'],
+                    output_file_name, opciones['start_channel_number'], opciones['duplicate_handling'], opciones_proceso
+                )
+                if opciones['metrics']:
+                    exportar_metricas(metricas, output_file_name)
+            finally:
+                if health_cache is not None:
+                    health_cache.close()
+                if epg_memo is not None:
+                    epg_memo.close()
+    except SystemExit:
+        resumen = {'archivo': archivo_m3u, 'salida': None, 'error': f"proceso abortado, consulta {ruta_log}"}
+    except Exception as e:
+        resumen = {'archivo': archivo_m3u, 'salida': None, 'error': str(e)}
+
+    resumen['log'] = ruta_log
+    try:
+        with escritura_atomica(base_salida + '.resumen.json') as f:
+            json.dump(resumen, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        resumen.setdefault('error', f"no se pudo guardar el resumen: {e}")
+    return resumen
+
+def procesar_lote(archivos_m3u, output_dir, opciones, procesos=None):
+    epg_data, epg_index = None, None
+    if opciones.get('epg_url'):
+        epg_data, epg_index = cargar_epgs(opciones['epg_url'])
+        if not epg_data:
+            print(f"{Colors.RED}No se pudo cargar la guía EPG. Continuando sin asignación de tvg-id.{Colors.RESET}")
+    # La guía completa también se descarga una sola vez; cada proceso la filtra para su lista
+    guias_epg = descargar_guias_epg(opciones['epg_url']) if opciones.get('epg_url') and opciones.get('filtered_epg') else None
+    channel_order = cargar_perfil_orden(opciones['channel_order_file']) if opciones.get('channel_order_file') else None
+
+    os.makedirs(output_dir, exist_ok=True)
+    procesos = max(1, procesos or min(len(archivos_m3u), os.cpu_count() or 1))
+    print(f"\n{Colors.BOLD}Procesando {len(archivos_m3u)} listas con {procesos} procesos (salida en "
+          f"'{output_dir}')...{Colors.RESET}")
+
+    resumenes = []
+    nombres_usados = set()
+    with ProcessPoolExecutor(max_workers=procesos, initializer=_inicializar_worker_lote,
+                             initargs=(epg_data, epg_index, channel_order, guias_epg)) as executor:
+        futuros = {}
+        for archivo_m3u in archivos_m3u:
+            nombre, extension = os.path.splitext(nombre_lista(archivo_m3u))
+            nombre_salida = nombre
+            sufijo = 2
+            while nombre_salida in nombres_usados:
+                nombre_salida = f"{nombre}_{sufijo}"
+                sufijo += 1
+            nombres_usados.add(nombre_salida)
+            output_file_name = os.path.join(output_dir, nombre_salida + (extension or '.m3u'))
+            futuros[executor.submit(_procesar_lista_lote, archivo_m3u, output_file_name, opciones)] = archivo_m3u
+
+        for futuro in as_completed(futuros):
+            resumen = futuro.result()
+            resumenes.append(resumen)
+            if resumen.get('error') or not resumen.get('salida'):
+                print(f"  {Colors.RED}FALLO{Colors.RESET} {Colors.BOLD}{resumen['archivo']}{Colors.RESET}: "
+                      f"{resumen.get('error', 'no se generó la salida')} ({resumen['log']})")
+            else:
+                print(f"  {Colors.GREEN}OK{Colors.RESET} {Colors.BOLD}{resumen['archivo']}{Colors.RESET} -> "
+                      f"{resumen['salida']}: {resumen['funcionando']} canales, {resumen['fallidos']} fallidos, "
+                      f"{resumen['con_epg_id']} con tvg-id")
+
+    return resumenes
+
+def _recurso_servido(cuerpo, content_type, modificado, comprimir=True):
+    # Se comprime una sola vez por actualización; el ETag depende del contenido, así que si una
+    # actualización produce la misma lista los reproductores siguen recibiendo 304
+    huella = hashlib.sha1(cuerpo).hexdigest()[:20]
+    return {
+        'cuerpo': cuerpo,
+        'gzip': gzip.compress(cuerpo, SERVE_GZIP_LEVEL, mtime=0) if comprimir else None,
+        'etag': f'"{huella}"',
+        'etag_gzip': f'"{huella}-gz"',
+        'content_type': content_type,
+        'last_modified': formatdate(modificado, usegmt=True)
+    }
+
+class _PlaylistServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "m3u_processor"
+
+    def _responder(self, con_cuerpo):
+        ruta = unquote(urlsplit(self.path).path)
+        if ruta == '/status':
+            estado = json.dumps(self.server.status, ensure_ascii=False, indent=2).encode('utf-8')
+            recurso = _recurso_servido(estado, SERVE_CONTENT_TYPES['.json'], time.time())
+        else:
+            # Una sola lectura del diccionario: la actualización lo sustituye entero, nunca lo modifica
+            recurso = self.server.files.get(ruta)
+        if recurso is None:
+            # Mientras no termina la primera actualización no hay nada que servir
+            listo = bool(self.server.files)
+            self.send_response(404 if listo else 503)
+            if not listo:
+                self.send_header('Retry-After', str(SERVE_RETRY_AFTER))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        usar_gzip = recurso['gzip'] is not None and 'gzip' in self.headers.get('Accept-Encoding', '').lower()
+        etag = recurso['etag_gzip'] if usar_gzip else recurso['etag']
+        etags_cliente = [valor.strip() for valor in self.headers.get('If-None-Match', '').split(',')]
+        if '*' in etags_cliente or recurso['etag'] in etags_cliente or recurso['etag_gzip'] in etags_cliente:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        cuerpo = recurso['gzip'] if usar_gzip else recurso['cuerpo']
+        self.send_response(200)
+        self.send_header('Content-Type', recurso['content_type'])
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', recurso['last_modified'])
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if usar_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if con_cuerpo:
+            self.wfile.write(cuerpo)
+
+    def do_GET(self):
+        self._responder(True)
+
+    def do_HEAD(self):
+        self._responder(False)
+
+    def log_message(self, format, *args):
+        pass
+
+class PlaylistServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host, port):
+        super().__init__((host, port), _PlaylistServerHandler)
+        self.files = {}
+        self.status = {'estado': 'iniciando', 'ultima_actualizacion': None, 'listas': {}}
+
+    def publish(self, files, status):
+        # Cambio atómico: cada petición ve la versión anterior completa o la nueva completa
+        self.files = files
+        self.status = status
+
+    def handle_error(self, request, client_address):
+        # Los reproductores cortan las descargas a medias: no es un error del servidor
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+def actualizar_listas_servidas(servidor, archivos_m3u, opciones):
+    inicio = time.time()
+    inicio_etapa = time.perf_counter()
+    try:
+        resumenes = procesar_lote(archivos_m3u, opciones['output_dir'], opciones, opciones['processes'])
+        error = None
+    except Exception as e:
+        resumenes = []
+        error = str(e)
+        print(f"{Colors.RED}Error al actualizar las listas: {e}{Colors.RESET}")
+
+    # Se parte de lo publicado: si una lista falla se sigue sirviendo su última versión correcta
+    archivos = dict(servidor.files)
+    listas = {archivo: dict(datos) for archivo, datos in servidor.status['listas'].items()}
+    for resumen in resumenes:
+        datos = listas.setdefault(resumen['archivo'], {})
+        datos['error'] = resumen.get('error') or (None if resumen.get('salida') else 'no se generó la salida')
+        if datos['error']:
+            continue
+        # La lista y, si se ha generado, su guía EPG filtrada
+        recursos = {}
+        try:
+            for clave in ('salida', 'epg_filtrada'):
+                if resumen.get(clave):
+                    with open(resumen[clave], 'rb') as f:
+                        cuerpo = f.read()
+                    ruta = '/' + os.path.basename(resumen[clave])
+                    extension = os.path.splitext(ruta)[1].lower()
+                    # Las guías .xml.gz ya van comprimidas: se sirven tal cual
+                    tipo = SERVE_CONTENT_TYPES.get(extension, SERVE_CONTENT_TYPES['.m3u'])
+                    recursos[clave] = (ruta, _recurso_servido(cuerpo, tipo, inicio, comprimir=extension != '.gz'))
+        except OSError as e:
+            datos['error'] = str(e)
+            continue
+        for ruta, recurso in recursos.values():
+            archivos[ruta] = recurso
+        datos.update({'url': quote(recursos['salida'][0]), 'actualizada': inicio, 'funcionando': resumen.get('funcionando'),
+                      'fallidos': resumen.get('fallidos'), 'con_epg_id': resumen.get('con_epg_id')})
+        if 'epg_filtrada' in recursos:
+            datos['url_epg'] = quote(recursos['epg_filtrada'][0])
+
+    rutas_listas = sorted(datos['url'] for datos in listas.values() if datos.get('url'))
+    rutas_epg = sorted(datos['url_epg'] for datos in listas.values() if datos.get('url_epg'))
+    if len(rutas_listas) == 1:
+        archivos['/playlist.m3u'] = archivos[unquote(rutas_listas[0])]
+        if len(rutas_epg) == 1:
+            # lista.m3u -> lista.xml.gz: también en /epg.xml.gz
+            ruta_epg = unquote(rutas_epg[0])
+            archivos['/epg' + ruta_epg[len(os.path.splitext(unquote(rutas_listas[0]))[0]):]] = archivos[ruta_epg]
+    rutas_listas += rutas_epg
+    if rutas_listas:
+        indice = "".join(f"{ruta}\n" for ruta in rutas_listas).encode('utf-8')
+        archivos['/'] = _recurso_servido(indice, 'text/plain; charset=utf-8', inicio)
+
+    duracion = time.perf_counter() - inicio_etapa
+    servidor.publish(archivos, {
+        'estado': 'error' if error else 'ok',
+        'error': error,
+        'ultima_actualizacion': inicio,
+        'duracion_actualizacion': round(duracion, 1),
+        'proxima_actualizacion': time.time() + opciones['refresh_interval'],
+        'listas': listas
+    })
+    print(f"{Colors.BLUE}Listas actualizadas en {duracion:.1f}s. Próxima actualización en "
+          f"{opciones['refresh_interval']}s.{Colors.RESET}")
+
+def servir_listas(archivos_m3u, opciones):
+    # Las listas se procesan en segundo plano cada 'refresh_interval' segundos; las peticiones siempre
+    # se responden desde memoria con la última versión publicada y nunca esperan a las comprobaciones
+    servidor = PlaylistServer(opciones['serve_host'], opciones['serve_port'])
+    parar = threading.Event()
+
+    def actualizar_periodicamente():
+        while not parar.is_set():
+            actualizar_listas_servidas(servidor, archivos_m3u, opciones)
+            parar.wait(opciones['refresh_interval'])
+
+    threading.Thread(target=actualizar_periodicamente, daemon=True).start()
+    host, port = servidor.server_address[:2]
+    print(f"{Colors.GREEN}{Colors.BOLD}Sirviendo las listas en http://{host}:{port}/ (estado en /status). Ctrl+C para "
+          f"detener.{Colors.RESET}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{Colors.YELLOW}Deteniendo el servidor...{Colors.RESET}")
+    finally:
+        parar.set()
+        servidor.server_close()
+    return 0
+
+def _valores_limite_host(texto):
+    # 'CONEXIONES[/PETICIONES_POR_SEGUNDO]'; 0 desactiva el límite
+    conexiones, _, ritmo = texto.partition('/')
+    try:
+        valores = {'max_concurrent': int(conexiones) or None}
+        if ritmo:
+            valores['rate'] = float(ritmo) or None
+    except ValueError:
+        raise ValueError(f"'{texto}' no tiene el formato CONEXIONES[/PETICIONES_POR_SEGUNDO]")
+    if validar_limites_host({'*': valores}):
+        raise ValueError(f"'{texto}': las conexiones y las peticiones por segundo deben ser números positivos (0 = sin "
+                         "límite)")
+    return valores
+
+def validar_limites_host(limites):
+    # Devuelve un mensaje con el primer límite no válido de {patrón: {límite: valor}} o None si todos valen.
+    # Un límite negativo dejaría los canales de su servidor en cola para siempre.
+    if not isinstance(limites, dict):
+        return "los límites por servidor deben ser un objeto {patrón: {límite: valor}}"
+    for patron, valores in limites.items():
+        if not isinstance(valores, dict):
+            return f"los límites de '{patron}' deben ser un objeto con max_concurrent, rate y/o burst"
+        desconocidos = set(valores) - {'max_concurrent', 'rate', 'burst'}
+        if desconocidos:
+            return f"límites desconocidos para '{patron}': {', '.join(sorted(desconocidos))}"
+        for clave, valor in valores.items():
+            if valor is None:
+                continue
+            if isinstance(valor, bool) or not isinstance(valor, (int, float)) or not math.isfinite(valor) or valor < 0:
+                return f"'{clave}' de '{patron}' debe ser un número positivo, 0 o null (sin límite)"
+            if clave == 'max_concurrent' and valor != int(valor):
+                return f"'max_concurrent' de '{patron}' debe ser un número entero"
+            if clave == 'burst' and 0 < valor < 1:
+                return f"'burst' de '{patron}' debe ser al menos 1"
+    return None
+
+def texto_limite_host(valores):
+    if not valores or not any(valores.values()):
+        return 'Sin límite'
+    conexiones = f"{valores['max_concurrent']} conexiones" if valores.get('max_concurrent') else 'sin límite de conexiones'
+    return conexiones + (f", {valores['rate']:g}/s" if valores.get('rate') else '')
+
+def _limite_host(texto):
+    # 'PATRÓN=CONEXIONES[/PETICIONES_POR_SEGUNDO]'
+    patron, separador, limites = texto.partition('=')
+    if not patron or not separador:
+        raise argparse.ArgumentTypeError(f"'{texto}' no tiene el formato PATRÓN=CONEXIONES[/PETICIONES_POR_SEGUNDO]")
+    try:
+        return patron, _valores_limite_host(limites)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def ejecutar_cli(argv):
+    parser = argparse.ArgumentParser(
+        prog='m3u_processor.py',
+        description="Procesa una o varias listas M3U sin menú interactivo. Sin argumentos se abre el menú."
+    )
+    parser.add_argument('inputs', nargs='*', metavar='LISTA',
+                        help="Listas M3U de entrada: rutas (admite comodines, ej. 'clientes/*.m3u') o URLs http/https")
+    parser.add_argument('-c', '--config',
+                        help="Archivo JSON con las opciones; los argumentos de la línea de comandos tienen prioridad")
+    parser.add_argument('-o', '--output-dir', help="Carpeta donde se guardan las listas procesadas, sus registros y resúmenes")
+    parser.add_argument('-p', '--processes', type=int, help="Número de listas que se procesan en paralelo")
+    parser.add_argument('--timeout', type=int, help="Tiempo de espera por canal en segundos")
+    parser.add_argument('--workers', type=int, dest='max_workers', help="Conexiones simultáneas por lista")
+    parser.add_argument('--probe-method', choices=PROBE_METHODS, help="Método de comprobación de canales")
+    parser.add_argument('--duplicates', choices=('all', 'quality', 'first', 'fastest'), dest='duplicate_handling',
+                        help="Manejo de canales duplicados")
+    parser.add_argument('--start', type=int, dest='start_channel_number', help="Número inicial de canal")
+    parser.add_argument('--order-profile', dest='channel_order_file', help="Perfil de orden de canales (.json o .csv)")
+    parser.add_argument('--health-cache', action='store_const', const=True, dest='use_health_cache',
+                        help="Usar la caché de comprobaciones")
+    parser.add_argument('--lazy-probe', action=argparse.BooleanOptionalAction, default=None, dest='lazy_probe',
+                        help="Con --duplicates first/quality, comprobar cada grupo de duplicados solo hasta encontrar "
+                             "uno que funcione")
+    parser.add_argument('--fuzzy-duplicates', action='store_const', const=True,
+                        help="Con --duplicates first/quality/fastest, tratar también como duplicados los nombres "
+                             "parecidos (ej. 'Movistar LaLiga' y 'M+ LaLiga 1080 (backup)')")
+    parser.add_argument('--incremental', action='store_const', const=True,
+                        help="Reutilizar los resultados de la ejecución anterior para las entradas sin cambios")
+    parser.add_argument('--resume', action='store_const', const=True,
+                        help="Reanudar desde el diario de una ejecución interrumpida sin volver a comprobar lo ya comprobado")
+    parser.add_argument('-q', '--quiet', action='store_const', const=True,
+                        help="No escribir una línea por canal (recomendado en listas muy grandes)")
+    parser.add_argument('--metrics', action='store_const', const=True,
+                        help="Guardar métricas de cada lista en JSON (.metrics.json) y formato Prometheus (.prom)")
+    parser.add_argument('--filtered-epg', choices=EPG_FILTERED_FORMATS,
+                        help="Generar junto a cada lista una guía EPG con solo sus canales (xml o xml.gz)")
+    parser.add_argument('--serve', action='store_const', const=True,
+                        help="Modo servidor: servir por HTTP las listas procesadas y actualizarlas periódicamente en "
+                             "segundo plano")
+    parser.add_argument('--host', dest='serve_host', help="Dirección en la que escucha el modo servidor")
+    parser.add_argument('--port', type=int, dest='serve_port', help="Puerto del modo servidor")
+    parser.add_argument('--refresh', type=int, dest='refresh_interval',
+                        help="Segundos entre actualizaciones en el modo servidor")
+    parser.add_argument('--host-limit', action='append', type=_limite_host, metavar='PATRÓN=CONEXIONES[/POR_SEGUNDO]',
+                        help="Límite de conexiones simultáneas y peticiones por segundo para los servidores que "
+                             "coinciden con el patrón (ej. '*.panel.com=2/1'); se puede repetir")
+    parser.add_argument('--no-host-breaker', action='store_const', const=False, dest='host_breaker',
+                        help="Comprobar todas las URLs aunque su servidor no responda (sin cortocircuito de servidores "
+                             "caídos)")
+    parser.add_argument('--epg-url', action='append',
+                        help="URL de la guía EPG; se puede repetir para combinar varias (la primera tiene prioridad)")
+    parser.add_argument('--no-epg', action='store_true', help="No descargar la guía EPG")
+    args = parser.parse_args(argv)
+
+    opciones = dict(BATCH_DEFAULT_OPTIONS)
+    if args.config:
+        try:
+            with open(args.config, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f"no se pudo leer el archivo de configuración '{args.config}': {e}")
+        desconocidas = set(config) - set(opciones)
+        if desconocidas:
+            parser.error(f"opciones desconocidas en '{args.config}': {', '.join(sorted(desconocidas))}")
+        opciones.update(config)
+
+    for clave, valor in vars(args).items():
+        if clave in opciones and clave != 'inputs' and valor is not None:
+            opciones[clave] = valor
+    if args.no_epg:
+        opciones['epg_url'] = None
+    if opciones['host_limits'] is not None:
+        error = validar_limites_host(opciones['host_limits'])
+        if error:
+            parser.error(f"opción host_limits: {error}")
+    if args.host_limit:
+        # Los límites de la línea de comandos van antes que los del archivo de configuración
+        limites_host = dict(args.host_limit)
+        for patron, valores in (opciones['host_limits'] or {}).items():
+            limites_host.setdefault(patron, valores)
+        opciones['host_limits'] = limites_host
+
+    archivos_m3u = []
+    for patron in (args.inputs or opciones['inputs']):
+        # Las URLs se leen tal cual: sus '?' no son comodines
+        if es_lista_remota(patron):
+            archivos_m3u.append(patron)
+            continue
+        coincidencias = sorted(glob.glob(patron)) if glob.has_magic(patron) else [patron]
+        archivos_m3u.extend(coincidencias)
+    if not archivos_m3u:
+        parser.error("no se ha indicado ninguna lista M3U de entrada")
+    for archivo_m3u in archivos_m3u:
+        if not es_lista_remota(archivo_m3u) and not os.path.isfile(archivo_m3u):
+            parser.error(f"el archivo '{archivo_m3u}' no existe")
+
+    if opciones['serve']:
+        return servir_listas(archivos_m3u, opciones)
+    resumenes = procesar_lote(archivos_m3u, opciones['output_dir'], opciones, opciones['processes'])
+    return 0 if all(resumen.get('salida') and not resumen.get('error') for resumen in resumenes) else 1
+
 def display_menu():
     options = {
         'timeout': 5,
@@ -489,14 +3074,35 @@ def display_menu():
         'start_channel_number': 1,
         'auto_borrar': False,
         'input_m3u_file': None,
-        'duplicate_handling': 'all'
+        'duplicate_handling': 'all',
+        'max_workers': DEFAULT_MAX_WORKERS,
+        'probe_method': DEFAULT_PROBE_METHOD,
+        'use_health_cache': False,
+        'channel_order_file': None,
+        'lazy_probe': False,
+        'fuzzy_duplicates': False,
+        'incremental': False,
+        'quiet': False,
+        'metrics': False,
+        'filtered_epg': None,
+        'host_limit': None,
+        'host_breaker': True
     }
 
     # Diccionario para mapear los valores de 'duplicate_handling' a texto legible
     duplicate_display_names = {
         'all': 'Mantener todos',
         'quality': 'Priorizar calidad',
-        'first': 'Mantener el primero'
+        'first': 'Mantener el primero',
+        'fastest': 'Priorizar el más rápido'
+    }
+
+    probe_method_display_names = {
+        'auto': 'Automático (HEAD + GET parcial)',
+        'head': 'HEAD',
+        'range': 'GET parcial',
+        'get': 'GET completo',
+        'throughput': 'Medir velocidad'
     }
 
     while True:
@@ -506,20 +3112,51 @@ def display_menu():
         print(f"{Colors.MAGENTA}{Colors.BOLD}╔═════════════════════════════════════════════════════════╗{Colors.RESET}")
         print(f"{Colors.MAGENTA}║ {Colors.CYAN}{Colors.BOLD}         M3U PROCESSOR - Configuración         {Colors.RESET} {Colors.MAGENTA}║{Colors.RESET}")
         print(f"{Colors.MAGENTA}╠═════════════════════════════════════════════════════════╣{Colors.RESET}")
-        
+
         print(f"{Colors.MAGENTA}║ {Colors.YELLOW}1.{Colors.RESET} Archivo M3U de entrada: {Colors.BOLD}{options['input_m3u_file'] if options['input_m3u_file'] else 'NO ESPECIFICADO':<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
         print(f"{Colors.MAGENTA}║ {Colors.YELLOW}2.{Colors.RESET} Tiempo de espera (segundos): {Colors.BOLD}{options['timeout']:<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
         print(f"{Colors.MAGENTA}║ {Colors.YELLOW}3.{Colors.RESET} Nombre del archivo M3U de salida: {Colors.BOLD}{options['output_file_name'] if options['output_file_name'] else 'Modificar original':<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
         print(f"{Colors.MAGENTA}║ {Colors.YELLOW}4.{Colors.RESET} Número inicial de canal: {Colors.BOLD}{options['start_channel_number']:<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
         print(f"{Colors.MAGENTA}║ {Colors.YELLOW}5.{Colors.RESET} Borrar canales fallidos automáticamente: {Colors.BOLD}{'Sí' if options['auto_borrar'] else 'No':<20}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
-        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}6.{Colors.RESET} Manejo de canales duplicados: {Colors.BOLD}{duplicate_display_names.get(options['duplicate_handling'], 'Desconocido'):<20}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
-        
+        texto_duplicados = duplicate_display_names.get(options['duplicate_handling'], 'Desconocido')
+        if options['fuzzy_duplicates'] and options['duplicate_handling'] != 'all':
+            texto_duplicados += ' + parecidos'
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}6.{Colors.RESET} Manejo de canales duplicados: "
+              f"{Colors.BOLD}{texto_duplicados:<20}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}7.{Colors.RESET} Conexiones simultáneas: "
+              f"{Colors.BOLD}{options['max_workers']:<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        texto_metodo = probe_method_display_names.get(options['probe_method'], 'Desconocido')
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}8.{Colors.RESET} Método de comprobación: "
+              f"{Colors.BOLD}{texto_metodo:<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}9.{Colors.RESET} Usar caché de comprobaciones: "
+              f"{Colors.BOLD}{'Sí' if options['use_health_cache'] else 'No':<20}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        texto_perfil = options['channel_order_file'] or 'Integrado (España)'
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}10.{Colors.RESET} Perfil de orden de canales: "
+              f"{Colors.BOLD}{texto_perfil:<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}11.{Colors.RESET} Comprobar duplicados solo hasta uno válido: "
+              f"{Colors.BOLD}{'Sí' if options['lazy_probe'] else 'No':<10}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}12.{Colors.RESET} Modo incremental: "
+              f"{Colors.BOLD}{'Sí' if options['incremental'] else 'No':<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}13.{Colors.RESET} Modo silencioso: "
+              f"{Colors.BOLD}{'Sí' if options['quiet'] else 'No':<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}14.{Colors.RESET} Exportar métricas: "
+              f"{Colors.BOLD}{'Sí' if options['metrics'] else 'No':<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        texto_epg_filtrada = '.' + options['filtered_epg'] if options['filtered_epg'] else 'No'
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}15.{Colors.RESET} Guía EPG filtrada: "
+              f"{Colors.BOLD}{texto_epg_filtrada:<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}16.{Colors.RESET} Límite por servidor: "
+              f"{Colors.BOLD}{texto_limite_host(options['host_limit']):<30}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.YELLOW}17.{Colors.RESET} Cortocircuito de servidores caídos: "
+              f"{Colors.BOLD}{'Sí' if options['host_breaker'] else 'No':<20}{Colors.RESET}{Colors.MAGENTA}║{Colors.RESET}")
+
         print(f"{Colors.MAGENTA}╠═════════════════════════════════════════════════════════╣{Colors.RESET}")
-        print(f"{Colors.MAGENTA}║ {Colors.GREEN}7.{Colors.RESET} {Colors.BOLD}Iniciar procesamiento{Colors.RESET}                                      {Colors.MAGENTA}║{Colors.RESET}")
-        print(f"{Colors.RED}8.{Colors.RESET} {Colors.BOLD}Salir{Colors.RESET}                                                      {Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.MAGENTA}║ {Colors.GREEN}18.{Colors.RESET} {Colors.BOLD}Iniciar procesamiento{Colors.RESET}"
+              f"                                      {Colors.MAGENTA}║{Colors.RESET}")
+        print(f"{Colors.RED}19.{Colors.RESET} {Colors.BOLD}Salir{Colors.RESET}"
+              f"                                                      {Colors.MAGENTA}║{Colors.RESET}")
         print(f"{Colors.MAGENTA}╚═════════════════════════════════════════════════════════╝{Colors.RESET}")
 
-        choice = input(f"{Colors.BOLD}Selecciona una opción (1-8): {Colors.RESET}").strip()
+        choice = input(f"{Colors.BOLD}Selecciona una opción (1-19): {Colors.RESET}").strip()
 
         if choice == '1':
             m3u_files = [f for f in os.listdir('.') if f.lower().endswith('.m3u')]
@@ -532,12 +3169,13 @@ def display_menu():
                     print(f"{Colors.MAGENTA}║  {Colors.YELLOW}{idx + 1}.{Colors.RESET} {f_name:<52}{Colors.MAGENTA}║{Colors.RESET}")
                 print(f"{Colors.MAGENTA}║  {Colors.YELLOW}0.{Colors.RESET} Introducir ruta manualmente (si no está en la lista){Colors.RESET} {Colors.MAGENTA}║{Colors.RESET}")
                 print(f"{Colors.MAGENTA}╚═════════════════════════════════════════════════════════╝{Colors.RESET}")
-                
+
                 while True:
                     file_choice = input(f"{Colors.YELLOW}Selecciona un número o '0' para ruta manual: {Colors.RESET}").strip()
                     if file_choice == '0':
-                        file_path = input(f"{Colors.YELLOW}Introduce la ruta completa al archivo M3U de entrada: {Colors.RESET}").strip()
-                        if os.path.exists(file_path) and file_path.lower().endswith('.m3u'):
+                        file_path = input(f"{Colors.YELLOW}Introduce la ruta completa al archivo M3U de entrada o su "
+                                          f"URL: {Colors.RESET}").strip()
+                        if es_lista_remota(file_path) or (os.path.exists(file_path) and file_path.lower().endswith('.m3u')):
                             options['input_m3u_file'] = file_path
                             break
                         else:
@@ -558,13 +3196,14 @@ def display_menu():
                 print(f"{Colors.MAGENTA}║ {Colors.YELLOW}No se encontraron archivos .m3u en la carpeta actual.{Colors.RESET} {Colors.MAGENTA}║{Colors.RESET}")
                 print(f"{Colors.MAGENTA}╚═════════════════════════════════════════════════════════╝{Colors.RESET}")
                 while True:
-                    file_path = input(f"{Colors.YELLOW}Introduce la ruta completa al archivo M3U de entrada manualmente: {Colors.RESET}").strip()
-                    if os.path.exists(file_path) and file_path.lower().endswith('.m3u'):
+                    file_path = input(f"{Colors.YELLOW}Introduce la ruta completa al archivo M3U de entrada "
+                                      f"manualmente o su URL: {Colors.RESET}").strip()
+                    if es_lista_remota(file_path) or (os.path.exists(file_path) and file_path.lower().endswith('.m3u')):
                         options['input_m3u_file'] = file_path
                         break
                     else:
                         print(f"{Colors.RED}Ruta de archivo no válida o no es un archivo .m3u. Inténtalo de nuevo.{Colors.RESET}")
-            
+
         elif choice == '2':
             while True:
                 try:
@@ -577,7 +3216,7 @@ def display_menu():
                         print(f"{Colors.RED}El tiempo de espera debe ser un número positivo.{Colors.RESET}")
                 except ValueError:
                     print(f"{Colors.RED}Entrada no válida. Por favor, introduce un número entero.{Colors.RESET}")
-        
+
         elif choice == '3':
             output_name = input(f"{Colors.YELLOW}Introduce el nombre del nuevo archivo M3U (deja en blanco para modificar el original): {Colors.RESET}").strip()
             if output_name:
@@ -586,7 +3225,7 @@ def display_menu():
                 options['output_file_name'] = output_name
             else:
                 options['output_file_name'] = None
-        
+
         elif choice == '4':
             while True:
                 try:
@@ -599,7 +3238,7 @@ def display_menu():
                         print(f"{Colors.RED}El número inicial debe ser un número no negativo.{Colors.RESET}")
                 except ValueError:
                     print(f"{Colors.RED}Entrada no válida. Por favor, introduce un número entero.{Colors.RESET}")
-        
+
         elif choice == '5':
             auto_delete_choice = input(f"{Colors.YELLOW}¿Borrar automáticamente los canales fallidos? (s/n): {Colors.RESET}").strip().lower()
             options['auto_borrar'] = (auto_delete_choice == 's')
@@ -612,9 +3251,11 @@ def display_menu():
             print(f"{Colors.MAGENTA}║  {Colors.YELLOW}1.{Colors.RESET} Mantener todos los duplicados                                {Colors.MAGENTA}║{Colors.RESET}")
             print(f"{Colors.MAGENTA}║  {Colors.YELLOW}2.{Colors.RESET} Priorizar calidad (UHD > FHD > HD > SD)                    {Colors.MAGENTA}║{Colors.RESET}")
             print(f"{Colors.MAGENTA}║  {Colors.YELLOW}3.{Colors.RESET} Mantener el primero encontrado                             {Colors.MAGENTA}║{Colors.RESET}")
+            print(f"{Colors.MAGENTA}║  {Colors.YELLOW}4.{Colors.RESET} Priorizar el más rápido (velocidad "
+                  f"medida)                 {Colors.MAGENTA}║{Colors.RESET}")
             print(f"{Colors.MAGENTA}╚═════════════════════════════════════════════════════════╝{Colors.RESET}")
             while True:
-                dup_choice = input(f"{Colors.YELLOW}Tu elección (1-3): {Colors.RESET}").strip()
+                dup_choice = input(f"{Colors.YELLOW}Tu elección (1-4): {Colors.RESET}").strip()
                 if dup_choice == '1':
                     options['duplicate_handling'] = 'all'
                     break
@@ -624,24 +3265,139 @@ def display_menu():
                 elif dup_choice == '3':
                     options['duplicate_handling'] = 'first'
                     break
+                elif dup_choice == '4':
+                    options['duplicate_handling'] = 'fastest'
+                    break
                 else:
-                    print(f"{Colors.RED}Opción no válida. Por favor, introduce 1, 2 o 3.{Colors.RESET}")
-        
+                    print(f"{Colors.RED}Opción no válida. Por favor, introduce 1, 2, 3 o 4.{Colors.RESET}")
+            if options['duplicate_handling'] != 'all':
+                fuzzy_choice = input(f"{Colors.YELLOW}¿Tratar también como duplicados los nombres parecidos (ej. "
+                                     f"'Movistar LaLiga' y 'M+ LaLiga 1080 (backup)')? (s/n): {Colors.RESET}").strip().lower()
+                options['fuzzy_duplicates'] = (fuzzy_choice == 's')
+
         elif choice == '7':
+            while True:
+                try:
+                    workers_str = input(f"{Colors.YELLOW}Introduce el número de conexiones simultáneas (ej. "
+                                        f"{DEFAULT_MAX_WORKERS}): {Colors.RESET}").strip()
+                    workers_val = int(workers_str)
+                    if workers_val > 0:
+                        options['max_workers'] = workers_val
+                        break
+                    else:
+                        print(f"{Colors.RED}El número de conexiones debe ser un número positivo.{Colors.RESET}")
+                except ValueError:
+                    print(f"{Colors.RED}Entrada no válida. Por favor, introduce un número entero.{Colors.RESET}")
+
+        elif choice == '8':
+            os.system('cls' if os.name == 'nt' else 'clear')
+            print(f"{Colors.MAGENTA}{Colors.BOLD}╔═════════════════════════════════════════════════════════╗{Colors.RESET}")
+            print(f"{Colors.MAGENTA}║ {Colors.BLUE}Selecciona el método de comprobación de canales:{Colors.RESET} "
+                  f"{Colors.MAGENTA}║{Colors.RESET}")
+            print(f"{Colors.MAGENTA}╠═════════════════════════════════════════════════════════╣{Colors.RESET}")
+            print(f"{Colors.MAGENTA}║  {Colors.YELLOW}1.{Colors.RESET} Automático (HEAD y, si falla, GET "
+                  f"parcial)                 {Colors.MAGENTA}║{Colors.RESET}")
+            print(f"{Colors.MAGENTA}║  {Colors.YELLOW}2.{Colors.RESET} Solo "
+                  f"HEAD                                                  {Colors.MAGENTA}║{Colors.RESET}")
+            print(f"{Colors.MAGENTA}║  {Colors.YELLOW}3.{Colors.RESET} GET parcial (primeros {PROBE_RANGE_BYTES} "
+                  f"bytes)                        {Colors.MAGENTA}║{Colors.RESET}")
+            print(f"{Colors.MAGENTA}║  {Colors.YELLOW}4.{Colors.RESET} GET completo (comportamiento "
+                  f"clásico)                      {Colors.MAGENTA}║{Colors.RESET}")
+            print(f"{Colors.MAGENTA}║  {Colors.YELLOW}5.{Colors.RESET} Medir velocidad (tiempo de respuesta y "
+                  f"caudal)             {Colors.MAGENTA}║{Colors.RESET}")
+            print(f"{Colors.MAGENTA}╚═════════════════════════════════════════════════════════╝{Colors.RESET}")
+            while True:
+                method_choice = input(f"{Colors.YELLOW}Tu elección (1-5): {Colors.RESET}").strip()
+                if method_choice in ('1', '2', '3', '4', '5'):
+                    options['probe_method'] = PROBE_METHODS[int(method_choice) - 1]
+                    break
+                else:
+                    print(f"{Colors.RED}Opción no válida. Por favor, introduce un número del 1 al 5.{Colors.RESET}")
+
+        elif choice == '9':
+            cache_choice = input(f"{Colors.YELLOW}¿Reutilizar los resultados recientes guardados en "
+                                 f"'{HEALTH_CACHE_FILE}'? (s/n): {Colors.RESET}").strip().lower()
+            options['use_health_cache'] = (cache_choice == 's')
+
+        elif choice == '10':
+            while True:
+                profile_path = input(f"{Colors.YELLOW}Introduce la ruta del perfil de orden (.json o .csv; deja en "
+                                     f"blanco para usar el integrado): {Colors.RESET}").strip()
+                if not profile_path:
+                    options['channel_order_file'] = None
+                    break
+                if os.path.exists(profile_path) and profile_path.lower().endswith(('.json', '.csv')):
+                    options['channel_order_file'] = profile_path
+                    break
+                print(f"{Colors.RED}Ruta de archivo no válida o no es un archivo .json/.csv. Inténtalo de "
+                      f"nuevo.{Colors.RESET}")
+
+        elif choice == '11':
+            lazy_choice = input(f"{Colors.YELLOW}Con 'Priorizar calidad' o 'Mantener el primero', ¿dejar de comprobar "
+                                f"cada grupo de duplicados en cuanto uno funcione? (s/n): {Colors.RESET}").strip().lower()
+            options['lazy_probe'] = (lazy_choice == 's')
+
+        elif choice == '12':
+            incremental_choice = input(f"{Colors.YELLOW}¿Reutilizar los resultados de la ejecución anterior para las "
+                                       f"entradas que no han cambiado? (s/n): {Colors.RESET}").strip().lower()
+            options['incremental'] = (incremental_choice == 's')
+
+        elif choice == '13':
+            quiet_choice = input(f"{Colors.YELLOW}¿Ocultar las líneas por canal (comprobación y numeración) y mostrar "
+                                 f"solo el progreso y el resumen? (s/n): {Colors.RESET}").strip().lower()
+            options['quiet'] = (quiet_choice == 's')
+
+        elif choice == '14':
+            metrics_choice = input(f"{Colors.YELLOW}¿Guardar métricas de la ejecución (.metrics.json y .prom junto a "
+                                   f"la lista resultante)? (s/n): {Colors.RESET}").strip().lower()
+            options['metrics'] = (metrics_choice == 's')
+
+        elif choice == '15':
+            while True:
+                epg_choice = input(f"{Colors.YELLOW}Guardar junto a la lista una guía EPG con solo sus canales: 1. No, "
+                                   f"2. .xml, 3. .xml.gz (1-3): {Colors.RESET}").strip()
+                if epg_choice in ('1', '2', '3'):
+                    options['filtered_epg'] = {'1': None, '2': 'xml', '3': 'xml.gz'}[epg_choice]
+                    break
+                print(f"{Colors.RED}Opción no válida. Por favor, introduce 1, 2 o 3.{Colors.RESET}")
+
+        elif choice == '16':
+            while True:
+                limite_str = input(f"{Colors.YELLOW}Conexiones simultáneas y peticiones por segundo por servidor, "
+                                   "CONEXIONES[/POR_SEGUNDO] (ej. 2/1; deja en blanco para no limitar): "
+                                   f"{Colors.RESET}").strip()
+                if not limite_str:
+                    options['host_limit'] = None
+                    break
+                try:
+                    options['host_limit'] = _valores_limite_host(limite_str)
+                    break
+                except ValueError as e:
+                    print(f"{Colors.RED}{e}{Colors.RESET}")
+
+        elif choice == '17':
+            breaker_choice = input(f"{Colors.YELLOW}¿Dar por fallidas sin esperar las URLs de un servidor que no responde "
+                                   f"tras {HOST_BREAKER_THRESHOLD} intentos seguidos? (s/n): {Colors.RESET}").strip().lower()
+            options['host_breaker'] = (breaker_choice == 's')
+
+        elif choice == '18':
             if options['input_m3u_file']:
                 return options
             else:
                 input(f"{Colors.RED}¡Atención! Debes especificar la ruta del archivo M3U de entrada (Opción 1) antes de iniciar. Presiona Enter para continuar...{Colors.RESET}")
-        
-        elif choice == '8':
+
+        elif choice == '19':
             print(f"{Colors.YELLOW}Saliendo del script. ¡Hasta pronto!{Colors.RESET}")
             sys.exit(0)
-        
+
         else:
             input(f"{Colors.RED}Opción no válida. Presiona Enter para continuar...{Colors.RESET}")
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(ejecutar_cli(sys.argv[1:]))
+
     config_options = display_menu()
 
     archivo_m3u = config_options['input_m3u_file']
@@ -650,15 +3406,60 @@ if __name__ == "__main__":
     output_file_name = config_options['output_file_name']
     start_channel_number = config_options['start_channel_number']
     duplicate_handling_method = config_options['duplicate_handling']
-
-    epg_data = descargar_y_parsear_epg(EPG_GUIDE_URL)
+    max_workers = config_options['max_workers']
+    probe_method = config_options['probe_method']
+    health_cache = StreamHealthCache() if config_options['use_health_cache'] else None
+    channel_order = cargar_perfil_orden(config_options['channel_order_file']) if config_options['channel_order_file'] else None
+    sondeo_diferido = config_options['lazy_probe']
+    incremental = config_options['incremental']
+    metricas = RunMetrics(nombre_lista(archivo_m3u))
+
+    # Una lista remota no se puede sobrescribir: sin nombre de salida se guarda en la carpeta actual
+    lista_remota = es_lista_remota(archivo_m3u)
+    if lista_remota and not output_file_name:
+        output_file_name = nombre_lista(archivo_m3u)
+        print(f"{Colors.BLUE}La lista es remota: el resultado se guardará en '{output_file_name}'.{Colors.RESET}")
+
+    with metricas.stage('epg_load'):
+        epg_data, epg_index = cargar_epgs(EPG_GUIDE_URLS)
     if not epg_data:
         print(f"{Colors.RED}No se pudo cargar la guía EPG. Continuando sin asignación de tvg-id.{Colors.RESET}")
+    guias_epg = None
+    if config_options['filtered_epg']:
+        with metricas.stage('epg_guide_download'):
+            guias_epg = descargar_guias_epg(EPG_GUIDE_URLS)
+
+    # Si una ejecución anterior se cortó a mitad, su diario permite no repetir lo ya comprobado
+    reanudar = False
+    if os.path.exists(ruta_diario(output_file_name or archivo_m3u)):
+        respuesta_reanudar = input(f"{Colors.CYAN}Hay una ejecución anterior sin terminar. ¿Reanudar sin volver a "
+                                   f"comprobar lo ya comprobado? (s/n): {Colors.RESET}").lower()
+        reanudar = respuesta_reanudar == 's'
 
     print(f"{Colors.YELLOW}Leyendo el archivo: {Colors.BOLD}{archivo_m3u}{Colors.RESET}")
-    lineas = leer_m3u(archivo_m3u)
+    lineas = iterar_m3u(archivo_m3u)
 
-    if lineas:
-        procesar_m3u(archivo_m3u, lineas, auto_borrar, timeout, epg_data, output_file_name, start_channel_number, duplicate_handling_method)
-    else:
-        print(f"{Colors.YELLOW}El archivo .m3u está vacío.{Colors.RESET}")
+    epg_memo = abrir_memo_epg(epg_data) if epg_data else None
+
+    try:
+        if lista_remota or os.path.getsize(archivo_m3u) > 0:
+            opciones_proceso = {
+                'max_workers': max_workers, 'probe_method': probe_method, 'health_cache': health_cache,
+                'epg_index': epg_index, 'channel_order': channel_order, 'lazy_probe': sondeo_diferido,
+                'incremental': incremental, 'quiet': config_options['quiet'], 'run_metrics': metricas,
+                'fuzzy_duplicates': config_options['fuzzy_duplicates'], 'epg_guides': guias_epg,
+                'filtered_epg': config_options['filtered_epg'], 'resume': reanudar, 'epg_memo': epg_memo,
+                'host_limits': {'*': config_options['host_limit']} if config_options['host_limit'] else None,
+                'host_breaker': config_options['host_breaker']
+            }
+            procesar_m3u(archivo_m3u, lineas, auto_borrar, timeout, epg_data, output_file_name, start_channel_number,
+                         duplicate_handling_method, opciones_proceso)
+            if config_options['metrics']:
+                exportar_metricas(metricas, output_file_name or archivo_m3u)
+        else:
+            print(f"{Colors.YELLOW}El archivo .m3u está vacío.{Colors.RESET}")
+    finally:
+        if health_cache is not None:
+            health_cache.close()
+        if epg_memo is not None:
+            epg_memo.close()
@@ -0,0 +1,654 @@
+import glob
+import os
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("tqdm")
+pytest.importorskip("fuzzywuzzy")
+
+import m3u_processor as m3u  # noqa: E402
+
+ETIQUETAS_CALIDAD = (' HD', ' FHD', ' SD', ' UHD', ' 1080', ' 720')
+PREFIJOS = ('ES: ', 'ES | ', '[ES] ', 'VIP ')
+SILABAS = ('ra', 'to', 'me', 'di', 'sa', 'lu', 'no', 'ca', 've', 'pi', 'zo', 'mar', 'sol', 'del', 'tur', 'gen')
+CATEGORIAS = ('Deportes', 'Cine', 'Noticias', 'Música', 'Infantil', 'Documentales', 'Series', 'Regional')
+
+
+def _nombre_inventado(aleatorio, indice):
+    # Nombres reales de la tabla integrada y el resto inventados
+    nombres_reales = list(m3u.COMMON_SPANISH_CHANNELS_ORDER)
+    if indice < len(nombres_reales):
+        return nombres_reales[indice].title()
+    palabra = ''.join(aleatorio.choice(SILABAS) for _ in range(aleatorio.randint(2, 3)))
+    return f"{palabra.capitalize()} {aleatorio.choice(CATEGORIAS)} {indice}"
+
+
+def _con_ruido(aleatorio, nombre):
+    variante = aleatorio.randrange(6)
+    if variante == 0:
+        return nombre + aleatorio.choice(ETIQUETAS_CALIDAD)
+    if variante == 1:
+        return aleatorio.choice(PREFIJOS) + nombre
+    if variante == 2:
+        return nombre.upper()
+    if variante == 3 and len(nombre) > 3:
+        # Errata: dos letras contiguas intercambiadas
+        posicion = aleatorio.randrange(len(nombre) - 1)
+        return nombre[:posicion] + nombre[posicion + 1] + nombre[posicion] + nombre[posicion + 2:]
+    if variante == 4:
+        return nombre.replace(' ', '  ') + ' +'
+    return nombre + aleatorio.choice(ETIQUETAS_CALIDAD) + ' (Backup)'
+
+
+def _guia_y_nombres(semilla=3, canales_guia=300, nombres=150):
+    # Guía y nombres de lista sintéticos: los de la lista son variantes con ruido de los de la guía
+    # (etiquetas de calidad, prefijos, erratas...) y algunos nombres que no están en la guía
+    aleatorio = random.Random(semilla)
+    nombres_base = [_nombre_inventado(aleatorio, indice) for indice in range(canales_guia)]
+    epg_data = {}
+    for nombre in nombres_base:
+        epg_data.setdefault(m3u.normalizar_nombre_canal(nombre), nombre.replace(' ', '') + '.es')
+    consultas = []
+    for _ in range(nombres):
+        if aleatorio.random() < 0.8:
+            nombre = _con_ruido(aleatorio, aleatorio.choice(nombres_base))
+        else:
+            nombre = _nombre_inventado(aleatorio, canales_guia + aleatorio.randrange(1000))
+        consultas.append(nombre)
+    return epg_data, consultas
+
+
+def test_indice_epg_igual_que_recorrido_completo():
+    epg_data, consultas = _guia_y_nombres()
+    indice = m3u.EpgMatchIndex(epg_data)
+    for nombre in consultas:
+        assert m3u.encontrar_epg_id(nombre, epg_data, indice) == m3u.encontrar_epg_id(nombre, epg_data), nombre
+
+
+@pytest.mark.parametrize('con_rapidfuzz', [True, False])
+def test_emparejamiento_en_bloque_igual_que_por_canal(monkeypatch, con_rapidfuzz):
+    if con_rapidfuzz and m3u.rf_process is None:
+        pytest.skip("rapidfuzz no está instalado")
+    if not con_rapidfuzz:
+        monkeypatch.setattr(m3u, 'rf_process', None)
+    epg_data, consultas = _guia_y_nombres(semilla=5)
+    canales = [m3u.Channel(f'#EXTINF:-1 tvg-name="{nombre}",{nombre}', f"http://ejemplo.com/{posicion}")
+               for posicion, nombre in enumerate(consultas)]
+    m3u.emparejar_canales_epg(canales, epg_data)
+    for canal in canales:
+        assert canal.epg_match[0] == m3u.encontrar_epg_id(canal.tvg_name, epg_data), canal.tvg_name
+
+
+def test_cache_de_comprobaciones_compartida(tmp_path):
+    # Dos procesos del modo por lotes con la misma caché: ninguno bloquea la escritura del otro
+    ruta = str(tmp_path / "cache.sqlite")
+    primera = m3u.StreamHealthCache(ruta)
+    segunda = m3u.StreamHealthCache(ruta)
+    primera.put("http://ejemplo.com/1", True, 0.1)
+    assert primera.get("http://ejemplo.com/1")['ok'] is True
+    segunda.put("http://ejemplo.com/2", False, 0.2)
+    segunda.flush()
+    primera.close()
+    segunda.close()
+
+    cache = m3u.StreamHealthCache(ruta)
+    assert cache.get("http://ejemplo.com/1")['ok'] is True
+    assert cache.get("http://ejemplo.com/2")['ok'] is False
+    cache.close()
+
+
+def test_huella_epg_depende_de_la_normalizacion(monkeypatch):
+    epg_data = {'la 1': 'La1.es'}
+    huella = m3u.huella_epg(epg_data)
+    monkeypatch.setattr(m3u, 'NORMALIZE_VERSION', m3u.NORMALIZE_VERSION + 1)
+    assert m3u.huella_epg(epg_data) != huella
+
+
+def test_cargar_epgs_con_una_guia_que_falla(monkeypatch, tmp_path):
+    def cargar_datos_epg(url, timeout, cache_dir, limite=None):
+        if url == "http://ejemplo.com/rota.xml":
+            raise ValueError("XML no válido")
+        return {'la 1': 'La1.es'}
+
+    monkeypatch.setattr(m3u, 'cargar_datos_epg', cargar_datos_epg)
+    epg_data, epg_index = m3u.cargar_epgs(["http://ejemplo.com/rota.xml", "http://ejemplo.com/buena.xml"],
+                                          cache_dir=str(tmp_path))
+    assert epg_data == {'la 1': 'La1.es'}
+    assert epg_index is not None
+
+
+def _puerto_cerrado():
+    with socket.socket() as libre:
+        libre.bind(('127.0.0.1', 0))
+        return libre.getsockname()[1]
+
+
+def test_cache_epg_en_json(tmp_path, monkeypatch):
+    url = f"http://127.0.0.1:{_puerto_cerrado()}/guia.xml"
+    ruta_cache = m3u._ruta_cache_epg(url, str(tmp_path))
+    epg_data = {'la 1': 'La1.es', 'telecinco': 'Telecinco.es'}
+    m3u._guardar_cache_epg(ruta_cache, {'url': url, 'etag': '"1"', 'last_modified': None, 'epg_data': epg_data})
+    assert ruta_cache.endswith('.json')
+    # Sin conexión se usa la copia local y el índice se reconstruye a partir de ella
+    cargada, indice = m3u.cargar_epg(url, timeout=1, cache_dir=str(tmp_path))
+    assert cargada == epg_data
+    assert m3u.encontrar_epg_id('Telecinco HD', cargada, indice) == 'Telecinco.es'
+    # Con otra normalización de nombres la copia no sirve
+    monkeypatch.setattr(m3u, 'NORMALIZE_VERSION', m3u.NORMALIZE_VERSION + 1)
+    assert m3u._leer_cache_epg(ruta_cache) is None
+    assert m3u.cargar_epg(url, timeout=1, cache_dir=str(tmp_path)) == (None, None)
+
+
+def test_cache_epg_no_valida(tmp_path):
+    ruta_cache = str(tmp_path / "guia.json")
+    for contenido in ('{"version": 3', '[1, 2]', '{"version": 1, "epg_data": {}}'):
+        with open(ruta_cache, 'w', encoding='utf-8') as f:
+            f.write(contenido)
+        assert m3u._leer_cache_epg(ruta_cache) is None
+
+
+def test_lineas_de_trozos_con_crlf_partido():
+    # El \r y el \n de un mismo salto llegan en trozos distintos
+    trozos = [b"#EXTM3U\r", b"\n#EXTINF:-1,Uno\r", b"\nhttp://a/1\r\n", b"#EXTINF:-1,Dos\rhttp://a/2"]
+    assert list(m3u._lineas_de_trozos(trozos)) == [
+        "#EXTM3U\n", "#EXTINF:-1,Uno\n", "http://a/1\n", "#EXTINF:-1,Dos\n", "http://a/2\n"]
+
+
+def test_lista_remota_con_crlf(tmp_path):
+    contenido = "#EXTM3U\r\n" + "".join(
+        f'#EXTINF:-1 tvg-name="Canal {indice}",Canal {indice}\r\nhttp://ejemplo.com/{indice}\r\n'
+        for indice in range(2000))
+    datos = contenido.encode('utf-8')
+    ruta = tmp_path / "lista.m3u"
+    ruta.write_bytes(datos)
+
+    class Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), Manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{servidor.server_address[1]}/lista.m3u"
+        remotos = [(canal.tvg_name, canal.url) for tipo, canal in m3u.parsear_m3u(m3u.iterar_m3u(url))
+                   if tipo == 'canal']
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+    locales = [(canal.tvg_name, canal.url) for tipo, canal in m3u.parsear_m3u(m3u.iterar_m3u(str(ruta)))
+               if tipo == 'canal']
+    assert len(remotos) == 2000
+    assert remotos == locales
+
+
+def test_reparto_sin_limites_por_defecto():
+    # Sin límites configurados, una lista de un solo servidor usa todas las conexiones
+    scheduler = m3u.HostScheduler()
+    for indice in range(50):
+        scheduler.add(m3u.Channel(f'#EXTINF:-1,Canal {indice}', f"http://panel.ejemplo.com/{indice}"))
+    assert all(scheduler.next() is not None for _ in range(50))
+    assert scheduler.queued == 0
+
+
+@pytest.mark.parametrize('texto', ['*=-1', '*=2/-1', '*=2/nan', '*=dos', 'sin-igual'])
+def test_limite_host_no_valido(texto):
+    with pytest.raises(m3u.argparse.ArgumentTypeError):
+        m3u._limite_host(texto)
+
+
+def test_limites_host_de_configuracion():
+    assert m3u.validar_limites_host({'*.panel.com': {'max_concurrent': 2, 'rate': 0.5, 'burst': None}}) is None
+    assert m3u.validar_limites_host({'*': {'max_concurrent': -1}})
+    assert m3u.validar_limites_host({'*': {'rate': 1, 'burst': 0.5}})
+    assert m3u.validar_limites_host({'*': {'conexiones': 2}})
+    assert m3u.validar_limites_host({'*': 2})
+
+
+def test_limites_no_validos_no_pierden_canales(monkeypatch):
+    # Límites editados a mano en HOST_RATE_LIMITS: ningún canal se queda en la cola sin comprobar
+    monkeypatch.setattr(m3u, '_comprobar_canal', lambda url, *args: (True, 0.0))
+    scheduler = m3u.HostScheduler()
+    scheduler.limits = {'*': {'max_concurrent': -1, 'rate': -5, 'burst': 0}}
+    canales = [m3u.Channel(f'#EXTINF:-1,Canal {indice}', f"http://panel.ejemplo.com/{indice}") for indice in range(20)]
+    comprobados = [canal for canal, _ in m3u.comprobar_canales_concurrente(canales, max_workers=4, scheduler=scheduler)]
+    assert sorted(canal.url for canal in comprobados) == sorted(canal.url for canal in canales)
+    assert scheduler.queued == 0
+
+
+def test_reparto_nunca_termina_con_canales_en_cola(monkeypatch):
+    # Aunque un servidor quede bloqueado sin poder recuperar fichas, sus canales se comprueban igualmente
+    monkeypatch.setattr(m3u, '_comprobar_canal', lambda url, *args: (True, 0.0))
+    scheduler = m3u.HostScheduler()
+    monkeypatch.setattr(scheduler, 'limits_for', lambda host: {'max_concurrent': -1, 'rate': None, 'burst': None})
+    canales = [m3u.Channel(f'#EXTINF:-1,Canal {indice}', f"http://panel.ejemplo.com/{indice}") for indice in range(5)]
+    comprobados = list(m3u.comprobar_canales_concurrente(canales, max_workers=2, scheduler=scheduler))
+    assert len(comprobados) == 5
+    assert scheduler.queued == 0
+
+
+def test_normalizacion_de_nombres_sin_cambios():
+    # La numeración y el emparejamiento EPG dependen de esta normalización: la clave de los nombres
+    # parecidos separa las palabras, pero normalizar_nombre_canal debe seguir pegándolas
+    assert m3u.normalizar_nombre_canal("Dkiss 720 (Backup)") == "dkissbackup"
+    assert m3u.normalizar_nombre_canal("Movistar Plus+ HD (Backup)") == "movistarbackup"
+    assert m3u._clave_casi_duplicado("M+ LaLiga 1080 (backup)") == "movistar laliga"
+
+
+def test_nombres_parecidos_de_la_tabla_integrada():
+    # Cada entrada de la tabla de numeración es un canal distinto: ninguna se puede unir a otra
+    assert m3u.agrupar_casi_duplicados(list(m3u.COMMON_SPANISH_CHANNELS_ORDER)) == {}
+    assert m3u.agrupar_casi_duplicados(["Sky Sport", "Sky Sports", "Movistar Cine", "Movistar Cines"]) == {}
+
+
+def test_nombres_parecidos_que_se_agrupan():
+    grupos = m3u.agrupar_casi_duplicados(["Movistar LaLiga", "M+ LaLiga 1080 (backup)", "Tele Cinco", "Telecinco HD",
+                                          "LaLiga Movistar"])
+    assert grupos == {'m laligabackup': 'movistar laliga', 'telecinco': 'tele cinco', 'laliga movistar': 'movistar laliga'}
+
+
+class _ManejadorCanales(BaseHTTPRequestHandler):
+    # /ok responde 200 y cualquier otra ruta 404; anota las rutas pedidas
+    peticiones = []
+
+    def do_HEAD(self):
+        self.peticiones.append(self.path)
+        self.send_response(200 if self.path.startswith('/ok') else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servidor_canales():
+    manejador = type('Manejador', (_ManejadorCanales,), {'peticiones': []})
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), manejador)
+    servidor.url = f"http://127.0.0.1:{servidor.server_address[1]}"
+    servidor.peticiones = manejador.peticiones
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    try:
+        yield servidor
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+
+
+def _lista_con_espejos(base):
+    # Cada canal tiene varios espejos, unos caídos y otros no
+    espejos = {
+        'Uno': ['bad', 'ok', 'ok'],
+        'Dos': ['ok'],
+        'Tres': ['bad'],
+        'Cuatro': ['bad', 'bad', 'ok'],
+        'Cinco': ['ok', 'bad'],
+    }
+    lineas = ["#EXTM3U\n"]
+    for nombre, rutas in espejos.items():
+        for indice, ruta in enumerate(rutas):
+            lineas.append(f'#EXTINF:-1 tvg-name="{nombre}",{nombre}\n')
+            lineas.append(f"{base}/{ruta}/{nombre}/{indice}\n")
+    return lineas
+
+
+def _procesar(ruta_lista, salida, duplicados, opciones, epg_data=None):
+    lineas = ruta_lista.read_text(encoding='utf-8').splitlines(keepends=True)
+    opciones = dict({'interactive': False, 'quiet': True, 'max_workers': 4, 'probe_method': 'head'}, **opciones)
+    return m3u.procesar_m3u(str(ruta_lista), lineas, borrar_automatico=True, timeout=5, epg_data=epg_data,
+                            output_file_name=str(salida), duplicate_handling_method=duplicados, opciones=opciones)
+
+
+@pytest.mark.parametrize('duplicados', ['first', 'quality'])
+def test_sondeo_diferido_igual_que_completo(tmp_path, servidor_canales, duplicados):
+    ruta = tmp_path / "lista.m3u"
+    ruta.write_text("".join(_lista_con_espejos(servidor_canales.url)), encoding='utf-8')
+    _procesar(ruta, tmp_path / "completo.m3u", duplicados, {'lazy_probe': False})
+    _procesar(ruta, tmp_path / "diferido.m3u", duplicados, {'lazy_probe': True})
+    completo = (tmp_path / "completo.m3u").read_text(encoding='utf-8')
+    assert "/ok/" in completo and "/bad/" not in completo
+    assert (tmp_path / "diferido.m3u").read_text(encoding='utf-8') == completo
+
+
+class _Reloj:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+
+def test_cortocircuito_tras_fallos_de_conexion():
+    breaker = m3u.HostCircuitBreaker(threshold=3, cooldown=30, trial_timeout=2)
+    for _ in range(2):
+        breaker.record('caido.com', False, True, 5.0)
+    # Un error HTTP es una respuesta: el servidor está vivo y la cuenta vuelve a empezar
+    breaker.record('caido.com', False, False, 0.1)
+    for _ in range(2):
+        breaker.record('caido.com', False, True, 5.0)
+    assert breaker.timeout_for('caido.com', 5) == 5
+    breaker.record('caido.com', False, True, 5.0)
+    assert breaker.timeout_for('caido.com', 5) is None
+    assert breaker.timeout_for('caido.com', 5) is None
+    assert breaker.timeout_for('otro.com', 5) == 5
+    assert breaker.tripped_hosts() == {'caido.com': 2}
+
+
+def test_cortocircuito_una_sola_prueba_tras_la_espera(monkeypatch):
+    reloj = _Reloj()
+    monkeypatch.setattr(m3u.time, 'monotonic', reloj)
+    breaker = m3u.HostCircuitBreaker(threshold=2, cooldown=30, trial_timeout=2)
+    breaker.record('caido.com', False, True, 5.0)
+    breaker.record('caido.com', False, True, 5.0)
+    reloj.ahora += 29
+    assert breaker.timeout_for('caido.com', 5) is None
+    reloj.ahora += 2
+    # Pasada la espera sale una única comprobación de prueba, con el timeout corto
+    assert breaker.timeout_for('caido.com', 5) == 2
+    assert breaker.timeout_for('caido.com', 5) is None
+    # Si la prueba falla, la espera vuelve a empezar
+    breaker.record('caido.com', False, True, 2.0)
+    reloj.ahora += 29
+    assert breaker.timeout_for('caido.com', 5) is None
+    reloj.ahora += 2
+    assert breaker.timeout_for('caido.com', 5) == 2
+    # Si responde, el servidor se comprueba con normalidad y necesita otra vez todos los fallos para cortarse
+    breaker.record('caido.com', True, False, 0.2)
+    assert breaker.timeout_for('caido.com', 5) == 5
+    assert breaker.timeout_for('caido.com', 5) == 5
+    breaker.record('caido.com', False, True, 5.0)
+    assert breaker.timeout_for('caido.com', 5) == 5
+
+
+def test_timeout_adaptativo_acotado():
+    breaker = m3u.HostCircuitBreaker()
+    for _ in range(m3u.ADAPTIVE_TIMEOUT_MIN_SAMPLES - 1):
+        breaker.record('rapido.com', True, False, 0.01, 'head')
+    assert breaker.timeout_for('rapido.com', 5, 'head') == 5
+    breaker.record('rapido.com', True, False, 0.01, 'head')
+    assert breaker.timeout_for('rapido.com', 5, 'head') == m3u.ADAPTIVE_TIMEOUT_MIN
+    # Las latencias de HEAD no acortan el timeout de otro método
+    assert breaker.timeout_for('rapido.com', 5, 'throughput') == 5
+    for _ in range(m3u.ADAPTIVE_TIMEOUT_MIN_SAMPLES):
+        breaker.record('lento.com', True, False, 4.0, 'head')
+    assert breaker.timeout_for('lento.com', 5, 'head') == 5
+    for _ in range(m3u.ADAPTIVE_TIMEOUT_MIN_SAMPLES):
+        breaker.record('medio.com', True, False, 0.5, 'head')
+    assert breaker.timeout_for('medio.com', 5, 'head') == pytest.approx(0.5 * m3u.ADAPTIVE_TIMEOUT_FACTOR)
+
+
+def test_timeout_de_lectura_no_cuenta_como_servidor_caido():
+    excepciones = m3u.requests.exceptions
+    assert m3u._servidor_no_responde(excepciones.ConnectTimeout())
+    assert m3u._servidor_no_responde(excepciones.ConnectionError("Connection refused"))
+    assert not m3u._servidor_no_responde(excepciones.ReadTimeout())
+    # Así envuelve requests el timeout de lectura mientras descarga el cuerpo
+    assert not m3u._servidor_no_responde(excepciones.ConnectionError(m3u.ReadTimeoutError(None, None, "Read timed out.")))
+
+
+def test_servidor_lento_no_se_corta():
+    class Manejador(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            time.sleep(1)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), Manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    breaker = m3u.HostCircuitBreaker(threshold=2)
+    try:
+        url = f"http://127.0.0.1:{servidor.server_address[1]}/lento"
+        for _ in range(3):
+            resultado = m3u._comprobar_canal(url, 0.2, None, 'head', breaker)
+            assert not resultado['ok'] and not resultado['error_red']
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+    assert breaker.tripped_hosts() == {}
+
+
+@pytest.mark.parametrize('activado', [True, False])
+def test_interruptor_del_cortocircuito(tmp_path, activado):
+    # Un puerto sin nadie escuchando rechaza la conexión al momento
+    puerto = _puerto_cerrado()
+    ruta = tmp_path / "lista.m3u"
+    ruta.write_text("#EXTM3U\n" + "".join(f'#EXTINF:-1 tvg-name="Canal {indice}",Canal {indice}\n'
+                                          f"http://127.0.0.1:{puerto}/{indice}\n" for indice in range(20)),
+                    encoding='utf-8')
+    resumen = _procesar(ruta, tmp_path / "salida.m3u", 'all', {'max_workers': 1, 'host_breaker': activado})
+    assert resumen['fallidos'] == 20
+    assert bool(resumen['hosts_cortocircuitados']) == activado
+
+
+def _canales(ruta_lista):
+    return [canal for tipo, canal in m3u.parsear_m3u(m3u.iterar_m3u(str(ruta_lista))) if tipo == 'canal']
+
+
+def test_reanudar_no_vuelve_a_comprobar_lo_del_diario(tmp_path, servidor_canales):
+    ruta = tmp_path / "lista.m3u"
+    ruta.write_text("".join(_lista_con_espejos(servidor_canales.url)), encoding='utf-8')
+    salida = tmp_path / "salida.m3u"
+    canales = _canales(ruta)
+    diario = m3u.ProbeJournal(m3u.ruta_diario(str(salida)), 'head')
+    # El diario da por buenos los primeros canales, aunque su URL no funcione: así se ve que no se vuelven a pedir
+    for canal in canales[:3]:
+        diario.record(canal.entry_hash(), {'ok': True, 'latencia': 0.1})
+    diario.close()
+    resumen = _procesar(ruta, salida, 'all', {'resume': True})
+    assert resumen['sondeos_reanudados'] == 3
+    assert sorted(servidor_canales.peticiones) == sorted(m3u.urlsplit(canal.url).path for canal in canales[3:])
+    assert canales[0].url in salida.read_text(encoding='utf-8')
+    # La ejecución terminó y se guardó: el diario ya no hace falta
+    assert not (tmp_path / "salida.journal").exists()
+
+
+def test_diario_con_la_ultima_linea_a_medias(tmp_path):
+    ruta = str(tmp_path / "salida.journal")
+    diario = m3u.ProbeJournal(ruta, 'head')
+    diario.record('a' * 40, {'ok': True, 'latencia': 0.2})
+    diario.record('b' * 40, {'ok': False, 'latencia': 5.0})
+    diario.close()
+    with open(ruta, 'a', encoding='utf-8') as f:
+        f.write('{"hash":"' + 'c' * 20)
+    reanudado = m3u.ProbeJournal(ruta, 'head', reanudar=True)
+    assert set(reanudado.entries) == {'a' * 40, 'b' * 40}
+    assert reanudado.get('b' * 40)['ok'] is False
+    # Lo nuevo se añade detrás de lo recuperado, no de la línea a medias
+    reanudado.record('d' * 40, {'ok': True})
+    reanudado.close()
+    assert set(m3u.ProbeJournal._leer(ruta, 'head')) == {'a' * 40, 'b' * 40, 'd' * 40}
+
+
+@pytest.mark.parametrize('cabecera', [
+    '{"version": 1, "probe_method": "range", "creado": 0}',
+    '{"version": 99, "probe_method": "head", "creado": 0}',
+    'no es json',
+])
+def test_diario_de_otra_version_o_metodo(tmp_path, cabecera):
+    ruta = tmp_path / "salida.journal"
+    ruta.write_text(cabecera + "\n" + '{"hash":"' + 'a' * 40 + '","ok":true,"comprobado":%f}\n' % time.time(),
+                    encoding='utf-8')
+    assert m3u.ProbeJournal._leer(str(ruta), 'head') is None
+    assert m3u.ProbeJournal(str(ruta), 'head', reanudar=True).entries == {}
+
+
+def test_guardar_parcial_conserva_el_diario(tmp_path, servidor_canales, monkeypatch):
+    ruta = tmp_path / "lista.m3u"
+    ruta.write_text("".join(_lista_con_espejos(servidor_canales.url)), encoding='utf-8')
+    salida = tmp_path / "salida.m3u"
+    comprobar = m3u._comprobar_canal
+    llamadas = []
+
+    def comprobar_e_interrumpir(*args, **kwargs):
+        # Simula un Ctrl+C a mitad de las comprobaciones
+        llamadas.append(args[0])
+        if len(llamadas) == 4:
+            raise KeyboardInterrupt
+        return comprobar(*args, **kwargs)
+
+    monkeypatch.setattr(m3u, '_comprobar_canal', comprobar_e_interrumpir)
+    monkeypatch.setattr('builtins.input', lambda *args: 's')
+    lineas = ruta.read_text(encoding='utf-8').splitlines(keepends=True)
+    m3u.procesar_m3u(str(ruta), lineas, timeout=5, output_file_name=str(salida),
+                     opciones={'interactive': True, 'quiet': True, 'max_workers': 1, 'probe_method': 'head'})
+    assert salida.exists()
+    diario = m3u.ProbeJournal._leer(m3u.ruta_diario(str(salida)), 'head')
+    assert diario and len(diario) < len(_canales(ruta))
+
+
+CANALES_INCREMENTAL = [('La 1', 'ok'), ('La 2', 'ok'), ('Antena 3', 'bad'), ('Cuatro', 'ok'), ('Telecinco', 'ok'),
+                       ('Canal Sur', 'ok')]
+GUIA_INCREMENTAL = {m3u.normalizar_nombre_canal(nombre): nombre.replace(' ', '') + '.es'
+                    for nombre, _ in CANALES_INCREMENTAL}
+
+
+def _escribir_lista(ruta, base, canales):
+    ruta.write_text("#EXTM3U\n" + "".join(f'#EXTINF:-1 tvg-name="{nombre}",{nombre}\n{base}/{estado}/{nombre}\n'
+                                          for nombre, estado in canales), encoding='utf-8')
+
+
+def _numeros(salida):
+    return {canal.tvg_name: dict(canal.attrs).get('tvg-chno') for canal in _canales(salida)}
+
+
+@pytest.fixture
+def lista_incremental(tmp_path, servidor_canales):
+    # Primera ejecución incremental: comprueba todo y deja el manifiesto junto a la salida
+    ruta = tmp_path / "lista.m3u"
+    salida = tmp_path / "salida.m3u"
+    _escribir_lista(ruta, servidor_canales.url, CANALES_INCREMENTAL)
+    resumen = _procesar(ruta, salida, 'all', {'incremental': True}, GUIA_INCREMENTAL)
+    assert resumen['sondeos_reutilizados'] == 0
+    assert len(servidor_canales.peticiones) == len(CANALES_INCREMENTAL)
+    assert m3u.cargar_manifiesto(m3u.ruta_manifiesto(str(salida))) is not None
+    del servidor_canales.peticiones[:]
+    return ruta, salida
+
+
+def _procesar_incremental(ruta, salida, opciones=None, epg_data=GUIA_INCREMENTAL):
+    metricas = m3u.RunMetrics()
+    resumen = _procesar(ruta, salida, 'all', dict({'incremental': True, 'run_metrics': metricas}, **(opciones or {})),
+                        epg_data)
+    return resumen, metricas.counters
+
+
+def test_manifiesto_sin_cambios(lista_incremental, servidor_canales):
+    ruta, salida = lista_incremental
+    anterior = salida.read_text(encoding='utf-8')
+    resumen, contadores = _procesar_incremental(ruta, salida)
+    assert resumen['sondeos_reutilizados'] == len(CANALES_INCREMENTAL)
+    assert servidor_canales.peticiones == []
+    assert contadores['epg_match_reused'] == resumen['con_epg_id'] > 0
+    assert salida.read_text(encoding='utf-8') == anterior
+
+
+def test_manifiesto_con_entradas_nuevas_y_borradas(lista_incremental, servidor_canales):
+    ruta, salida = lista_incremental
+    numeros = _numeros(salida)
+    canales = [canal for canal in CANALES_INCREMENTAL if canal[0] != 'La 2'] + [('Telemadrid', 'ok')]
+    _escribir_lista(ruta, servidor_canales.url, canales)
+    resumen, _ = _procesar_incremental(ruta, salida)
+    # Solo se comprueba la entrada nueva; las demás conservan su número
+    assert resumen['sondeos_reutilizados'] == len(canales) - 1
+    assert servidor_canales.peticiones == ['/ok/Telemadrid']
+    nuevos = _numeros(salida)
+    assert 'La 2' not in nuevos and nuevos['Telemadrid'] is not None
+    assert all(nuevos[nombre] == numeros[nombre] for nombre in numeros if nombre != 'La 2')
+
+
+def test_manifiesto_con_otra_guia_epg(lista_incremental, servidor_canales):
+    ruta, salida = lista_incremental
+    # Otra guía invalida los tvg-id guardados, pero no las comprobaciones
+    resumen, contadores = _procesar_incremental(ruta, salida, epg_data=dict(GUIA_INCREMENTAL, **{'tdp': 'Tdp.es'}))
+    assert resumen['sondeos_reutilizados'] == len(CANALES_INCREMENTAL)
+    assert contadores['epg_match_reused'] == 0
+    assert resumen['con_epg_id'] > 0
+
+
+def test_manifiesto_con_otro_metodo_de_comprobacion(lista_incremental, servidor_canales):
+    ruta, salida = lista_incremental
+    resumen, contadores = _procesar_incremental(ruta, salida, {'probe_method': 'range'})
+    assert resumen['sondeos_reutilizados'] == 0
+    assert len(servidor_canales.peticiones) == len(CANALES_INCREMENTAL)
+    assert contadores['epg_match_reused'] == resumen['con_epg_id'] > 0
+
+
+def test_metricas_sin_archivos_a_medias(tmp_path, monkeypatch):
+    metricas = m3u.RunMetrics('lista')
+    metricas.count('channels_checked', 3)
+    destino = str(tmp_path / "lista.m3u")
+    m3u.exportar_metricas(metricas, destino)
+    anterior = (tmp_path / "lista.metrics.json").read_text(encoding='utf-8')
+    assert m3u.json.loads(anterior)['counters']['channels_checked'] == 3
+
+    def to_dict_que_falla():
+        raise OSError("disco lleno")
+
+    # Si la escritura falla a mitad, el archivo anterior queda intacto y no queda el temporal
+    monkeypatch.setattr(metricas, 'to_dict', to_dict_que_falla)
+    m3u.exportar_metricas(metricas, destino)
+    assert (tmp_path / "lista.metrics.json").read_text(encoding='utf-8') == anterior
+    assert not (tmp_path / "lista.metrics.json.tmp").exists()
+
+
+GUIA_XMLTV = ('<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n'
+              '  <channel id="La1.es"><display-name>La 1</display-name></channel>\n'
+              '  <programme channel="La1.es" start="20240101000000 +0000"><title>Telediario</title></programme>\n'
+              '</tv>\n').encode('utf-8')
+
+
+class _ManejadorGuias(BaseHTTPRequestHandler):
+    # /lenta tarda más que el plazo de las guías; la otra responde al momento
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(GUIA_XMLTV)))
+        self.end_headers()
+        if self.path == '/lenta':
+            self.wfile.write(GUIA_XMLTV[:40])
+            self.wfile.flush()
+            time.sleep(1)
+        self.wfile.write(GUIA_XMLTV[40:] if self.path == '/lenta' else GUIA_XMLTV)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.mark.parametrize('cargar', ['cargar_epgs', 'descargar_guias_epg'])
+def test_guia_fuera_de_plazo_no_escribe_la_cache(tmp_path, cargar):
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), _ManejadorGuias)
+    hilo_servidor = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo_servidor.start()
+    previos = set(threading.enumerate())
+    base = f"http://127.0.0.1:{servidor.server_address[1]}"
+    try:
+        getattr(m3u, cargar)([f"{base}/rapida", f"{base}/lenta"], timeout=5, plazo=0.3, cache_dir=str(tmp_path))
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+    # Se espera a que termine el hilo de la guía lenta antes de mirar la carpeta de la caché
+    for hilo in set(threading.enumerate()) - previos:
+        hilo.join(5)
+    escritos = {os.path.basename(ruta) for ruta in glob.glob(str(tmp_path / '*'))}
+    rapida = os.path.basename(m3u._ruta_cache_epg(f"{base}/rapida", str(tmp_path)))
+    lenta = os.path.basename(m3u._ruta_cache_epg(f"{base}/lenta", str(tmp_path)))
+    if cargar == 'cargar_epgs':
+        assert escritos == {rapida}
+    else:
+        assert escritos == {rapida.replace('.json', '.guide'), rapida.replace('.json', '.guide.json')}
+    assert not any(nombre.startswith(os.path.splitext(lenta)[0]) for nombre in escritos)